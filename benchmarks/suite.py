@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for sparcli's hot paths. Results are written as JSON so that they
+can be compared between commits.
+
+Run from the repository root:
+
+    poetry run python benchmarks/suite.py run --output before.json
+    git checkout my-branch
+    poetry run python benchmarks/suite.py run --output after.json
+    poetry run python benchmarks/suite.py compare before.json after.json
+
+Use `--quick` to run only the smallest size of each benchmark, and `--filter` to
+select benchmarks by name. `--memory` also records the peak memory that each
+benchmark allocates, which is slower.
+"""
+import argparse
+from itertools import product
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import sparcli.capture
+import sparcli.sampling
+from sparcli.capture.capture import PipeCapture
+from sparcli.context import SampledContext, SparcliContext
+from sparcli.controller import Controller, Variable
+from sparcli.data import CompactingSeries, compact, normalize
+from sparcli.render import Renderer, render_as_vertical_bars, resample
+
+
+MAX_SIZE = 300
+BENCHMARKS = []
+
+
+def benchmark(**grid):
+    """
+    Register a benchmark, to be run once for each combination of parameters. The
+    decorated function does any setup and returns the function to time, and the
+    number of operations that one call of it performs.
+    """
+
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, setup, grid))
+        return setup
+
+    return register
+
+
+@benchmark(n_samples=[1_000, 100_000, 1_000_000], max_scale=[1000, 1])
+def series_add(n_samples, max_scale):
+    """Add values one at a time, to a compacting or (max_scale=1) truncating series."""
+    values = np.random.random(n_samples).tolist()
+
+    def run():
+        series = CompactingSeries(MAX_SIZE, max_scale)
+        for value in values:
+            series.add(value)
+
+    return run, n_samples
+
+
+@benchmark(max_scale=[1000, 1])
+def series_values(max_scale):
+    """Read the values of a full compacting or (max_scale=1) truncating series."""
+    series = CompactingSeries(MAX_SIZE, max_scale)
+    series.extend(np.random.random(100_000))
+
+    def run():
+        for _ in range(10_000):
+            series.values
+
+    return run, 10_000
+
+
+@benchmark(size=[MAX_SIZE, 10_000, 1_000_000])
+def data_compact(size):
+    values = np.random.random(size)
+    return lambda: compact(values), size
+
+
+@benchmark(size=[MAX_SIZE, 10_000, 1_000_000])
+def data_normalize(size):
+    values = np.random.random(size)
+    return lambda: normalize(values), size
+
+
+@benchmark(size=[MAX_SIZE, 10_000], width=[80, 200, 400])
+def render_resample(size, width):
+    values = np.random.random(size)
+    return lambda: resample(values, width), width
+
+
+@benchmark(width=[80, 200, 400])
+def render_vertical_bars(width):
+    values = np.random.random(width)
+    return lambda: render_as_vertical_bars(values), width
+
+
+class NullCapture:
+    mid_line = False
+
+    def flush(self, before_write=None):
+        return 0
+
+
+@benchmark(n_variables=[1, 100, 10_000], width=[80, 400], n_dirty=[1, None])
+def renderer_draw(n_variables, width, n_dirty):
+    """Draw a frame in which `n_dirty` variables changed (None: all of them)."""
+    renderer = Renderer(lambda data: None, NullCapture())
+    renderer.geometry.refresh = lambda: False
+    renderer.geometry.size = os.terminal_size((width, 24))
+    variables = {f"v{i}": Variable() for i in range(n_variables)}
+    for variable in variables.values():
+        variable.series.extend(np.random.random(1000))
+    renderer.draw(variables)
+    dirty = list(variables.values())[: n_dirty or n_variables]
+
+    def run():
+        for variable in dirty:
+            variable.series.add(0.5)
+        renderer.draw(variables)
+
+    return run, 1
+
+
+@benchmark(
+    n_variables=[100, 10_000], priority=["recent", "variance"], n_dirty=[1, None]
+)
+def renderer_draw_priority(n_variables, priority, n_dirty):
+    """
+    Draw a frame with more variables than fit in the terminal, choosing rows by
+    `priority`, after `n_dirty` variables changed (None: all of them).
+    """
+    renderer = Renderer(lambda data: None, NullCapture(), priority)
+    renderer.geometry.refresh = lambda: False
+    renderer.geometry.size = os.terminal_size((80, 24))
+    variables = {f"v{i}": Variable() for i in range(n_variables)}
+    for variable in variables.values():
+        variable.series.extend(np.random.random(1000))
+    renderer.draw(variables)
+    dirty = list(variables.values())[-(n_dirty or n_variables) :]
+
+    def run():
+        for variable in dirty:
+            variable.series.add(0.5)
+        renderer.draw(variables)
+
+    return run, 1
+
+
+class NullRenderer:
+    def start(self):
+        pass
+
+    def forget(self, variables):
+        pass
+
+
+@benchmark(n_variables=[1, 100, 10_000], n_samples=[100_000])
+def controller_ingest(n_variables, n_samples):
+    controller = Controller(NullRenderer())
+    producer = object()
+    names = [f"v{i}" for i in range(n_variables)]
+    events = [
+        ("data_produced", producer, {names[i % n_variables]: float(i)})
+        for i in range(n_samples)
+    ]
+
+    def run():
+        controller.event_queue.events.extend(events)
+        while controller.event_queue:
+            controller.process_events()
+
+    return run, n_samples
+
+
+SCALARS = {
+    "float": float,
+    "np.float64": np.float64,
+    "np.float32": np.float32,
+    "0-d array": np.array,
+}
+
+
+@benchmark(scalar=list(SCALARS), path=["series", "controller"], n_samples=[100_000])
+def scalar_add(scalar, path, n_samples):
+    """
+    Add each type of scalar that users record, directly to a series or through
+    the controller (ingesting a batch at a time, as between frames).
+    """
+    values = [SCALARS[scalar](x) for x in np.random.random(n_samples)]
+    controller = Controller(NullRenderer())
+    producer = object()
+
+    def run():
+        if path == "series":
+            series = CompactingSeries(MAX_SIZE)
+            for value in values:
+                series.add(value)
+            return
+        for i in range(0, n_samples, 1_000):
+            for value in values[i : i + 1_000]:
+                controller.data_produced(producer, {"x": value})
+            controller.ingest()
+
+    return run, n_samples
+
+
+@benchmark(n_samples=[1_000, 100_000, 10_000_000], chunk_size=[1_000])
+def series_extend(n_samples, chunk_size):
+    values = np.random.random(n_samples)
+
+    def run():
+        series = CompactingSeries(MAX_SIZE)
+        for i in range(0, n_samples, chunk_size):
+            series.extend(values[i : i + chunk_size])
+
+    return run, n_samples
+
+
+@benchmark(n_samples=[100_000], handle=[False, True])
+def context_record(n_samples, handle):
+    """
+    Record one variable through a context, with `record(x=...)` or a metric
+    handle, and ingest the events.
+    """
+    controller = Controller(NullRenderer())
+    context = SparcliContext(controller.event_queue)
+    values = [float(i) for i in range(n_samples)]
+
+    def run():
+        if handle:
+            metric = context.metric("x")
+            for value in values:
+                metric(value)
+        else:
+            for value in values:
+                context.record(x=value)
+        while controller.event_queue:
+            controller.process_events()
+
+    return run, n_samples
+
+
+SAMPLING = {
+    "every=1": {"every": 1},
+    "every=100": {"every": 100},
+    "fraction=0.01": {"fraction": 0.01},
+}
+
+
+@benchmark(n_samples=[100_000], option=list(SAMPLING))
+def context_sampled(n_samples, option):
+    """
+    Record one variable through a sampled metric handle, and ingest the values
+    that are kept.
+    """
+    controller = Controller(NullRenderer())
+    make_sampler = sparcli.sampling.policy(**SAMPLING[option])
+    context = SampledContext(
+        SparcliContext(controller.event_queue),
+        make_sampler,
+        controller.event_queue.append,
+    )
+    values = [float(i) for i in range(n_samples)]
+
+    def run():
+        metric = context.metric("x")
+        for value in values:
+            metric(value)
+        while controller.event_queue:
+            controller.process_events()
+
+    return run, n_samples
+
+
+@benchmark(n_variables=[1, 100, 10_000], n_producers=[1_000])
+def controller_producer_churn(n_variables, n_producers):
+    """
+    Short-lived producers (like `gen` in an inner loop) that each record one
+    sample to one variable and stop, while `n_variables` other variables live on.
+    """
+    controller = Controller(NullRenderer())
+    owner = object()
+    controller.data_produced(owner, {f"v{i}": 0.0 for i in range(n_variables)})
+    controller.ingest()
+    events = []
+    for i in range(n_producers):
+        producer = object()
+        events.append(("data_produced", producer, {"loop": float(i)}))
+        events.append(("producer_stopped", producer))
+
+    def run():
+        controller.event_queue.events.extend(events)
+        while controller.event_queue:
+            controller.process_events()
+
+    return run, n_producers
+
+
+@benchmark(n_bytes=[64 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+def capture_flush(n_bytes):
+    """Forward `n_bytes` of captured output to /dev/null, one pipe-full at a time."""
+    chunk = b"x" * 79 + b"\n"
+    chunk = chunk * (16 * 1024 // len(chunk))
+    target_fd = os.open(os.devnull, os.O_WRONLY)
+    capture = PipeCapture(sparcli.capture.get_platform(), target_fd)
+    capture.start()
+
+    def run():
+        written = 0
+        while written < n_bytes:
+            os.write(target_fd, chunk)
+            written += len(chunk)
+            capture.flush()
+
+    return run, n_bytes
+
+
+@benchmark(n_bytes=[1024 * 1024, 64 * 1024 * 1024], splice=[False, True])
+def capture_log_flood(n_bytes, splice):
+    """
+    Flood a capture with log lines as fast as the writer can go, while the
+    forwarding thread moves them to a file. `splice` chooses between os.splice
+    (where the platform has it) and copying through Python.
+    """
+    chunk = b"INFO worker: processed batch 1234 of 5678 (loss=0.1234)\n" * 64
+    target_fd, path = tempfile.mkstemp()
+    os.unlink(path)
+    capture = PipeCapture(sparcli.capture.get_platform(), target_fd)
+    capture.splice = splice and capture.splice
+    capture.start()
+    capture.start_forwarding(threading.Lock())
+
+    def run():
+        expected = capture.bytes_forwarded
+        written = 0
+        while written < n_bytes:
+            written += os.write(target_fd, chunk)
+        expected += written
+        while capture.bytes_forwarded < expected:
+            time.sleep(0.0001)
+        os.ftruncate(capture.true_fd, 0)
+        os.lseek(capture.true_fd, 0, os.SEEK_SET)
+
+    return run, n_bytes
+
+
+def run_benchmark(function, min_time=0.2, max_repeat=20):
+    """Time a function repeatedly, returning the fastest run in seconds."""
+    times = []
+    deadline = time.perf_counter() + min_time
+    while len(times) < max_repeat and (len(times) < 3 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), len(times)
+
+
+def peak_memory(function):
+    """Run a function once, returning the peak number of bytes it allocated."""
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def parameter_sets(grid, quick):
+    names = list(grid)
+    values = [grid[name][:1] if quick else grid[name] for name in names]
+    for combination in product(*values):
+        yield dict(zip(names, combination))
+
+
+def metadata():
+    try:
+        # Not capture_output or text, which need Python 3.7.
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+    }
+
+
+def run(args):
+    results = []
+    for name, setup, grid in BENCHMARKS:
+        if args.filter and args.filter not in name:
+            continue
+        for params in parameter_sets(grid, args.quick):
+            function, n_ops = setup(**params)
+            seconds, repeat = run_benchmark(function)
+            result = {
+                "name": name,
+                "params": params,
+                "seconds": seconds,
+                "per_op": seconds / n_ops,
+                "repeat": repeat,
+            }
+            line = f"{name:<22} {format_params(params):<40} {seconds / n_ops:12.3e} s/op"
+            if args.memory:
+                result["peak_bytes"] = peak_memory(function)
+                line += f" {result['peak_bytes'] / 1024:10.1f} KiB peak"
+            results.append(result)
+            print(line)
+    with open(args.output, "w") as file:
+        json.dump({"meta": metadata(), "results": results}, file, indent=2)
+
+
+def format_params(params):
+    return " ".join(f"{key}={value}" for key, value in params.items())
+
+
+def result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = {result_key(r): r for r in json.load(file)["results"]}
+    with open(args.candidate) as file:
+        candidate = json.load(file)["results"]
+
+    regressions = 0
+    for result in candidate:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result["per_op"] / before["per_op"]
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = "improved"
+        print(
+            f"{result['name']:<22} {format_params(result['params']):<40} "
+            f"{before['per_op']:10.3e} -> {result['per_op']:10.3e} "
+            f"({ratio:5.2f}x) {flag}"
+        )
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command")
+    # Not an argument of add_subparsers until Python 3.7.
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", default="benchmarks.json")
+    run_parser.add_argument("--filter", help="Only run benchmarks with this in their name")
+    run_parser.add_argument("--quick", action="store_true", help="Smallest sizes only")
+    run_parser.add_argument(
+        "--memory", action="store_true", help="Also record peak memory (slower)"
+    )
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown that counts as a regression (default: 0.1)",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,47 +1,323 @@
 import atexit
+import functools
+import os
+import sys
 import threading
 
+import sparcli.aio
 import sparcli.capture
 import sparcli.context
 import sparcli.controller
 import sparcli.render
+import sparcli.sampling
+import sparcli.shared
 
 
-__all__ = ["ctx", "gen"]
+__all__ = [
+    "actx",
+    "agen",
+    "configure",
+    "ctx",
+    "gen",
+    "init_worker",
+    "shared_sink",
+    "stats",
+]
 
 
-def ctx():
+def configure(**options):
+    """
+    Set options for the controller. Options take effect the next time the
+    controller is started, i.e. before the first call to `ctx` or `gen`.
+
+    max_fps: The maximum number of times per second to redraw the charts.
+    show_stats: Draw sparcli's own metrics (see `stats`) as extra charts.
+    max_queue_size: The maximum number of data events waiting for the
+        controller, or None for no limit.
+    overflow: What to do with data when the queue is full: "drop_newest",
+        "drop_oldest", or "collapse" (summarise it in the producer until there
+        is room). Recording never blocks.
+    headless: Whether to print plain-text summaries instead of drawing charts
+        and capturing output. By default, this is decided by whether stdout is
+        a terminal.
+    summary_interval: In headless mode, the number of seconds between
+        summaries. If None, nothing is printed and recording does nothing;
+        otherwise, every sample is still sent to the controller.
+    scroll_region: Pin the charts to the bottom of the terminal with a scroll
+        region, so output scrolls above them without redrawing them. Not all
+        terminals support this.
+    max_lines_per_second, max_bytes_per_second: Enter flood mode, showing at
+        most this much captured output. Above the limit, output is sampled,
+        and a marker says how many lines were left out.
+    spill_path: In flood mode, the file to write all captured output to. By
+        default, a temporary file is created. It's deleted at exit if no lines
+        were suppressed; otherwise, the markers say where it is, and it's kept.
+    grace_period: How many seconds to keep a variable after the last context
+        that recorded it is closed. If it's recorded again in that time (e.g.
+        by the next `gen` over an inner loop), it keeps its history.
+    row_priority: Which charts to show when there are more than fit in the
+        terminal: the first ones (None), those that changed most recently
+        ("recent"), or those with the highest "variance". The last row says how
+        many were left out. Variance is recomputed at most once a second per
+        chart, and ties go to the charts already shown.
+    """
+    unknown = set(options) - set(_controller_factory.__kwdefaults__)
+    if unknown:
+        raise TypeError(f"Unknown options: {', '.join(sorted(unknown))}")
+    _main.options.update(options)
+
+
+def ctx(
+    flush_interval=None, flush_count=None, every=None, interval=None, fraction=None
+):
+    """
+    Create a context for recording metrics. By default each record is sent to
+    the controller immediately. If `flush_interval` (seconds) or `flush_count`
+    (records) is given, records are summarised in the context and sent in bulk,
+    which is cheaper for tight loops.
+
+    To record only some of the values, give one of these options. Skipped
+    values cost next to nothing, and the charts show the fraction that was kept.
+
+    every: Keep every Nth record.
+    interval: Keep at most one record per this many seconds.
+    fraction: Keep this fraction of records, at random.
+
+    In a worker process set up with `init_worker`, this returns the worker's
+    shared memory context instead, and the options other than sampling are
+    ignored. The same goes for a context that does nothing, in headless mode
+    without summaries.
+    """
+    make_sampler = sparcli.sampling.policy(every, interval, fraction)
+    emit = None
+    if _main.fixed_context:
+        context = _main.fixed_context
+    else:
+        controller = _main.get_controller()
+        if not controller:
+            return _main.fixed_context
+        emit = controller.event_queue.append
+        if flush_interval or flush_count:
+            context = sparcli.context.AggregatingContext(
+                controller.event_queue, flush_interval, flush_count
+            )
+        else:
+            context = sparcli.context.SparcliContext(controller.event_queue)
+    if make_sampler:
+        return sparcli.context.SampledContext(context, make_sampler, emit)
+    return context
+
+
+def gen(iterable, name, batch_size=None, every=None, interval=None, fraction=None):
+    """
+    Wrap an iterable, recording each value that it yields. If `batch_size` is
+    given, values are sent to the controller in batches of that size (and when
+    the iteration ends). To record only some of the values, give `every`,
+    `interval` or `fraction` (see `ctx`).
+    """
+    with ctx(every=every, interval=interval, fraction=fraction) as context:
+        if not batch_size:
+            metric = context.metric(name)
+            for value in iterable:
+                metric(value)
+                yield value
+            return
+
+        batch = []
+        try:
+            for value in iterable:
+                batch.append(value)
+                if len(batch) >= batch_size:
+                    context.record_array(name, batch)
+                    batch.clear()
+                yield value
+        finally:
+            if batch:
+                context.record_array(name, batch)
+
+
+def actx(
+    flush_interval=None, flush_count=None, every=None, interval=None, fraction=None
+):
+    """
+    Like `ctx`, but for use with `async with`. If the controller hasn't been
+    started when the context is entered, it's started in an executor, so the
+    event loop is never blocked.
+    """
+    make_context = functools.partial(
+        ctx, flush_interval, flush_count, every, interval, fraction
+    )
+    return sparcli.aio.AsyncContext(make_context, would_block=_main.would_block)
+
+
+async def agen(
+    async_iterable, name, batch_size=None, every=None, interval=None, fraction=None
+):
+    """
+    Wrap an async iterable, recording each value that it yields. See `gen`.
+    """
+    async with actx(every=every, interval=interval, fraction=fraction) as context:
+        if not batch_size:
+            metric = context.metric(name)
+            async for value in async_iterable:
+                metric(value)
+                yield value
+            return
+
+        batch = []
+        try:
+            async for value in async_iterable:
+                batch.append(value)
+                if len(batch) >= batch_size:
+                    context.record_array(name, batch)
+                    batch.clear()
+                yield value
+        finally:
+            if batch:
+                context.record_array(name, batch)
+
+
+def shared_sink(n_workers, capacity=2 ** 16, merge=True, mp_context=None):
+    """
+    Create a sink for metrics recorded in other processes, e.g. the workers of a
+    `ProcessPoolExecutor`. Pass it to `init_worker` in each worker:
+
+        with sparcli.shared_sink(4) as sink, ProcessPoolExecutor(
+            4, initializer=sparcli.init_worker, initargs=(sink,)
+        ) as pool:
+            ...
+
+    n_workers: The maximum number of worker processes.
+    capacity: The number of samples that each worker can buffer.
+    merge: Whether to combine variables of the same name from different workers.
+        If False, each worker's variables are shown separately.
+    mp_context: The multiprocessing context that the workers are started with,
+        if not the default.
+
+    If nothing is being recorded in this process (in headless mode without
+    summaries, in a forked child, or in a worker), this returns a sink whose
+    workers record nothing, and no shared memory is allocated.
+
+    Requires Python 3.8+.
+    """
     controller = _main.get_controller()
-    return sparcli.context.SparcliContext(controller.event_queue)
+    if not controller:
+        return sparcli.shared.NullSink()
+    sink = sparcli.shared.SharedSink(n_workers, capacity, merge, mp_context)
+    sink.emit = controller.event_queue.append
+    sink.emit(("sink_added", sink))
+    return sink
 
 
-def gen(iterable, name):
-    with ctx() as context:
-        for value in iterable:
-            context.record(**{name: value})
-            yield value
+def init_worker(sink):
+    """
+    Make `ctx` and `gen` in this process record into `sink`, instead of starting
+    a controller. Call it in each worker process, e.g. as a pool initializer.
+    """
+    _main.fixed_context = sink.claim_slot()
+
+
+def stats():
+    """
+    Get counters and timings of sparcli's own work, for diagnosing overhead:
+    queue depth, events and samples per second, time spent ingesting, drawing
+    and forwarding captured output, and bytes written per frame. Returns None if
+    the controller isn't running.
+    """
+    controller = _main.controller
+    if not controller:
+        return None
+    return controller.get_stats()
 
 
 CAPTURE_METHOD = "fd"
 
 
-def _controller_factory():
-    capture = sparcli.capture.make_multi_capture(True, True)
-    renderer = sparcli.render.Renderer(capture.write_out, capture)
-    return sparcli.controller.Controller(renderer)
+def _controller_factory(
+    *,
+    max_fps=30,
+    show_stats=False,
+    max_queue_size=None,
+    overflow="drop_newest",
+    headless=None,
+    summary_interval=60,
+    scroll_region=False,
+    max_lines_per_second=None,
+    max_bytes_per_second=None,
+    spill_path=None,
+    grace_period=1.0,
+    row_priority=None,
+):
+    if headless is None:
+        headless = not _isatty(sys.stdout)
+    if headless:
+        if not summary_interval:
+            return None
+        renderer = sparcli.render.SummaryRenderer(_write_stdout)
+        max_fps = 1 / summary_interval
+    else:
+        capture = sparcli.capture.make_multi_capture(True, True)
+        if max_lines_per_second or max_bytes_per_second:
+            limiter = sparcli.capture.flood.FloodLimiter(
+                max_lines_per_second, max_bytes_per_second, spill_path
+            )
+            capture.limit_rate(limiter)
+        if scroll_region:
+            renderer_class = sparcli.render.ScrollRegionRenderer
+        else:
+            renderer_class = sparcli.render.Renderer
+        renderer = renderer_class(capture.write_out, capture, row_priority)
+    return sparcli.controller.Controller(
+        renderer,
+        max_fps=max_fps,
+        show_stats=show_stats,
+        max_queue_size=max_queue_size,
+        overflow=overflow,
+        grace_period=grace_period,
+    )
+
+
+def _isatty(file):
+    try:
+        return file.isatty()
+    except (AttributeError, ValueError):
+        # No stream (e.g. pythonw), or it's closed.
+        return False
+
+
+def _write_stdout(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
 
 
 class _Main:
     def __init__(self, lock):
         self.controller = None
         self.initialized = False
+        self.options = {}
+        # A context to use instead of the controller's: in worker processes,
+        # and when there is no output at all.
+        self.fixed_context = None
         self.controller_lock = lock
 
+    @property
+    def ready(self):
+        """Whether `ctx` can return without starting the controller."""
+        return self.controller is not None or self.fixed_context is not None
+
+    def would_block(self):
+        return not self.ready
+
     def get_controller(self):
+        # Once the controller is running, don't take the lock: it's held while the
+        # controller is torn down, which may take a while.
+        controller = self.controller
+        if controller is not None:
+            return controller
         with self.controller_lock:
             if not self.initialized:
                 self.initialize()
-            if not self.controller:
+            if not self.ready:
                 self.build()
         return self.controller
 
@@ -55,14 +331,42 @@ class _Main:
         self.initialized = True
 
     def build(self):
+        controller = _controller_factory(**self.options)
+        if not controller:
+            self.fixed_context = sparcli.context.NullContext()
+            return
         atexit.register(self.cleanup)
-        self.controller = _controller_factory()
-        self.controller.start()
+        controller.install_signal_handlers()
+        controller.start()
+        # Only published once it's running, because it's read without the lock.
+        self.controller = controller
 
     def tear_down(self):
         self.controller.stop()
         self.controller.join()
+        self.controller.restore_signal_handlers()
         self.controller = None
 
+    def after_fork(self):
+        """
+        Reset in a forked child process, which doesn't inherit the controller's
+        thread. The child records nothing: contexts from before the fork discard
+        their events, and new ones do nothing. Its output still goes through the
+        parent's capture, so it's shown in the parent's display.
+        """
+        self.controller_lock = threading.Lock()
+        if self.controller:
+            self.controller.event_queue.detach()
+            # The SIGWINCH handler would otherwise notify the closed waker.
+            self.controller.restore_signal_handlers()
+        self.controller = None
+        self.fixed_context = sparcli.context.NullContext()
+
+
+def _after_fork():
+    _main.after_fork()
+
 
 _main = _Main(threading.Lock())
+if hasattr(os, "register_at_fork"):  # Python 3.7+, not on Windows
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,31 @@
+import asyncio
+
+
+# Python 3.7+. Before that, get_event_loop returns the running loop in a coroutine.
+get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+class AsyncContext:
+    """
+    An async context manager for a metrics context. If making the context could
+    block (because it starts the controller), it is made in the loop's default
+    executor so that the event loop keeps running. Whether it could block is
+    decided by calling `would_block` on entry. Recording never blocks.
+    """
+
+    def __init__(self, make_context, would_block=None):
+        self.make_context = make_context
+        self.would_block = would_block
+        self.context = None
+
+    async def __aenter__(self):
+        if self.would_block is None or self.would_block():
+            loop = get_running_loop()
+            self.context = await loop.run_in_executor(None, self.make_context)
+        else:
+            self.context = self.make_context()
+        return self.context
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback
+        self.context.close()
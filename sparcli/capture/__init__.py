@@ -1,4 +1,5 @@
 from . import capture
+from . import flood  # noqa: F401
 from . import platform_posix
 from . import platform_windows
 from .system import os
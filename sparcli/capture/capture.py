@@ -1,7 +1,19 @@
+import errno
+import threading
+import time
+
+from ..events import Waker
 from .system import os
 
 
 class Capture:
+    bytes_forwarded = 0
+    forward_time = 0.0
+    # Whether the last output that was forwarded ended part way through a line.
+    mid_line = False
+    # A FloodLimiter that decides which output to show, if any.
+    limiter = None
+
     def __enter__(self):
         self.start()
         return self
@@ -15,21 +27,44 @@ class Capture:
     def close(self):
         raise NotImplementedError
 
-    def flush(self):
+    def flush(self, before_write=None):
         raise NotImplementedError
 
     def write(self, data):
         raise NotImplementedError
 
+    def start_forwarding(self, lock, before_write=None, after_write=None):
+        """
+        Forward captured output in the background as soon as it arrives, instead
+        of waiting for `flush`. `lock` is held while writing, and `before_write`
+        is called (with the lock held) before writing each chunk. `after_write` is
+        called after each chunk, without the lock.
+        """
+        raise NotImplementedError
+
+    def stop_forwarding(self):
+        raise NotImplementedError
+
 
 class PipeCapture(Capture):
-    BUFFER_SIZE = 4096
+    # How much to read at a time when copying output through Python.
+    BUFFER_SIZE = 64 * 1024
+    # The capacity to ask for, where pipes can be resized. Splicing moves up to
+    # a whole pipe-full at a time, so a larger pipe means fewer system calls.
+    PIPE_SIZE = 1024 * 1024
 
     def __init__(self, platform, target_fd: int):
         self.platform = platform
         self.target_fd = target_fd
         self.true_fd = target_fd
         self.pipe_out_fd = self.pipe_in_fd = None
+        self.forwarder = None
+        # Whether to move output to the true FD with os.splice. Turned off if
+        # the true FD turns out not to support it.
+        self.splice = platform.can_splice
+        self.bytes_forwarded = 0
+        self.forward_time = 0.0
+        self.mid_line = False
 
     def start(self):
         if self.true_fd != self.target_fd:
@@ -37,11 +72,13 @@ class PipeCapture(Capture):
         self.true_fd = os.dup(self.target_fd)
         self.pipe_out_fd, self.pipe_in_fd = os.pipe()
         self.platform.set_nonblocking(self.pipe_out_fd)
+        self.platform.set_pipe_size(self.pipe_in_fd, self.PIPE_SIZE)
         os.dup2(self.pipe_in_fd, self.target_fd)
 
     def close(self):
         if self.true_fd == self.target_fd:
             raise IOError(f"Not capturing FD {self.target_fd}")
+        self.stop_forwarding()
         os.dup2(self.true_fd, self.target_fd)
         os.close(self.pipe_in_fd)
         self.flush()
@@ -50,25 +87,100 @@ class PipeCapture(Capture):
         self.true_fd = self.target_fd
         self.pipe_out_fd = self.pipe_in_fd = None
 
-    def flush(self):
+    def flush(self, before_write=None):
+        forwarded = 0
         while True:
-            try:
-                data = os.read(self.pipe_out_fd, self.BUFFER_SIZE)
-            except BlockingIOError:
-                break
-            if not data:
-                break
-            os.write(self.true_fd, data)
+            n_bytes = self.forward(None if forwarded else before_write)
+            if not n_bytes:
+                return forwarded
+            forwarded += n_bytes
+
+    def forward(self, before_write=None):
+        """Forward one chunk of captured output. Returns its size."""
+        start = time.perf_counter()
+        if self.splice and not self.limiter:
+            n_bytes = self.forward_spliced(before_write)
+        else:
+            n_bytes = self.forward_copied(before_write)
+        if n_bytes:
+            self.bytes_forwarded += n_bytes
+            self.forward_time += time.perf_counter() - start
+        return n_bytes
+
+    def forward_copied(self, before_write):
+        try:
+            data = os.read(self.pipe_out_fd, self.BUFFER_SIZE)
+        except BlockingIOError:
+            return 0
+        if not data:
+            return 0
+        shown = self.limiter.filter(data) if self.limiter else data
+        if shown:
+            if before_write:
+                before_write()
+            self.write(shown)
+            self.mid_line = not shown.endswith(b"\n")
+        return len(data)
+
+    def forward_spliced(self, before_write):
+        """
+        Move a chunk from the pipe to the true FD inside the kernel. All but the
+        last byte is spliced; the last byte is copied, so that we still know
+        whether the output ends part way through a line.
+        """
+        size = min(self.platform.pending_bytes(self.pipe_out_fd), self.PIPE_SIZE)
+        if not size:
+            return 0
+        if before_write:
+            before_write()
+        spliced = 0
+        try:
+            while spliced < size - 1:
+                spliced += os.splice(self.pipe_out_fd, self.true_fd, size - 1 - spliced)
+        except BlockingIOError:
+            # The true FD is a full pipe, which splice won't wait for because
+            # the capture pipe is non-blocking. Copy the rest of the chunk.
+            pass
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                raise
+            # E.g. the true FD is a file opened for appending. Copy from now on.
+            self.splice = False
+        data = os.read(self.pipe_out_fd, size - spliced)
+        self.write(data)
+        self.mid_line = not data.endswith(b"\n")
+        return spliced + len(data)
 
     def write(self, data):
         if isinstance(data, str):
             data = data.encode("utf8")
-        os.write(self.true_fd, data)
+        while data:
+            data = data[os.write(self.true_fd, data) :]
+
+    def forward_marker(self, before_write=None):
+        """Show the flood limiter's marker, if it's due. Returns its size."""
+        marker = self.limiter.expire()
+        if marker:
+            if before_write:
+                before_write()
+            self.write(marker)
+            self.mid_line = False
+        return len(marker)
+
+    def start_forwarding(self, lock, before_write=None, after_write=None):
+        self.forwarder = Forwarder(self, lock, before_write, after_write)
+        self.forwarder.start()
+
+    def stop_forwarding(self):
+        if self.forwarder:
+            self.forwarder.stop()
+            self.forwarder = None
 
 
 class NoCapture(Capture):
     def __init__(self, target_fd):
         self.target_fd = target_fd
+        self.true_fd = target_fd
 
     def start(self):
         pass
@@ -76,17 +188,62 @@ class NoCapture(Capture):
     def close(self):
         pass
 
-    def flush(self):
-        pass
+    def flush(self, before_write=None):
+        return 0
 
     def write(self, data):
         os.write(self.target_fd, data)
 
+    def start_forwarding(self, lock, before_write=None, after_write=None):
+        pass
+
+    def stop_forwarding(self):
+        pass
+
+
+class Forwarder(threading.Thread):
+    """Forwards the output of a pipe capture whenever it becomes readable."""
+
+    def __init__(self, capture, lock, before_write=None, after_write=None):
+        super().__init__(daemon=True)
+        self.capture = capture
+        self.lock = lock
+        self.before_write = before_write
+        self.after_write = after_write
+        self.waker = Waker()
+        self.running = True
+
+    def run(self):
+        platform = self.capture.platform
+        read_fds = [self.capture.pipe_out_fd]
+        while self.running:
+            limiter = self.capture.limiter
+            # Wake up when the flood limiter's marker is due, to show it.
+            timeout = limiter.time_to_marker() if limiter else None
+            readable = platform.wait_readable(self.waker, read_fds, timeout)
+            self.waker.reset()
+            forwarded = 0
+            if readable:
+                with self.lock:
+                    forwarded = self.capture.forward(self.before_write)
+            if limiter and limiter.time_to_marker() == 0:
+                with self.lock:
+                    forwarded += self.capture.forward_marker(self.before_write)
+            if forwarded and self.after_write:
+                self.after_write()
+
+    def stop(self):
+        self.running = False
+        self.waker.notify()
+        self.join()
+        self.waker.close()
+
 
 class MultiCapture:
     def __init__(self, out_cap, err_cap):
         self.out_cap = out_cap
         self.err_cap = err_cap
+        self.limiter = None
 
     def __enter__(self):
         self.start()
@@ -100,15 +257,51 @@ class MultiCapture:
         self.err_cap.start()
 
     def close(self):
+        # Both forwarders share the limiter, so stop both before either flushes.
+        self.out_cap.stop_forwarding()
+        self.err_cap.stop_forwarding()
         self.out_cap.close()
         self.err_cap.close()
+        if self.limiter:
+            marker = self.limiter.close()
+            if marker:
+                self.out_cap.write(marker)
+
+    def flush(self, before_write=None):
+        return self.out_cap.flush(before_write) + self.err_cap.flush(before_write)
 
-    def flush(self):
-        self.out_cap.flush()
-        self.err_cap.flush()
+    def limit_rate(self, limiter):
+        """
+        Enter flood mode: pass output from both streams through `limiter` (a
+        FloodLimiter) before showing it. Output isn't spliced in this mode.
+        """
+        self.limiter = limiter
+        self.out_cap.limiter = limiter
+        self.err_cap.limiter = limiter
 
     def write_out(self, data):
         self.out_cap.write(data)
 
     def write_err(self, data):
         self.err_cap.write(data)
+
+    def start_forwarding(self, lock, before_write=None, after_write=None):
+        self.out_cap.start_forwarding(lock, before_write, after_write)
+        self.err_cap.start_forwarding(lock, before_write, after_write)
+
+    @property
+    def terminal_fd(self):
+        """Where stdout really goes, even while it's captured."""
+        return self.out_cap.true_fd
+
+    @property
+    def bytes_forwarded(self):
+        return self.out_cap.bytes_forwarded + self.err_cap.bytes_forwarded
+
+    @property
+    def forward_time(self):
+        return self.out_cap.forward_time + self.err_cap.forward_time
+
+    @property
+    def mid_line(self):
+        return self.out_cap.mid_line or self.err_cap.mid_line
@@ -0,0 +1,156 @@
+"""Limits on the rate of captured output, for programs that write floods of it."""
+import math
+import os
+import tempfile
+import time
+
+
+class FloodLimiter:
+    """
+    Limits how much captured output reaches the terminal, so that a program
+    that writes faster than the terminal can keep up doesn't slow itself and
+    the charts down. The pipes are still drained as fast as output arrives.
+
+    Each second, whole lines are shown until `max_lines` or `max_bytes` is
+    reached, and the rest are suppressed. If the previous second went over the
+    limit, lines are sampled evenly instead (every Nth line), so that the output
+    keeps moving. When a second ends, a marker says how many lines were
+    suppressed. Everything, shown or not, is written to a spill file at `path`
+    (a temporary file by default), through a large buffer. A temporary spill
+    file is deleted on close, unless a marker pointed to it.
+    """
+
+    INTERVAL = 1.0
+    SPILL_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, max_lines=None, max_bytes=None, path=None):
+        self.max_lines = max_lines or math.inf
+        self.max_bytes = max_bytes or math.inf
+        if path:
+            self.spill = open(path, "ab", buffering=self.SPILL_BUFFER_SIZE)
+        else:
+            self.spill = tempfile.NamedTemporaryFile(
+                prefix="sparcli-",
+                suffix=".log",
+                buffering=self.SPILL_BUFFER_SIZE,
+                delete=False,
+            )
+        self.path = self.spill.name
+        self.temporary = not path
+        # Whether a marker has pointed to the spill file.
+        self.referenced = False
+        self.window_end = 0.0
+        # Show every `stride`th line in this window.
+        self.stride = 1
+        self.seen_lines = self.seen_bytes = 0
+        self.shown_lines = self.shown_bytes = 0
+        self.suppressed = 0
+        # Whether the last chunk ended part way through a line, and whether
+        # that line is being shown.
+        self.mid_line = False
+        self.passing = True
+
+    def filter(self, data: bytes) -> bytes:
+        """Take a chunk of captured output, and return the part of it to show."""
+        self.spill.write(data)
+        now = time.monotonic()
+        marker = self.roll_over(now) if now >= self.window_end else b""
+        n_lines = data.count(b"\n")
+        self.seen_bytes += len(data)
+        if (
+            self.stride == 1
+            and (self.passing or not self.mid_line)
+            and self.shown_lines + n_lines < self.max_lines
+            and self.shown_bytes + len(data) <= self.max_bytes
+        ):
+            # All of it fits.
+            self.seen_lines += n_lines
+            self.shown_lines += n_lines
+            self.shown_bytes += len(data)
+            self.mid_line = not data.endswith(b"\n")
+            self.passing = True
+            return marker + data
+        return marker + self.sample(data)
+
+    def sample(self, data):
+        shown = []
+        *lines, tail = data.split(b"\n")
+        for line in lines:
+            if not self.mid_line:
+                self.passing = self.admit(line)
+            if self.passing:
+                shown.append(line + b"\n")
+                self.shown_lines += 1
+                self.shown_bytes += len(line) + 1
+            else:
+                self.suppressed += 1
+            self.seen_lines += 1
+            self.mid_line = False
+        if tail:
+            if not self.mid_line:
+                self.passing = self.admit(tail)
+            if self.passing:
+                shown.append(tail)
+                self.shown_bytes += len(tail)
+            self.mid_line = True
+        return b"".join(shown)
+
+    def admit(self, line):
+        """Decide whether to show a line, when it starts."""
+        return (
+            self.seen_lines % self.stride == 0
+            and self.shown_lines < self.max_lines
+            and self.shown_bytes + len(line) < self.max_bytes
+        )
+
+    def roll_over(self, now):
+        """Start a new window, and return the marker for the last one."""
+        if now - self.window_end < self.INTERVAL:
+            # Still flooding: sample at the rate of the last window.
+            ratio = max(
+                self.seen_lines / self.max_lines, self.seen_bytes / self.max_bytes
+            )
+            self.stride = max(1, math.ceil(ratio))
+        else:
+            self.stride = 1
+        self.window_end = now + self.INTERVAL
+        self.seen_lines = self.seen_bytes = 0
+        self.shown_lines = self.shown_bytes = 0
+        return self.marker()
+
+    def time_to_marker(self):
+        """
+        Get the number of seconds until the marker for this window is due, or
+        None if no lines have been suppressed.
+        """
+        if not self.suppressed:
+            return None
+        return max(0.0, self.window_end - time.monotonic())
+
+    def expire(self) -> bytes:
+        """
+        Return the marker for this window if it has ended, so that it's shown
+        even if no more output arrives.
+        """
+        now = time.monotonic()
+        if not self.suppressed or now < self.window_end:
+            return b""
+        return self.roll_over(now)
+
+    def marker(self):
+        if not self.suppressed:
+            return b""
+        # Don't append the marker to a line that's being shown.
+        newline = b"\n" if self.mid_line and self.passing else b""
+        marker = f"[{self.suppressed} lines suppressed; see {self.path}]\n"
+        self.suppressed = 0
+        self.referenced = True
+        return newline + marker.encode()
+
+    def close(self) -> bytes:
+        """Close the spill file, and return a marker for the last window."""
+        self.spill.close()
+        marker = self.marker()
+        if self.temporary and not self.referenced:
+            os.remove(self.path)
+        return marker
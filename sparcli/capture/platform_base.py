@@ -1,4 +1,11 @@
 class Platform:
+    # Whether pipes can be waited on with select.
+    selectable_pipes = False
+    # How often to check pipes that can't be waited on.
+    POLL_INTERVAL = 1 / 30
+    # Whether data can be moved from pipes to other files without copying it.
+    can_splice = False
+
     def set_nonblocking(self, read_fd):
         raise NotImplementedError(
             "Non-blocking capture not impelemented on this platform"
@@ -6,3 +13,23 @@ class Platform:
 
     def apply_workarounds(self):
         pass
+
+    def set_pipe_size(self, write_fd, size):
+        """Ask for a pipe to be able to hold `size` bytes, where that's possible."""
+        pass
+
+    def pending_bytes(self, read_fd):
+        """The number of bytes that can be read from a pipe without blocking."""
+        raise NotImplementedError("Not implemented on this platform")
+
+    def wait_readable(self, waker, read_fds, timeout=None):
+        """
+        Block until the waker is notified, until some of the given pipes may be
+        readable, or until the timeout (in seconds) expires. Returns the pipes to
+        try reading from. Without select, this polls: it waits for a short time,
+        then returns all of them.
+        """
+        if timeout is None or timeout > self.POLL_INTERVAL:
+            timeout = self.POLL_INTERVAL
+        waker.wait(timeout=timeout)
+        return read_fds
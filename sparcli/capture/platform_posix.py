@@ -1,8 +1,32 @@
-from .system import fcntl, os
+import struct
+
+from .system import fcntl, os, sys, termios
 from .platform_base import Platform
 
 
 class PosixPlatform(Platform):
+    selectable_pipes = True
+
+    @property
+    def can_splice(self):
+        return sys.platform.startswith("linux") and os.splice is not None
+
     def set_nonblocking(self, read_fd):
         old_flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
         fcntl.fcntl(read_fd, fcntl.F_SETFL, old_flags | os.O_NONBLOCK)
+
+    def set_pipe_size(self, write_fd, size):
+        if fcntl.F_SETPIPE_SZ is None:
+            return
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            # E.g. more than /proc/sys/fs/pipe-max-size. Keep the default size.
+            pass
+
+    def wait_readable(self, waker, read_fds, timeout=None):
+        return waker.wait(read_fds, timeout)
+
+    def pending_bytes(self, read_fd):
+        result = fcntl.ioctl(read_fd, termios.FIONREAD, bytes(4))
+        return struct.unpack("i", result)[0]
@@ -5,11 +5,12 @@ import sys as sys_
 
 
 if os_.name == "nt":
-    fcntl_ = None
+    fcntl_ = termios_ = None
     import ctypes.wintypes
     import msvcrt as msvcrt_
 else:
     import fcntl as fcntl_
+    import termios as termios_
 
     msvcrt_ = None
 
@@ -24,8 +25,11 @@ class ctypes:
 
 class fcntl:
     fcntl = getattr(fcntl_, "fcntl", None)
+    ioctl = getattr(fcntl_, "ioctl", None)
     F_GETFL = getattr(fcntl_, "F_GETFL", None)
     F_SETFL = getattr(fcntl_, "F_SETFL", None)
+    # Python 3.10+, Linux only.
+    F_SETPIPE_SZ = getattr(fcntl_, "F_SETPIPE_SZ", None)
 
 
 class msvcrt:
@@ -40,6 +44,8 @@ class os:
     name = os_.name
     pipe = os_.pipe
     read = os_.read
+    # Python 3.10+, Linux only.
+    splice = getattr(os_, "splice", None)
     write = os_.write
 
 
@@ -54,5 +60,9 @@ class sys:
         pypy_version_info = sys_.pypy_version_info
 
 
+class termios:
+    FIONREAD = getattr(termios_, "FIONREAD", None)
+
+
 # Hide implementation.
-del ctypes_, fcntl_, msvcrt_, os_, sys_
+del ctypes_, fcntl_, msvcrt_, os_, sys_, termios_
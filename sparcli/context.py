@@ -1,12 +1,67 @@
 from contextlib import AbstractContextManager
+import sys
+import time
+
+import numpy as np
+
+import sparcli.data
+
+
+INF = float("inf")
 
 
 class SparcliContext(AbstractContextManager):
+    """
+    A producer of metrics. If the event queue is full and refuses a record, the
+    record is summarised locally with any others that follow it, until the
+    queue has room for the summary.
+    """
+
     def __init__(self, event_queue):
         self.emit = event_queue.append
+        self.offer = event_queue.offer
+        self.collapsed = {}
 
     def record(self, **variables):
-        self.emit(("data_produced", self, variables))
+        if self.collapsed:
+            self.release_collapsed()
+        if self.collapsed or not self.offer(("data_produced", self, variables)):
+            for name, value in variables.items():
+                self.collapsed_aggregate(name).add(value)
+
+    def record_array(self, name, values):
+        """
+        Record many values of one variable as a single event. `values` may be an
+        array of any shape or an iterable of scalars; it is copied, so the caller
+        is free to reuse it.
+        """
+        if isinstance(values, np.ndarray):
+            values = values.astype(float)
+        else:
+            values = np.fromiter(values, dtype=float)
+        if self.collapsed:
+            self.release_collapsed()
+        if self.collapsed or not self.offer(("array_produced", self, name, values)):
+            self.collapsed_aggregate(name).extend(values.ravel())
+
+    def metric(self, name):
+        """
+        Get a handle for recording values of one variable: `handle(value)`, or
+        `handle.record(value)`. That's cheaper than `record`, because no dict of
+        variables is built for each value.
+        """
+        return Metric(self, name)
+
+    def collapsed_aggregate(self, name):
+        try:
+            return self.collapsed[name]
+        except KeyError:
+            aggregate = self.collapsed[name] = sparcli.data.Aggregate()
+            return aggregate
+
+    def release_collapsed(self):
+        if self.offer(("aggregate_produced", self, self.collapsed)):
+            self.collapsed = {}
 
     def __enter__(self):
         return self
@@ -16,4 +71,187 @@ class SparcliContext(AbstractContextManager):
         self.close()
 
     def close(self):
+        if self.collapsed:
+            # Bypass the bound, so the summary isn't lost.
+            self.emit(("aggregate_produced", self, self.collapsed))
+            self.collapsed = {}
         self.emit(("producer_stopped", self))
+
+
+class AggregatingContext(SparcliContext):
+    """
+    A context that summarises samples locally, and sends the summaries to the
+    controller every `flush_interval` seconds or every `flush_count` records,
+    whichever comes first. Summaries are also sent when the context is closed.
+    Nothing is sent while the producer is idle, so don't hold it open for long
+    between records.
+    """
+
+    def __init__(self, event_queue, flush_interval=None, flush_count=None):
+        super().__init__(event_queue)
+        self.flush_interval = flush_interval if flush_interval else INF
+        self.flush_count = flush_count if flush_count else INF
+        self.aggregates = {}
+        self.n_records = 0
+        self.next_flush = time.monotonic() + self.flush_interval
+
+    def record(self, **variables):
+        for name, value in variables.items():
+            self.aggregate(name).add(value)
+        self.recorded()
+
+    def record_array(self, name, values):
+        self.aggregate(name).extend(np.asarray(values, dtype=float))
+        self.recorded()
+
+    def metric(self, name):
+        return AggregatingMetric(self, name)
+
+    def aggregate(self, name):
+        try:
+            return self.aggregates[name]
+        except KeyError:
+            aggregate = self.aggregates[name] = sparcli.data.Aggregate()
+            return aggregate
+
+    def recorded(self):
+        self.n_records += 1
+        if self.n_records >= self.flush_count or time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        if self.aggregates:
+            if not self.offer(("aggregate_produced", self, self.aggregates)):
+                # The queue is full: keep aggregating, and try again next time.
+                return
+            self.aggregates = {}
+        self.n_records = 0
+        self.next_flush = time.monotonic() + self.flush_interval
+
+    def close(self):
+        if self.aggregates:
+            self.emit(("aggregate_produced", self, self.aggregates))
+            self.aggregates = {}
+        super().close()
+
+
+class NullContext(AbstractContextManager):
+    """A context that discards everything, for when there's nowhere to show it."""
+
+    def record(self, **variables):
+        pass
+
+    def record_array(self, name, values):
+        pass
+
+    def metric(self, name):
+        return NullMetric(self, name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+
+class SampledContext(AbstractContextManager):
+    """
+    Decimates what is recorded in another context (see `sparcli.sampling`).
+    Each call to `record` is kept or skipped as a whole. Each variable's handle
+    and arrays share a sampler of their own. If `emit` is given, the samplers
+    are announced to the controller, which shows the fraction of values kept.
+    """
+
+    def __init__(self, context, make_sampler, emit=None):
+        self.context = context
+        self.make_sampler = make_sampler
+        self.emit = emit
+        self.samplers = {}
+        self.sampler = self.sampler_for(None)
+
+    def sampler_for(self, name):
+        try:
+            return self.samplers[name]
+        except KeyError:
+            sampler = self.samplers[name] = self.make_sampler()
+            if self.emit:
+                self.emit(("sampler_added", self.context, name, sampler))
+            return sampler
+
+    def record(self, **variables):
+        if self.sampler.keep():
+            self.context.record(**variables)
+
+    def record_array(self, name, values):
+        if not isinstance(values, np.ndarray):
+            values = np.fromiter(values, dtype=float)
+        values = values.ravel()
+        indices = self.sampler_for(name).select(len(values))
+        if indices:
+            self.context.record_array(name, values[indices])
+
+    def metric(self, name):
+        return SampledMetric(self.context.metric(name), self.sampler_for(name))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback
+        self.close()
+
+    def close(self):
+        self.context.close()
+
+
+class Metric:
+    """A handle for recording values of one variable in a `SparcliContext`."""
+
+    __slots__ = ("context", "name")
+
+    def __init__(self, context, name):
+        self.context = context
+        # Interned, so the controller's lookups by name are cheap.
+        self.name = sys.intern(name)
+
+    def __call__(self, value):
+        context = self.context
+        if context.collapsed:
+            context.release_collapsed()
+        if context.collapsed or not context.offer(("value_produced", self, value)):
+            context.collapsed_aggregate(self.name).add(value)
+
+    record = __call__
+
+
+class AggregatingMetric(Metric):
+    __slots__ = ()
+
+    def __call__(self, value):
+        context = self.context
+        context.aggregate(self.name).add(value)
+        context.recorded()
+
+    record = __call__
+
+
+class NullMetric(Metric):
+    __slots__ = ()
+
+    def __call__(self, value):
+        pass
+
+    record = __call__
+
+
+class SampledMetric:
+    """A handle that passes on the values that its sampler keeps."""
+
+    __slots__ = ("metric", "sampler")
+
+    def __init__(self, metric, sampler):
+        self.metric = metric
+        self.sampler = sampler
+
+    def __call__(self, value):
+        if self.sampler.keep():
+            self.metric(value)
+
+    record = __call__
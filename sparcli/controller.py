@@ -1,77 +1,410 @@
-from collections import defaultdict, deque
+from collections import defaultdict, OrderedDict
 import threading
 import time
 
+import numpy as np
+
 import sparcli.data
+import sparcli.events
 
 
 class Controller(threading.Thread):
-    def __init__(self, renderer):
+    MAX_BATCH = 10000
+    # How many seconds to keep showing a sampling rate before measuring it again,
+    # so that the labels don't flicker.
+    LABEL_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        renderer,
+        max_fps=30,
+        show_stats=False,
+        max_queue_size=None,
+        overflow="drop_newest",
+        grace_period=1.0,
+    ):
+        if not max_fps > 0:
+            raise ValueError("max_fps must be positive")
         super().__init__(daemon=True)
-        self.event_queue = deque()
+        self.waker = sparcli.events.Waker()
+        self.event_queue = sparcli.events.EventQueue(
+            self.waker, max_queue_size, overflow
+        )
         self.renderer = renderer
         self.variables = defaultdict(lambda: Variable())
+        # The names of the variables that each producer has recorded to.
+        self.producers = defaultdict(set)
+        # Variables that have no producers left, and when to remove them, in
+        # order. A variable that is recorded to again in the meantime is kept.
+        self.expiring = OrderedDict()
+        self.grace_period = grace_period
+        # The samplers that decimate each producer's variables at the source, by
+        # variable name (or None for all of them).
+        self.samplers = defaultdict(dict)
+        # The label of each sampler, and when to measure their rates again.
+        self.rate_labels = {}
+        self.next_labels = 0.0
+        self.pending = {}
+        self.sinks = []
+        self.frame_interval = 1 / max_fps
+        self.next_frame = 0.0
+        self.changed = False
+        self.poll_due = False
+        self.running = True
+        self.stats = Stats()
+        self.show_stats = show_stats
+        self.previous_stats = None
 
     def stop(self):
         self.event_queue.append(("controller_stopped",))
 
     def run(self):
-        self.renderer.start()
-        while True:
-            try:
+        self.renderer.start(wake=self.waker.notify)
+        while self.running:
+            self.wait()
+            self.waker.reset()
+            self.process_events()
+            if self.event_queue:
+                # The batch was cut short; don't block with events still queued.
+                self.waker.notify()
+            if self.needs_redraw and time.monotonic() >= self.next_frame:
+                self.draw()
+        if self.needs_redraw:
+            self.draw()
+        for sink in self.sinks:
+            sink.release()
+        self.renderer.close()
+        self.waker.close()
+
+    def install_signal_handlers(self):
+        self.renderer.install_signal_handlers(self.waker.notify)
+
+    def restore_signal_handlers(self):
+        self.renderer.restore_signal_handlers()
+
+    @property
+    def needs_redraw(self):
+        return self.changed or self.poll_due or self.renderer.needs_redraw
+
+    def wait(self):
+        """
+        Sleep until there is something to do. When idle, that means waiting for an
+        event (including captured output, which the renderer is notified of);
+        otherwise it means waiting for the next frame while still accepting events.
+        """
+        if self.needs_redraw:
+            timeout = max(self.next_frame - time.monotonic(), 0.0)
+            self.waker.wait(timeout=timeout)
+            return
+        poll_interval = self.renderer.poll_interval
+        timeout = poll_interval
+        if self.sinks:
+            # Workers can't wake the controller, so poll their sinks once a frame.
+            timeout = min(self.frame_interval, timeout or self.frame_interval)
+        if self.expiring:
+            expiry = max(self.expiring[next(iter(self.expiring))] - time.monotonic(), 0)
+            timeout = min(expiry, timeout or expiry)
+        self.waker.wait(timeout=timeout)
+        self.poll_due = poll_interval is not None
+
+    def process_events(self):
+        """
+        Drain the event queue (up to MAX_BATCH events) and any shared memory sinks,
+        then ingest the samples in bulk. Returns the number of events that were
+        processed.
+        """
+        start = time.perf_counter()
+        n_events = 0
+        try:
+            while self.running and n_events < self.MAX_BATCH:
                 event = self.event_queue.popleft()
-                topic = event[0]
-                data = event[1:]
-            except IndexError:
-                time.sleep(1 / 30)
-                topic = None
-                data = tuple()
-
-            if topic is None:
-                pass
-            elif topic == "data_produced":
-                self.data_produced(*data)
-            elif topic == "producer_stopped":
-                self.producer_stopped(*data)
-            elif topic == "controller_stopped":
-                self.renderer.close()
-                break
-            else:  # pragma: no-cover
-                raise ValueError(f"Unknown event {topic}")
+                n_events += 1
+                self.dispatch(*event)
+        except IndexError:
+            pass
+        for sink in self.sinks:
+            self.drain_sink(sink)
+        self.ingest()
+        self.garbage_collect()
+        self.stats.events += n_events
+        self.stats.ingest_time += time.perf_counter() - start
+        return n_events
+
+    def dispatch(self, topic, *data):
+        if topic == "value_produced":
+            self.value_produced(*data)
+        elif topic == "data_produced":
+            self.data_produced(*data)
+        elif topic == "array_produced":
+            self.array_produced(*data)
+        elif topic == "aggregate_produced":
+            self.aggregate_produced(*data)
+        elif topic == "producer_stopped":
+            self.ingest()
+            self.producer_stopped(*data)
+        elif topic == "sampler_added":
+            self.sampler_added(*data)
+        elif topic == "sink_added":
+            self.sinks.append(*data)
+            return
+        elif topic == "sink_closed":
+            self.sink_closed(*data)
+        elif topic == "controller_stopped":
+            self.running = False
+            return
+        else:  # pragma: no-cover
+            raise ValueError(f"Unknown event {topic}")
+        self.changed = True
+
+    def draw(self):
+        if self.show_stats:
+            self.record_stats()
+        start = time.perf_counter()
+        changed = self.changed or self.show_stats
+        self.renderer.draw(self.variables, changed, self.labels())
+        self.stats.draw_time += time.perf_counter() - start
+        self.stats.frames += 1
+        self.changed = False
+        self.poll_due = False
+        self.next_frame = time.monotonic() + self.frame_interval
+
+    def labels(self):
+        """
+        Get labels for the variables that are sampled at the source, which say
+        what fraction of their values were kept. Only the sampled producers'
+        variables are visited.
+        """
+        now = time.monotonic()
+        if now >= self.next_labels:
+            self.next_labels = now + self.LABEL_INTERVAL
+            previous = {}
+        else:
+            previous = self.rate_labels
+        # Rebuilt each time, so that stopped producers' samplers are let go.
+        self.rate_labels = rate_labels = {}
+        labels = {}
+        for producer, samplers in self.samplers.items():
+            for name in self.producers.get(producer, ()):
+                sampler = samplers.get(name) or samplers.get(None)
+                if not sampler:
+                    continue
+                label = rate_labels.get(sampler) or previous.get(sampler)
+                if not label:
+                    label = sampler.rate_label
+                rate_labels[sampler] = label
+                labels[name] = f"{name} ({label})"
+        return labels
+
+    def sampler_added(self, producer, name, sampler):
+        self.samplers[producer][name] = sampler
 
-            self.renderer.draw(self.variables)
+    def value_produced(self, metric, value):
+        name = metric.name
+        try:
+            variable, samples = self.pending[name]
+        except KeyError:
+            variable, samples = self.pending[name] = self.variables[name], []
+        producer = metric.context
+        if producer not in variable.references:
+            self.reference(name, variable, producer)
+        samples.append(value)
+        self.stats.samples += 1
 
     def data_produced(self, producer, variables: dict):
         for name, value in variables.items():
+            try:
+                variable, samples = self.pending[name]
+            except KeyError:
+                variable, samples = self.pending[name] = self.variables[name], []
+            if producer not in variable.references:
+                self.reference(name, variable, producer)
+            samples.append(value)
+        self.stats.samples += len(variables)
+
+    def array_produced(self, producer, name, values: np.ndarray):
+        self.variable_in_order(producer, name).extend(values)
+        self.stats.samples += len(values)
+
+    def aggregate_produced(self, producer, aggregates: dict):
+        for name, aggregate in aggregates.items():
+            self.variable_in_order(producer, name).merge(aggregate)
+            self.stats.samples += aggregate.count
+
+    def variable_in_order(self, producer, name):
+        """
+        Get a variable for writing, after ingesting its pending samples so that
+        they stay in order.
+        """
+        variable = self.variables[name]
+        if producer not in variable.references:
+            self.reference(name, variable, producer)
+        _, samples = self.pending.pop(name, (None, None))
+        if samples:
+            variable.extend(np.array(samples, dtype=float))
+        return variable
+
+    def drain_sink(self, sink):
+        for name, values in sink.drain():
+            self.variable_in_order(sink, name).extend(values)
+            self.stats.samples += len(values)
+            self.changed = True
+
+    def sink_closed(self, sink):
+        self.drain_sink(sink)
+        self.sinks.remove(sink)
+        sink.release()
+        self.ingest()
+        self.producer_stopped(sink)
+
+    def ingest(self):
+        """Add pending samples to their series, one batch per variable."""
+        for variable, samples in self.pending.values():
+            variable.extend(np.array(samples, dtype=float))
+        self.pending.clear()
+
+    def get_stats(self):
+        """
+        Get a snapshot of the controller's counters and timings. Times are in
+        seconds; `flush_time` is the time spent forwarding captured output, which
+        happens on another thread.
+        """
+        stats = self.stats
+        elapsed = time.monotonic() - stats.start_time
+        renderer = self.renderer
+        return {
+            "elapsed": elapsed,
+            "queue_depth": len(self.event_queue),
+            "dropped_events": self.event_queue.dropped,
+            "collapsed_events": self.event_queue.collapsed,
+            "events": stats.events,
+            "samples": stats.samples,
+            "frames": stats.frames,
+            "events_per_second": stats.events / elapsed,
+            "samples_per_second": stats.samples / elapsed,
+            "ingest_time": stats.ingest_time,
+            "draw_time": stats.draw_time,
+            "flush_time": renderer.flush_time,
+            "bytes_written": renderer.bytes_written,
+            "bytes_forwarded": renderer.bytes_forwarded,
+            "bytes_per_frame": renderer.bytes_written / max(stats.frames, 1),
+        }
+
+    def record_stats(self):
+        """
+        Add the controller's own metrics to variables of their own, so that they
+        are drawn alongside the user's. Rates and loads (the fraction of time spent
+        on each task) are measured since the previous frame.
+        """
+        current = self.get_stats()
+        previous, self.previous_stats = self.previous_stats, current
+        if previous is None:
+            return
+        elapsed = current["elapsed"] - previous["elapsed"]
+
+        def delta(key):
+            return current[key] - previous[key]
+
+        metrics = {
+            "sparcli.queue_depth": current["queue_depth"],
+            "sparcli.events_per_second": delta("events") / elapsed,
+            "sparcli.samples_per_second": delta("samples") / elapsed,
+            "sparcli.ingest_load": delta("ingest_time") / elapsed,
+            "sparcli.draw_load": delta("draw_time") / elapsed,
+            "sparcli.flush_load": delta("flush_time") / elapsed,
+            "sparcli.bytes_per_frame": delta("bytes_written") / max(delta("frames"), 1),
+        }
+        for name, value in metrics.items():
             variable = self.variables[name]
-            variable.reference(producer)
-            variable.series.add(value)
+            if self not in variable.references:
+                self.reference(name, variable, self)
+            variable.add(value)
+
+    def reference(self, name, variable, producer):
+        variable.reference(producer)
+        self.producers[producer].add(name)
+        self.expiring.pop(name, None)
 
     def producer_stopped(self, producer):
-        for variable in self.variables.values():
+        """
+        Release the variables that the producer recorded to. Those that have no
+        other producers are removed after the grace period, unless they are
+        recorded to again.
+        """
+        self.samplers.pop(producer, None)
+        deadline = time.monotonic() + self.grace_period
+        for name in self.producers.pop(producer, ()):
+            variable = self.variables[name]
             variable.dereference(producer)
+            if not variable.is_live:
+                self.expiring[name] = deadline
         self.garbage_collect()
 
     def garbage_collect(self):
-        self.variables = defaultdict(
-            Variable,
-            {
-                name: variable
-                for name, variable in self.variables.items()
-                if variable.is_live
-            },
-        )
+        """Remove variables whose grace period is over."""
+        if not self.expiring:
+            return
+        now = time.monotonic()
+        removed = {}
+        while self.expiring:
+            name = next(iter(self.expiring))
+            if self.expiring[name] > now:
+                break
+            del self.expiring[name]
+            removed[name] = self.variables.pop(name)
+        if removed:
+            self.renderer.forget(removed)
+            self.changed = True
+
+
+class Stats:
+    __slots__ = (
+        "start_time",
+        "events",
+        "samples",
+        "frames",
+        "ingest_time",
+        "draw_time",
+    )
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.events = 0
+        self.samples = 0
+        self.frames = 0
+        self.ingest_time = 0.0
+        self.draw_time = 0.0
 
 
 class Variable:
+    __slots__ = ("references", "_series", "totals")
+
     def __init__(self):
         self.references = set()
         self._series = sparcli.data.CompactingSeries(300, 1000, 1)
+        # Statistics of every sample, which the series loses as it's compacted.
+        self.totals = sparcli.data.Aggregate()
 
     @property
     def series(self):
         return self._series
 
+    def add(self, value):
+        self._series.add(value)
+        self.totals.add(value)
+
+    def extend(self, values: np.ndarray):
+        values = np.asarray(values, dtype=float)
+        self._series.extend(values)
+        self.totals.extend(values)
+
+    def merge(self, aggregate):
+        self._series.merge(aggregate.mean, aggregate.count, aggregate.finite_count)
+        self.totals.merge(aggregate)
+
+    @property
+    def version(self):
+        return self._series.version
+
     @property
     def is_live(self):
         return len(self.references) > 0
@@ -1,3 +1,5 @@
+from math import isfinite
+
 import numpy as np
 
 
@@ -18,18 +20,69 @@ def normalize(series: np.ndarray) -> np.ndarray:
     return scaled
 
 
-def compact(values: np.ndarray) -> np.ndarray:
-    values = values.copy()
+def compact(values: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Halve the length of a series by averaging pairs of values. If `out` is given,
+    the result is written to it and `values` is used as scratch space; they may
+    overlap.
+    """
+    if out is None:
+        values = values.copy()
+        out = np.empty(values.size // 2)
     odds = values[1::2]
     evens = values[:-1:2]
     nans = ~np.isfinite(odds)
     odds[nans] = evens[nans]
     nans = ~np.isfinite(evens)
     evens[nans] = odds[nans]
-    return np.stack([odds, evens]).mean(axis=0)
+    np.add(odds, evens, out=out)
+    out *= 0.5
+    return out
+
+
+def bucket_means(buckets: np.ndarray) -> np.ndarray:
+    """
+    Calculate the mean of the finite values in each row. Rows that have no finite
+    values have a mean of NaN.
+    """
+    is_finite = np.isfinite(buckets)
+    totals = np.where(is_finite, buckets, 0.0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return totals / is_finite.sum(axis=1)
+
+
+def split(real_size: int, n_values: int, size: int) -> int:
+    """
+    The number of the `real_size` finite samples among `size` that belong to the
+    first `n_values`, assuming they're spread evenly, rounded to a whole number.
+    """
+    return (real_size * n_values * 2 + size) // (size * 2)
 
 
 class CompactingSeries:
+    """
+    A series that keeps a bounded number of values. When it fills up, pairs of
+    values are averaged to make room (up to `max_scale` times); after that the
+    oldest values are dropped.
+
+    The tail is stored in a preallocated ring buffer, so adding values doesn't
+    allocate. Once the series starts dropping values, each value is also written
+    to a mirror after the end of the ring, so that the tail is always a
+    contiguous view.
+    """
+
+    __slots__ = (
+        "max_size",
+        "max_scale",
+        "scale",
+        "scale_exp",
+        "head",
+        "buffer",
+        "start",
+        "size",
+        "version",
+    )
+
     def __init__(self, max_size: int, max_scale: int = 1000, initial_scale: int = 1):
         if max_size < 2 or max_size % 2 != 0:
             raise ValueError("max_size must be a multiple of 2")
@@ -40,52 +93,233 @@ class CompactingSeries:
         self.scale = initial_scale
         self.scale_exp = 1 << (initial_scale - 1)
         self.head = StableBucket()
-        self.tail = np.array([], dtype=np.float32)
+        self.buffer = np.empty(max_size * 2)
+        self.start = 0
+        self.size = 0
+        # Incremented whenever values are added, so that views can be cached.
+        self.version = 0
+
+    @property
+    def tail(self):
+        """The completed buckets, oldest first. This is a view of the buffer."""
+        return self.buffer[self.start : self.start + self.size]
 
     @property
     def values(self):
+        """
+        The values to display. This is a view of internal storage that is only
+        valid until the series is next modified.
+        """
         if self.head.size == 0:
-            return np.copy(self.tail)
-        return np.append(self.tail, self.weighted_head)[-self.max_size + 1 :]
+            return self.tail
+        # The slot after the tail is free, so the head can be shown in place.
+        end = self.start + self.size
+        self.buffer[end] = self.weighted_head
+        return self.buffer[self.start : end + 1][-self.max_size + 1 :]
 
     @property
     def weighted_head(self):
-        values = [self.tail[-1], self.head.mean]
-        weights = [self.scale_exp, self.head.size]
-        return np.average(values, weights=weights)
+        last = self.buffer[self.start + self.size - 1]
+        total = last * self.scale_exp + self.head.mean * self.head.size
+        return total / (self.scale_exp + self.head.size)
 
     def add(self, value):
-        self.head.add(value)
-        if self.head.size < self.scale_exp:
-            return
-        self.tail = np.append(self.tail, self.head.mean)
-        self.head.empty()
-        if self.tail.size < self.max_size:
+        self.version += 1
+        head = self.head
+        # Convert NumPy scalars and 0-d arrays once, rather than in each check.
+        head.add(float(value))
+        if head.size < self.scale_exp:
             return
+        self.append_bucket(head.mean)
+        head.empty()
+
+    def extend(self, values):
+        """Add many values at once. Equivalent to calling `add` for each value."""
+        values = np.asarray(values, dtype=float).ravel()
+        self.version += 1
+        while values.size:
+            if self.head.size:
+                n_values = self.scale_exp - self.head.size
+                self.head.extend(values[:n_values])
+                values = values[n_values:]
+                if self.head.size == self.scale_exp:
+                    self.append_bucket(self.head.mean)
+                    self.head.empty()
+                continue
+            n_buckets = values.size // self.scale_exp
+            if self.scale < self.max_scale:
+                n_buckets = min(n_buckets, self.max_size - self.size)
+            if not n_buckets:
+                self.head.extend(values)
+                break
+            n_values = n_buckets * self.scale_exp
+            buckets = values[:n_values].reshape(n_buckets, self.scale_exp)
+            self.append_buckets(bucket_means(buckets))
+            values = values[n_values:]
+
+    def merge(self, mean: float, size: int, real_size: int):
+        """
+        Add `size` samples that have already been summarised by their `mean`, of
+        which `real_size` were finite. Samples that straddle a bucket boundary are
+        split proportionally, rounding the finite samples to whole ones.
+        """
+        self.version += 1
+        while size:
+            if self.head.size or size < self.scale_exp:
+                n_values = min(size, self.scale_exp - self.head.size)
+                n_real = split(real_size, n_values, size)
+                self.head.merge(mean, n_values, n_real)
+                size -= n_values
+                real_size -= n_real
+                if self.head.size == self.scale_exp:
+                    self.append_bucket(self.head.mean)
+                    self.head.empty()
+                continue
+            n_buckets = size // self.scale_exp
+            if self.scale < self.max_scale:
+                n_buckets = min(n_buckets, self.max_size - self.size)
+            n_values = n_buckets * self.scale_exp
+            bucket_mean = mean if real_size else NAN
+            self.append_buckets(np.full(n_buckets, bucket_mean))
+            real_size -= split(real_size, n_values, size)
+            size -= n_values
+
+    def append_bucket(self, mean):
+        if self.scale < self.max_scale:
+            self.buffer[self.size] = mean
+        else:
+            index = (self.start + self.size) % self.max_size
+            self.buffer[index] = self.buffer[index + self.max_size] = mean
+        self.size += 1
+        if self.size == self.max_size:
+            self.make_room()
+
+    def append_buckets(self, means: np.ndarray):
         if self.scale < self.max_scale:
-            self.tail = compact(self.tail)
+            # Callers never add more than will fit before compaction.
+            self.buffer[self.size : self.size + means.size] = means
+            self.size += means.size
+        else:
+            means = means[-self.max_size + 1 :]
+            end = self.start + self.size
+            indices = np.arange(end, end + means.size) % self.max_size
+            self.buffer[indices] = means
+            self.buffer[indices + self.max_size] = means
+            self.size += means.size
+        if self.size >= self.max_size:
+            self.make_room()
+
+    def make_room(self):
+        if self.scale < self.max_scale:
+            half = self.max_size // 2
+            compact(self.buffer[: self.max_size], out=self.buffer[:half])
+            self.size = half
             self.scale += 1
             self.scale_exp = 1 << (self.scale - 1)
+            if self.scale == self.max_scale:
+                self.buffer[self.max_size : self.max_size + half] = self.buffer[:half]
         else:
-            self.tail = self.tail[1:]
+            n_dropped = self.size - self.max_size + 1
+            self.start = (self.start + n_dropped) % self.max_size
+            self.size -= n_dropped
 
 
 class StableBucket:
+    __slots__ = ("mean", "size", "real_size")
+
     def __init__(self):
-        self.mean = NAN
-        self.size = 0
-        self.real_size = 0
+        self.empty()
 
-    def add(self, value):
+    def add(self, value: float):
+        """Add a scalar. For speed, `value` should be a Python float."""
         self.size += 1
-        if not np.isfinite(value):
-            pass
-        elif not np.isfinite(self.mean):
-            self.real_size += 1
+        if not isfinite(value):
+            return
+        self.real_size += 1
+        if self.real_size == 1:
             self.mean = value
         else:
-            self.real_size += 1
-            self.mean = self.mean + (value - self.mean) / self.real_size
+            self.mean += (value - self.mean) / self.real_size
+
+    def extend(self, values: np.ndarray):
+        finite = values[np.isfinite(values)]
+        self.size += values.size
+        if not finite.size:
+            return
+        self.real_size += finite.size
+        if self.real_size == finite.size:
+            self.mean = float(finite.mean())
+        else:
+            self.mean += float(finite.mean() - self.mean) * finite.size / self.real_size
+
+    def merge(self, mean: float, size: int, real_size: int):
+        self.size += size
+        if not real_size:
+            return
+        self.real_size += real_size
+        if self.real_size == real_size:
+            self.mean = mean
+        else:
+            self.mean += (mean - self.mean) * real_size / self.real_size
 
     def empty(self):
-        self.__init__()
+        self.mean = NAN
+        self.size = 0
+        self.real_size = 0
+
+
+class Aggregate:
+    """
+    Summary statistics of some samples, accumulated by a producer. `latest` is
+    the last finite sample.
+    """
+
+    __slots__ = ("count", "total", "finite_count", "minimum", "maximum", "latest")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.finite_count = 0
+        self.minimum = INF
+        self.maximum = -INF
+        self.latest = NAN
+
+    @property
+    def mean(self):
+        if not self.finite_count:
+            return NAN
+        return self.total / self.finite_count
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        if not isfinite(value):
+            return
+        self.finite_count += 1
+        self.total += value
+        self.latest = value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+    def extend(self, values: np.ndarray):
+        finite = values[np.isfinite(values)]
+        self.count += values.size
+        if not finite.size:
+            return
+        self.finite_count += finite.size
+        self.total += float(finite.sum())
+        self.minimum = min(self.minimum, float(finite.min()))
+        self.maximum = max(self.maximum, float(finite.max()))
+        self.latest = float(finite[-1])
+
+    def merge(self, other: "Aggregate"):
+        """Add the samples summarised by another aggregate."""
+        self.count += other.count
+        self.finite_count += other.finite_count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        if other.finite_count:
+            self.latest = other.latest
@@ -0,0 +1,161 @@
+from collections import deque
+import select
+import socket
+import threading
+
+
+class Waker:
+    """
+    Wakes a thread that is waiting for events. Notifying never blocks, and only
+    writes to the socket on the first notification after a reset.
+    """
+
+    def __init__(self):
+        self.receiver, self.sender = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.sender.setblocking(False)
+        self.pending = False
+
+    def notify(self):
+        if self.pending:
+            return
+        self.pending = True
+        try:
+            self.sender.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def wait(self, filenos=(), timeout=None):
+        """
+        Block until notified, until one of the given file descriptors is readable,
+        or until the timeout expires. Returns the readable file descriptors.
+        """
+        readable, _, _ = select.select([self.receiver, *filenos], [], [], timeout)
+        return [fileno for fileno in readable if fileno is not self.receiver]
+
+    def reset(self):
+        # Drain the socket before clearing the flag, so that a notification that
+        # arrives in between is never lost.
+        try:
+            while self.receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.pending = False
+
+    def close(self):
+        # Stay pending, so that late notifications don't write to closed sockets.
+        self.pending = True
+        self.receiver.close()
+        self.sender.close()
+
+
+class NullWaker:
+    """A waker for a queue that nobody consumes."""
+
+    def notify(self):
+        pass
+
+
+class EventQueue:
+    """
+    A non-blocking queue that wakes the consumer when events are added.
+
+    Data events are offered with `offer`, which respects `max_size` (if given)
+    according to the `overflow` policy:
+
+    - drop_newest: discard the offered event.
+    - drop_oldest: discard the oldest queued data event to make room.
+    - collapse: refuse the event, so that the producer can fold it into an
+      aggregate and offer that later.
+
+    Control events are added with `append`, and are never dropped or refused.
+    """
+
+    POLICIES = ("drop_newest", "drop_oldest", "collapse")
+
+    def __init__(self, waker, max_size=None, overflow="drop_newest"):
+        if overflow not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if max_size is not None and not max_size > 0:
+            raise ValueError("max_size must be positive")
+        self.events = deque()
+        self.waker = waker
+        self.max_size = max_size if max_size else float("inf")
+        self.overflow = overflow
+        self.dropped = 0
+        self.collapsed = 0
+        # Dropping the oldest event takes several steps, which mustn't interleave
+        # with other producers or the consumer, so every change to the queue takes
+        # the lock. It's only held for constant time (unless control events are
+        # at the front of the queue), so producers never wait for long.
+        self.lock = threading.Lock() if overflow == "drop_oldest" else None
+
+    def __len__(self):
+        return len(self.events)
+
+    def append(self, event):
+        if self.lock is None:
+            self.events.append(event)
+        else:
+            with self.lock:
+                self.events.append(event)
+        self.waker.notify()
+
+    def offer(self, event):
+        """
+        Add a data event, unless the queue is full. Returns False if the event
+        was refused and should be collapsed by the producer; dropped events count
+        as accepted.
+        """
+        if len(self.events) < self.max_size:
+            self.append(event)
+            return True
+        if self.overflow == "collapse":
+            self.collapsed += 1
+            return False
+        if self.overflow == "drop_newest":
+            self.dropped += 1
+            return True
+        with self.lock:
+            self.drop_oldest()
+            self.events.append(event)
+        self.waker.notify()
+        return True
+
+    def detach(self):
+        """
+        Discard all events from now on, e.g. in a forked child process, where
+        the consumer doesn't exist. Producers that still refer to the queue can
+        carry on at no cost.
+        """
+        self.events = deque(maxlen=0)
+        self.waker.close()
+        self.waker = NullWaker()
+        if self.lock:
+            # It may have been held by another thread at the time of the fork.
+            self.lock = threading.Lock()
+
+    def drop_oldest(self):
+        """Drop the oldest data event. Called with the lock."""
+        events = self.events
+        skipped = []
+        while events:
+            event = events.popleft()
+            if event[0] in DATA_EVENTS:
+                self.dropped += 1
+                break
+            skipped.append(event)
+        # Put back the control events that were in front of it, in order.
+        events.extendleft(reversed(skipped))
+
+    def popleft(self):
+        if self.lock is None:
+            return self.events.popleft()
+        with self.lock:
+            return self.events.popleft()
+
+
+DATA_EVENTS = frozenset(
+    ("value_produced", "data_produced", "array_produced", "aggregate_produced")
+)
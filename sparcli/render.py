@@ -1,4 +1,9 @@
+import heapq
+import os
 import shutil
+import signal
+import threading
+import time
 
 import numpy as np
 
@@ -38,36 +43,529 @@ def resample(series: np.ndarray, width: int) -> np.ndarray:
 CSI = "\x1b["
 # Terminal output sequences
 # https://en.wikipedia.org/wiki/ANSI_escape_code#Terminal_output_sequences
-CURSOR_UP = f"{CSI}1A"
-CLEAR_LINE = f"{CSI}2K"
+CLEAR_TO_END_OF_LINE = f"{CSI}K"
+CLEAR_TO_END_OF_SCREEN = f"{CSI}J"
+RESET_ATTRIBUTES = f"{CSI}0m"
+RESET_SCROLL_REGION = f"{CSI}r"
+# Move down a line, scrolling if at the bottom, without changing column (IND).
+INDEX = "\x1bD"
+# Save and restore the cursor's position and attributes (DECSC and DECRC).
+SAVE_CURSOR = "\x1b7"
+RESTORE_CURSOR = "\x1b8"
+
+
+def cursor_up(n: int) -> str:
+    return f"{CSI}{n}A" if n else ""
+
+
+def cursor_down(n: int) -> str:
+    return f"{CSI}{n}B" if n else ""
+
+
+def cursor_to_column(column: int) -> str:
+    return f"{CSI}{column + 1}G"
+
+
+def cursor_to_row(row: int) -> str:
+    return f"{CSI}{row + 1};1H"
+
+
+def set_scroll_region(top: int, bottom: int) -> str:
+    """Limit scrolling to rows `top` (inclusive) to `bottom` (exclusive). DECSTBM."""
+    return f"{CSI}{top + 1};{bottom}r"
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    return next(
+        (i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b))
+    )
+
+
+def diff_row(old: str, new: str) -> str:
+    """Rewrite the part of the row that changed, assuming one column per character."""
+    start = common_prefix_length(old, new)
+    if len(old) != len(new):
+        return f"{cursor_to_column(start)}{new[start:]}{CLEAR_TO_END_OF_LINE}"
+    end = len(new) - common_prefix_length(old[::-1], new[::-1])
+    return f"{cursor_to_column(start)}{new[start:end]}"
+
+
+def wrapped_height(rows: list, columns: int) -> int:
+    """
+    The number of lines that rows take up in a terminal `columns` wide. Rows that
+    are wider than that (because the terminal was made narrower after they were
+    drawn) are rewrapped onto more lines.
+    """
+    return sum(max(1, -(-len(row) // columns)) for row in rows)
+
+
+def diff_rows(old: list, new: list) -> str:
+    """
+    Compute the output that turns the `old` rows into the `new` rows. The cursor
+    is assumed to be at the start of the line below the old rows, and is left at
+    the start of the line below the new rows. An empty string means that nothing
+    changed.
+    """
+    out = []
+    row = len(old)
+
+    def move_to(target):
+        nonlocal row
+        if target < row:
+            out.append(cursor_up(row - target))
+        else:
+            out.append(cursor_down(target - row))
+        row = target
+
+    for i, (old_row, new_row) in enumerate(zip(old, new)):
+        if old_row != new_row:
+            move_to(i)
+            out.append(diff_row(old_row, new_row))
+
+    if len(new) > len(old):
+        move_to(len(old))
+        out.append("\r")
+        out.extend(f"{new_row}\n" for new_row in new[len(old) :])
+    elif len(new) < len(old):
+        move_to(len(new))
+        out.append(f"\r{CLEAR_TO_END_OF_SCREEN}")
+    elif out:
+        move_to(len(new))
+        out.append("\r")
+    return "".join(out)
+
+
+class TerminalGeometry:
+    """
+    The size of the terminal. It's refreshed when the terminal is resized, if the
+    SIGWINCH handler could be installed; otherwise it's polled every
+    POLL_INTERVAL seconds. It's queried through `fd`, because stdout itself is
+    usually a capture pipe; without one (or a terminal on the other end), it
+    falls back to `shutil.get_terminal_size`.
+    """
+
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, fd=None):
+        self.fd = fd
+        self.size = None
+        self.stale = True
+        self.next_poll = 0.0
+        self.on_resize = None
+        self.previous_handler = None
+        self.handling_signal = False
+
+    @property
+    def columns(self):
+        return self.size.columns
+
+    @property
+    def lines(self):
+        return self.size.lines
+
+    @property
+    def poll_interval(self):
+        return None if self.handling_signal else self.POLL_INTERVAL
+
+    def install(self, on_resize=None):
+        """
+        Listen for SIGWINCH. Signal handlers can only be installed from the main
+        thread, so this does nothing elsewhere (or on platforms without SIGWINCH).
+        """
+        if not hasattr(signal, "SIGWINCH"):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self.on_resize = on_resize
+        self.previous_handler = signal.signal(signal.SIGWINCH, self.handle_signal)
+        self.handling_signal = True
+
+    def uninstall(self):
+        if not self.handling_signal:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if signal.getsignal(signal.SIGWINCH) == self.handle_signal:
+            signal.signal(signal.SIGWINCH, self.previous_handler or signal.SIG_DFL)
+        self.handling_signal = False
+
+    def handle_signal(self, signum, frame):
+        self.stale = True
+        if self.on_resize:
+            self.on_resize()
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+
+    def refresh(self):
+        """Update the size if it may have changed. Returns True if it did."""
+        now = time.monotonic()
+        if not (self.stale or (not self.handling_signal and now >= self.next_poll)):
+            return False
+        self.stale = False
+        self.next_poll = now + self.POLL_INTERVAL
+        size = self.query()
+        resized = size != self.size
+        self.size = size
+        return resized
+
+    def query(self):
+        if self.fd is not None:
+            try:
+                size = os.get_terminal_size(self.fd)
+            except (OSError, ValueError):
+                pass
+            else:
+                # Some terminals don't know their size, and say it's 0x0.
+                if size.columns > 0 and size.lines > 0:
+                    return size
+        return shutil.get_terminal_size()
 
 
 class Renderer:
-    def __init__(self, write, capture):
-        self.height = 0
+    """
+    Draws a row of bars for each variable at the bottom of the terminal. Captured
+    output is forwarded on another thread: it erases the rows first, and they
+    are redrawn on the next frame. `lock` keeps the two from interleaving. After
+    a partial line of output, the rows are held back for a moment in case the
+    rest of the line follows.
+
+    If there are more variables than fit in the terminal, the last row says how
+    many were left out, and the others aren't rendered at all. `priority` picks
+    the variables to show: the first ones (None), those that changed most
+    recently ("recent"), or those with the highest "variance". They are shown
+    in their usual order either way. Ties (e.g. between variables that changed
+    in the same frame) go to the variables that are already shown, so that rows
+    don't swap back and forth.
+    """
+
+    PRIORITIES = (None, "recent", "variance")
+    # How many seconds to wait for the rest of a partial line of output before
+    # drawing the rows below it anyway.
+    MID_LINE_TIMEOUT = 0.5
+    # How many seconds to keep a variable's variance after it changes, before
+    # reading its whole series again to rescore it.
+    RESCORE_INTERVAL = 1.0
+
+    def __init__(self, write, capture, priority=None):
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"Unknown row priority: {priority}")
+        self.rows = []
+        self.geometry = TerminalGeometry()
+        # Rendered bars of each variable, with the version and width they were
+        # rendered at.
+        self.cache = {}
+        self.priority = priority
+        # The priority of each variable, with the version and time it was scored
+        # at, and the names of the variables that were chosen last time.
+        self.scores = {}
+        self.shown = set()
         self.capture = capture
         self.write = write
+        self.lock = threading.Lock()
+        self.erased = False
+        # When captured output was last forwarded, and whether a newline was
+        # written after it because it ended part way through a line.
+        self.output_time = 0.0
+        self.line_broken = False
+        self.bytes_written = 0
+
+    @property
+    def height(self):
+        return len(self.rows)
 
-    def start(self):
+    @property
+    def flush_time(self):
+        return self.capture.forward_time
+
+    @property
+    def bytes_forwarded(self):
+        return self.capture.bytes_forwarded
+
+    def start(self, wake=None):
         self.capture.start()
+        self.geometry.fd = self.capture.terminal_fd
+        self.capture.start_forwarding(
+            self.lock, before_write=self.erase, after_write=wake
+        )
 
     def close(self):
         self.capture.close()
 
-    def draw(self, variables):
-        self.clear()
-        self.capture.flush()
-        viewport_size = shutil.get_terminal_size()
+    @property
+    def poll_interval(self):
+        return self.geometry.poll_interval
+
+    @property
+    def needs_redraw(self):
+        return self.geometry.stale or self.erased
+
+    def install_signal_handlers(self, wake):
+        self.geometry.install(on_resize=wake)
+
+    def restore_signal_handlers(self):
+        self.geometry.uninstall()
+
+    def forget(self, variables):
+        # Removed variables' rows disappear on the next draw.
+        pass
+
+    def draw(self, variables, changed=True, labels=None):
+        """
+        Draw the variables. `labels` are shown instead of the names of some of
+        them.
+        """
+        resized = self.geometry.refresh()
+        if not (changed or resized or self.erased):
+            return
+        variables, n_hidden = self.viewport(variables)
+        if labels:
+            variables = {
+                labels.get(name, name): variable for name, variable in variables.items()
+            }
         name_width = max((len(name) for name in variables), default=0)
-        chart_width = viewport_size.columns - name_width - 1
+        # Leave the last column empty, so that rows never fill the line. Some
+        # terminals join full lines with the next one when they're resized.
+        chart_width = self.geometry.columns - name_width - 2
+        rows = []
+        cache = {}
+        for name, variable in variables.items():
+            key = (variable.version, chart_width)
+            cached_key, bars = self.cache.get(variable, (None, None))
+            if cached_key != key:
+                values = sparcli.data.normalize(variable.series.values)
+                values = resample(values, chart_width)
+                bars = render_as_vertical_bars(values)
+            cache[variable] = key, bars
+            rows.append(f"{name.rjust(name_width)} {bars}")
+        if n_hidden:
+            rows.append(f"+{n_hidden} more")
+        self.cache = cache
+        with self.lock:
+            self.erased = False
+            self.update(rows, resized)
+
+    def viewport(self, variables):
+        """
+        Choose the variables to draw, leaving a line for output below the rows.
+        Returns them in their original order, and the number left out.
+        """
+        n_rows = max(self.geometry.lines - 1, 0)
+        if len(variables) <= n_rows:
+            self.scores = {}
+            self.shown = set()
+            return variables, 0
+        # Make room for the row that says how many were left out.
+        n_shown = max(n_rows - 1, 0)
+        names = list(variables)
+        if self.priority:
+            scores = self.score(variables)
+            shown = self.shown
+            chosen = set(
+                heapq.nlargest(
+                    n_shown, names, key=lambda name: (scores[name], name in shown)
+                )
+            )
+            names = [name for name in names if name in chosen]
+            self.shown = chosen
+        shown = {name: variables[name] for name in names[:n_shown]}
+        return shown, (len(variables) - n_shown if n_rows else 0)
+
+    def score(self, variables):
+        """
+        Score the variables by priority. Only changed variables are rescored, and
+        for "variance", each at most once per RESCORE_INTERVAL.
+        """
+        now = time.monotonic()
+        scores = {}
+        cache = {}
         for name, variable in variables.items():
-            values = sparcli.data.normalize(variable.series.values)
-            values = resample(values, chart_width)
-            name = name.rjust(name_width)
-            bars = render_as_vertical_bars(values)
-            self.write(f"{name} {bars}\n")
-        self.height = len(variables)
+            version = variable.version
+            cached_version, score, scored_at = self.scores.get(
+                variable, (None, None, None)
+            )
+            if cached_version != version:
+                if self.priority == "recent":
+                    score, scored_at = now, now
+                elif scored_at is None or now - scored_at >= self.RESCORE_INTERVAL:
+                    values = variable.series.values
+                    finite = values[np.isfinite(values)]
+                    score = finite.var() if len(finite) else -np.inf
+                    scored_at = now
+                else:
+                    # Rescore it once the interval is up, even if it doesn't
+                    # change again.
+                    version = cached_version
+            cache[variable] = version, score, scored_at
+            scores[name] = score
+        self.scores = cache
+        return scores
+
+    def update(self, rows, resized):
+        """Replace the rows on the screen. Called with the lock."""
+        if resized:
+            # Lines may have been reflowed, so redraw everything.
+            self.clear()
+        if self.capture.mid_line and not self.line_broken:
+            if time.monotonic() < self.output_time + self.MID_LINE_TIMEOUT:
+                # Don't draw after a partial line of output while the rest of it
+                # may follow. Try again on the next frame.
+                self.erased = True
+                return
+            # No more has come (e.g. it's a prompt), so draw below it.
+            self.output("\n")
+            self.line_broken = True
+        output = diff_rows(self.rows, rows)
+        if output:
+            self.output(output)
+        self.rows = rows
+
+    def erase(self):
+        """Make way for captured output. Called by the forwarder, with the lock."""
+        self.clear()
+        self.erased = True
+        self.output_time = time.monotonic()
+        self.line_broken = False
 
     def clear(self):
-        self.write(f"{CURSOR_UP}{CLEAR_LINE}" * self.height)
-        self.height = 0
+        if self.rows:
+            height = wrapped_height(self.rows, self.geometry.columns)
+            self.output(f"{cursor_up(height)}\r{CLEAR_TO_END_OF_SCREEN}")
+        self.rows = []
+
+    def output(self, data):
+        self.bytes_written += len(data.encode("utf8"))
+        self.write(data)
+
+
+class ScrollRegionRenderer(Renderer):
+    """
+    Draws the rows in lines reserved at the bottom of the terminal, and sets a
+    scroll region (DECSTBM) above them. Captured output scrolls within the
+    region, so the rows don't have to be erased and redrawn around it; the
+    cursor is saved and restored around each frame instead, so frames can be
+    drawn at any time, even after a partial line. Rows that don't fit are cut
+    off, leaving at least one line for output.
+    """
+
+    def start(self, wake=None):
+        self.capture.start()
+        self.geometry.fd = self.capture.terminal_fd
+        self.capture.start_forwarding(self.lock)
+
+    def close(self):
+        self.capture.close()
+        # Leave the last frame below the output, like the plain renderer does.
+        if self.rows:
+            newline = "\n" if self.capture.mid_line else ""
+            rows = "".join(f"{row}\n" for row in self.rows)
+            self.output(f"{self.release()}{newline}\r{rows}")
+            self.rows = []
+
+    def update(self, rows, resized):
+        lines = self.geometry.lines
+        rows = rows[: max(lines - 1, 0)]
+        old_rows = self.rows
+        out = []
+        if resized or len(rows) != len(old_rows):
+            out.append(self.release())
+            out.append(self.reserve(len(rows), lines))
+            old_rows = [""] * len(rows)
+        top = lines - len(rows)
+        changes = [
+            f"{cursor_to_row(top + i)}{diff_row(old_row, new_row)}"
+            for i, (old_row, new_row) in enumerate(zip(old_rows, rows))
+            if old_row != new_row
+        ]
+        if changes:
+            out.extend([SAVE_CURSOR, RESET_ATTRIBUTES, *changes, RESTORE_CURSOR])
+        output = "".join(out)
+        if output:
+            self.output(output)
+        self.rows = rows
+
+    def reserve(self, n_rows, lines):
+        """
+        Make room for `n_rows` at the bottom by scrolling the output up (if the
+        cursor is near the bottom), and keep the output above them.
+        """
+        if not n_rows:
+            return ""
+        return (
+            f"{INDEX * n_rows}{cursor_up(n_rows)}"
+            f"{SAVE_CURSOR}{set_scroll_region(0, lines - n_rows)}{RESTORE_CURSOR}"
+        )
+
+    def release(self):
+        """
+        Remove the scroll region and clear the reserved lines. The cursor is at
+        the end of the output, so everything after it belongs to the rows.
+        """
+        if not self.rows:
+            return ""
+        return (
+            f"{SAVE_CURSOR}{RESET_SCROLL_REGION}{RESTORE_CURSOR}"
+            f"{CLEAR_TO_END_OF_SCREEN}"
+        )
+
+
+class SummaryRenderer:
+    """
+    Writes a line of plain text for each variable, for output that isn't a
+    terminal. The controller decides how often to draw.
+    """
+
+    flush_time = 0.0
+    bytes_forwarded = 0
+    poll_interval = None
+    needs_redraw = False
+
+    def __init__(self, write):
+        self.write = write
+        self.bytes_written = 0
+        # Variables that were removed since the last summary.
+        self.forgotten = {}
+
+    def start(self, wake=None):
+        pass
+
+    def close(self):
+        pass
+
+    def install_signal_handlers(self, wake):
+        pass
+
+    def restore_signal_handlers(self):
+        pass
+
+    def forget(self, variables):
+        """Keep removed variables until their final values have been summarised."""
+        self.forgotten.update(variables)
+
+    def draw(self, variables, changed=True, labels=None):
+        if not changed:
+            return
+        variables = {**self.forgotten, **variables}
+        self.forgotten = {}
+        labels = labels or {}
+        lines = [
+            summarize(labels.get(name, name), variable)
+            for name, variable in variables.items()
+        ]
+        if lines:
+            output = "".join(f"{line}\n" for line in lines)
+            self.bytes_written += len(output.encode("utf8"))
+            self.write(output)
+
+
+def summarize(name: str, variable) -> str:
+    """
+    Describe a variable in one line: its latest value, and the statistics of every
+    sample recorded to it (not just those that are still in its series).
+    """
+    totals = variable.totals
+    if not totals.finite_count:
+        return f"{name}: no data"
+    return (
+        f"{name}: {totals.latest:.6g} (mean {totals.mean:.6g}, "
+        f"min {totals.minimum:.6g}, max {totals.maximum:.6g})"
+    )
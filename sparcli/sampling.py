@@ -0,0 +1,184 @@
+"""
+Decimation of metrics where they are recorded. A sampler decides which of the
+values offered to it are kept. Between decisions, skipping a value only costs
+decrementing a counter, so that recording from very tight loops stays cheap.
+"""
+import functools
+import math
+import random
+import time
+
+
+class Sampler:
+    """
+    Decides about one value out of every `stride`, and skips the rest. Subclasses
+    choose whether to keep the value, and the stride until the next decision.
+    """
+
+    __slots__ = ("stride", "countdown", "offered", "kept")
+
+    # How many values must be kept before the measured rate means much.
+    MIN_KEPT = 10
+
+    def __init__(self, stride=1):
+        self.stride = self.countdown = stride
+        # The number of values offered before the current stride.
+        self.offered = 0
+        self.kept = 0
+
+    def keep(self):
+        """Offer a value, and return whether to keep it."""
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
+        self.offered += self.stride
+        kept = self.decide()
+        self.kept += kept
+        self.countdown = self.stride
+        return kept
+
+    def select(self, n):
+        """Offer `n` values at once, and return the indices of those to keep."""
+        indices = []
+        start = 0
+        while start + self.countdown <= n:
+            start += self.countdown
+            self.countdown = 1
+            if self.keep():
+                indices.append(start - 1)
+        self.countdown -= n - start
+        return indices
+
+    def decide(self):
+        raise NotImplementedError
+
+    @property
+    def label(self):
+        """A short description of the policy, for display."""
+        raise NotImplementedError
+
+    @property
+    def seen(self):
+        return self.offered + self.stride - self.countdown
+
+    @property
+    def rate(self):
+        """The fraction of the values offered so far that were kept."""
+        seen = self.seen
+        return self.kept / seen if seen else 1.0
+
+    @property
+    def rate_label(self):
+        """
+        The fraction of the values that were kept, for display, e.g. "1/98". Until
+        a few have been kept, the policy is shown instead.
+        """
+        if self.kept < self.MIN_KEPT:
+            return self.label
+        return f"1/{self.seen / self.kept:.3g}"
+
+
+class EveryNth(Sampler):
+    """Keeps the first value, and every `n`th after it."""
+
+    __slots__ = ("n",)
+
+    def __init__(self, n):
+        if not (isinstance(n, int) and n >= 1):
+            raise ValueError("every must be a positive integer")
+        super().__init__()
+        self.n = n
+
+    def decide(self):
+        self.stride = self.n
+        return True
+
+    @property
+    def label(self):
+        return f"1/{self.n}"
+
+
+class Interval(Sampler):
+    """
+    Keeps at most one value per `interval` seconds. The clock is only checked
+    when a decision is due: the stride is chosen from the rate at which values
+    were offered since the last check, so that the next check lands around the
+    time that a value may be kept.
+    """
+
+    __slots__ = ("interval", "checked", "next_time")
+
+    def __init__(self, interval):
+        if not interval > 0:
+            raise ValueError("interval must be positive")
+        super().__init__()
+        self.interval = interval
+        self.checked = time.monotonic()
+        self.next_time = 0.0
+
+    def decide(self):
+        now = time.monotonic()
+        per_second = self.stride / max(now - self.checked, 1e-9)
+        self.checked = now
+        kept = now >= self.next_time
+        if kept:
+            self.next_time = now + self.interval
+        # Grow the stride gradually, in case the values come in bursts.
+        stride = int(per_second * (self.next_time - now))
+        self.stride = max(1, min(stride, 2 * self.stride))
+        return kept
+
+    @property
+    def label(self):
+        return f"1 per {self.interval:g}s"
+
+
+class Fraction(Sampler):
+    """
+    Keeps each value with probability `fraction`, independently. The gaps
+    between kept values are drawn from a geometric distribution, so no random
+    number is needed for the values in between.
+    """
+
+    __slots__ = ("fraction", "log_complement")
+
+    def __init__(self, fraction):
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be in (0, 1]")
+        self.fraction = fraction
+        self.log_complement = math.log1p(-fraction) if fraction < 1 else -math.inf
+        super().__init__(self.gap())
+
+    def gap(self):
+        return 1 + int(math.log(1.0 - random.random()) / self.log_complement)
+
+    def decide(self):
+        self.stride = self.gap()
+        return True
+
+    @property
+    def label(self):
+        return f"1/{1 / self.fraction:.3g}"
+
+
+def policy(every=None, interval=None, fraction=None):
+    """
+    Get a function that makes samplers for one of the options, or None if none is
+    given. `every` keeps every Nth value, `interval` at most one value per that
+    many seconds, and `fraction` a random fraction of values.
+    """
+    options = {"every": every, "interval": interval, "fraction": fraction}
+    given = [name for name, value in options.items() if value is not None]
+    if len(given) > 1:
+        raise ValueError(f"Only one sampling option may be given: {', '.join(given)}")
+    if every is not None:
+        make_sampler = functools.partial(EveryNth, every)
+    elif interval is not None:
+        make_sampler = functools.partial(Interval, interval)
+    elif fraction is not None:
+        make_sampler = functools.partial(Fraction, fraction)
+    else:
+        return None
+    # Check the option now, rather than when the first sampler is made.
+    make_sampler()
+    return make_sampler
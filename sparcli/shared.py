@@ -0,0 +1,347 @@
+"""
+Recording metrics from other processes. Workers write samples into ring buffers
+in shared memory, which the controller drains in bulk, so nothing is pickled per
+sample.
+"""
+from contextlib import AbstractContextManager
+import multiprocessing
+import multiprocessing.util
+import os
+import platform
+
+import numpy as np
+
+import sparcli.context
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no-cover (Python < 3.8)
+    shared_memory = None
+
+
+# Fields of each slot's header. OWNER is the pid of the process using the slot,
+# or 0 if it's free.
+HEAD, TAIL, N_NAMES, DROPPED, OWNER = range(5)
+HEADER_SIZE = 5
+
+RECORD = np.dtype([("name", "<u4"), ("value", "<f8")])
+
+# Whether the CPU makes stores visible to other processes in the order they were
+# made, and doesn't reorder loads; x86 does. On other CPUs (e.g. ARM), the head
+# and tail of each ring are published under a lock, whose release and acquire
+# order the records' reads and writes around them.
+ORDERED = platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86")
+
+
+class SharedSink(AbstractContextManager):
+    """
+    A block of shared memory with one slot for each worker process. Each slot
+    has a table of variable names and a single-producer, single-consumer ring
+    buffer of (name, value) records. The ring's head is only written by the
+    worker and its tail only by the controller, so no locks are needed; if the
+    ring is full, samples are dropped and counted. A slot is released when its
+    worker exits, or reused if its worker died, so pools whose workers are
+    restarted don't run out of slots. A slot keeps its table of names when it's
+    reused.
+
+    Create the sink in the parent process, and pass it to workers when they are
+    created (e.g. as an argument of a process pool's initializer). If `merge` is
+    False, each worker's variables are shown separately, labelled with the
+    worker's slot. `mp_context` is the multiprocessing context that the workers
+    are started with, if not the default.
+    """
+
+    MAX_NAMES = 256
+    NAME_SIZE = 64
+
+    def __init__(self, n_slots, capacity=2 ** 16, merge=True, mp_context=None):
+        if shared_memory is None:  # pragma: no-cover
+            raise NotImplementedError("Shared memory requires Python 3.8+")
+        self.n_slots = n_slots
+        self.capacity = capacity
+        self.merge = merge
+        self.memory = shared_memory.SharedMemory(create=True, size=self.size)
+        mp_context = mp_context or multiprocessing
+        self.lock = mp_context.Lock()
+        self.slot_locks = (
+            None if ORDERED else [mp_context.Lock() for _ in range(n_slots)]
+        )
+        self.emit = None
+        self.map()
+        self.counter[:] = 0
+        self.headers[:] = 0
+
+    @property
+    def size(self):
+        slot_size = (
+            8 * HEADER_SIZE
+            + self.MAX_NAMES * self.NAME_SIZE
+            + self.capacity * RECORD.itemsize
+        )
+        return 8 + self.n_slots * slot_size
+
+    def map(self):
+        """Create views of the shared memory."""
+        buffer = self.memory.buf
+        offset = 0
+
+        def view(dtype, shape):
+            nonlocal offset
+            array = np.ndarray(shape, dtype, buffer, offset)
+            offset += array.nbytes
+            return array
+
+        self.counter = view(np.int64, (1,))
+        self.headers = view(np.int64, (self.n_slots, HEADER_SIZE))
+        self.names = view(np.uint8, (self.n_slots, self.MAX_NAMES, self.NAME_SIZE))
+        self.records = view(RECORD, (self.n_slots, self.capacity))
+        self.slot_names = [[] for _ in range(self.n_slots)]
+
+    def __getstate__(self):
+        return {
+            "name": self.memory.name,
+            "n_slots": self.n_slots,
+            "capacity": self.capacity,
+            "merge": self.merge,
+            "lock": self.lock,
+            "slot_locks": self.slot_locks,
+        }
+
+    def __setstate__(self, state):
+        self.memory = shared_memory.SharedMemory(name=state.pop("name"))
+        self.__dict__.update(state)
+        self.emit = None
+        self.map()
+
+    def claim_slot(self):
+        """
+        Claim a slot for this process, and return a context that writes to it.
+        The slot is released when the process exits.
+        """
+        pid = os.getpid()
+        with self.lock:
+            owners = self.headers[:, OWNER]
+            slot = next(
+                (
+                    slot
+                    for slot in range(self.n_slots)
+                    if not owners[slot] or not process_exists(int(owners[slot]))
+                ),
+                None,
+            )
+            if slot is None:
+                raise RuntimeError(f"All {self.n_slots} worker slots are in use")
+            owners[slot] = pid
+            # The number of slots that have ever been used, which need draining.
+            self.counter[0] = max(int(self.counter[0]), slot + 1)
+        # Unlike atexit handlers, this runs in multiprocessing's workers too.
+        multiprocessing.util.Finalize(
+            None, self.release_slot, args=(slot, pid), exitpriority=0
+        )
+        return SharedContext(self, slot)
+
+    def release_slot(self, slot, pid):
+        if self.headers is None or self.memory.buf is None:
+            # Released, or unmapped.
+            return
+        with self.lock:
+            if self.headers[slot, OWNER] == pid:
+                self.headers[slot, OWNER] = 0
+
+    def drain(self):
+        """
+        Take the samples that workers have written since the last drain. Yields
+        the name and values of each variable in each slot, in order.
+        """
+        for slot in range(min(int(self.counter[0]), self.n_slots)):
+            header = self.headers[slot]
+            lock = self.slot_locks[slot] if self.slot_locks else None
+            if lock:
+                with lock:
+                    head = int(header[HEAD])
+            else:
+                head = int(header[HEAD])
+            tail = int(header[TAIL])
+            if head == tail:
+                continue
+            # A copy, so that the worker may overwrite the records once the tail
+            # is moved past them.
+            records = self.records[slot][np.arange(tail, head) % self.capacity]
+            if lock:
+                with lock:
+                    header[TAIL] = head
+            else:
+                header[TAIL] = head
+            names = self.names_of(slot)
+            order = np.argsort(records["name"], kind="stable")
+            ids = records["name"][order]
+            values = records["value"][order]
+            boundaries = np.flatnonzero(np.diff(ids)) + 1
+            for start, stop in zip([0, *boundaries], [*boundaries, len(ids)]):
+                yield self.label(names[ids[start]], slot), values[start:stop]
+
+    def names_of(self, slot):
+        names = self.slot_names[slot]
+        for i in range(len(names), int(self.headers[slot, N_NAMES])):
+            names.append(bytes(self.names[slot, i]).rstrip(b"\0").decode())
+        return names
+
+    def label(self, name, slot):
+        return name if self.merge else f"{name}[{slot}]"
+
+    @property
+    def dropped(self):
+        return int(self.headers[:, DROPPED].sum())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback
+        self.close()
+
+    def close(self):
+        """Stop draining the sink, after taking any remaining samples."""
+        if self.emit:
+            self.emit(("sink_closed", self))
+            self.emit = None
+
+    def release(self):
+        """
+        Free the shared memory. Only the controller should call this. It's only
+        unmapped once nothing in this process refers to the sink, because the
+        contexts of the sink may still write to it.
+        """
+        self.counter = self.headers = self.names = self.records = None
+        self.memory.unlink()
+
+
+def process_exists(pid):
+    if os.name == "nt":  # pragma: no-cover
+        # os.kill would terminate the process. Rely on workers releasing their
+        # slots when they exit.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class NullSink(AbstractContextManager):
+    """A sink for when nothing is recorded. Its workers' contexts do nothing."""
+
+    dropped = 0
+
+    def claim_slot(self):
+        return sparcli.context.NullContext()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def close(self):
+        pass
+
+
+class SharedContext(AbstractContextManager):
+    """
+    A context that records into a worker's slot of a `SharedSink`. It lives as
+    long as the worker, so closing it does nothing.
+    """
+
+    def __init__(self, sink, slot):
+        self.sink = sink
+        self.slot = slot
+        self.header = sink.headers[slot]
+        self.records = sink.records[slot]
+        self.names = sink.names[slot]
+        self.capacity = sink.capacity
+        self.lock = sink.slot_locks[slot] if sink.slot_locks else None
+        # The slot may have been used by a process that has exited; carry on
+        # with its names.
+        self.name_ids = {name: i for i, name in enumerate(sink.names_of(slot))}
+
+    def record(self, **variables):
+        for name, value in variables.items():
+            self.write(self.name_id(name), value)
+
+    def write(self, name_id, value):
+        header = self.header
+        head = int(header[HEAD])
+        if head - self.tail() >= self.capacity:
+            header[DROPPED] += 1
+            return
+        self.records[head % self.capacity] = (name_id, value)
+        self.publish(head + 1)
+
+    def tail(self):
+        """Read the tail, after which records may be overwritten."""
+        if self.lock is None:
+            return int(self.header[TAIL])
+        with self.lock:
+            return int(self.header[TAIL])
+
+    def publish(self, head):
+        """Move the head past records, once they have been written."""
+        if self.lock is None:
+            self.header[HEAD] = head
+            return
+        with self.lock:
+            self.header[HEAD] = head
+
+    def record_array(self, name, values):
+        values = np.fromiter(np.ravel(values), dtype=float)
+        header = self.header
+        head = int(header[HEAD])
+        free = self.capacity - (head - self.tail())
+        if len(values) > free:
+            header[DROPPED] += len(values) - free
+            values = values[:free]
+        indices = np.arange(head, head + len(values)) % self.capacity
+        self.records["name"][indices] = self.name_id(name)
+        self.records["value"][indices] = values
+        self.publish(head + len(values))
+
+    def metric(self, name):
+        """Get a handle for recording values of one variable."""
+        return SharedMetric(self, self.name_id(name))
+
+    def name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            pass
+        sink = self.sink
+        name_id = int(self.header[N_NAMES])
+        encoded = name.encode()
+        if name_id >= sink.MAX_NAMES:
+            raise ValueError(f"Too many variables (at most {sink.MAX_NAMES})")
+        if len(encoded) > sink.NAME_SIZE:
+            raise ValueError(f"Variable name is too long: {name}")
+        encoded = np.frombuffer(encoded, np.uint8)
+        self.names[name_id, : len(encoded)] = encoded
+        # Publish the name before any record refers to it.
+        self.header[N_NAMES] = name_id + 1
+        self.name_ids[name] = name_id
+        return name_id
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback
+        self.close()
+
+    def close(self):
+        pass
+
+
+class SharedMetric:
+    """A handle for recording values of one variable in a `SharedContext`."""
+
+    __slots__ = ("context", "name_id")
+
+    def __init__(self, context, name_id):
+        self.context = context
+        self.name_id = name_id
+
+    def __call__(self, value):
+        self.context.write(self.name_id, value)
+
+    record = __call__
@@ -13,13 +13,14 @@ def mock_system(mocker):
     patch_children(mocker, facade.msvcrt)
     patch_children(mocker, facade.os)
     patch_children(mocker, facade.sys)
+    patch_children(mocker, facade.termios)
 
     facade.ctypes.WinError.return_value = OSError()
     facade.os.dup.return_value = mocker.Mock(int)
     facade.os.dup2.return_value = mocker.Mock(int)
     facade.os.pipe.return_value = (mocker.Mock(int), mocker.Mock(int))
     facade.os.read.return_value = mocker.Mock(b"")
-    facade.os.write.return_value = mocker.Mock(int)
+    facade.os.write.side_effect = lambda fd, data: len(data)
     yield facade
 
 
@@ -1,11 +1,15 @@
+import errno
+
 import pytest
 
 import sparcli.capture.capture
+import sparcli.capture.flood
 
 
 @pytest.fixture
 def mute_capture(mocker, mock_system):
     platform = mocker.patch("sparcli.capture.platform_base.Platform", autospec=True)()
+    platform.can_splice = False
     capture_fd = mocker.MagicMock(int)
     yield sparcli.capture.capture.PipeCapture(platform, capture_fd)
 
@@ -31,6 +35,30 @@ def test_that_blocking_read_is_handled_gracefully(mocker, mute_capture, mock_sys
     assert not mock_system.os.write.called
 
 
+def test_that_flush_clears_before_forwarding(
+    mocker, mute_capture, mock_system, effector
+):
+    mock_system.os.read.side_effect = effector([b"foo", b"ba", BlockingIOError])
+    before_write = mocker.Mock()
+    mute_capture.start()
+
+    forwarded = mute_capture.flush(before_write)
+
+    assert forwarded == 5
+    before_write.assert_called_once_with()
+    assert mock_system.os.write.call_count == 2
+
+
+def test_that_flush_stops_at_end_of_file(mute_capture, mock_system):
+    mock_system.os.read.return_value = b""
+    mute_capture.start()
+    assert mute_capture.flush() == 0
+
+
+def test_that_nocapture_forwards_nothing(mock_system):
+    assert sparcli.capture.capture.NoCapture(1).flush() == 0
+
+
 @pytest.mark.parametrize("text,data", [("foo", b"foo"), (b"bar", b"bar")])
 def test_that_strings_are_encoded(mute_capture, mock_system, text, data):
     mute_capture.write(text)
@@ -42,9 +70,246 @@ def test_that_strings_are_encoded(mute_capture, mock_system, text, data):
 def test_that_multicapture_forwards_calls(method, mocker):
     out = mocker.Mock(sparcli.capture.capture.Capture)()
     err = mocker.Mock(sparcli.capture.capture.Capture)()
+    out.flush.return_value = err.flush.return_value = 0
     mutlicap = sparcli.capture.capture.MultiCapture(out, err)
 
     getattr(mutlicap, method)()
 
     assert getattr(out, method).called
     assert getattr(err, method).called
+
+
+def test_that_partial_writes_are_completed(mute_capture, mock_system):
+    mock_system.os.write.side_effect = lambda fd, data: 2
+    mute_capture.write(b"abcde")
+    written = [args[1] for args, _ in mock_system.os.write.call_args_list]
+    assert written == [b"abcde", b"cde", b"e"]
+
+
+def test_that_partial_lines_are_tracked(mute_capture, mock_system):
+    mock_system.os.read.side_effect = [b"foo", b"bar\n"]
+    mute_capture.start()
+
+    mute_capture.forward()
+    assert mute_capture.mid_line
+    mute_capture.forward()
+    assert not mute_capture.mid_line
+    assert mute_capture.bytes_forwarded == 7
+    assert mute_capture.forward_time > 0
+
+
+def test_that_output_is_spliced_except_for_last_byte(mocker, mute_capture, mock_system):
+    mute_capture.platform.pending_bytes.return_value = 10
+    mock_system.os.splice.side_effect = [4, 5]
+    mock_system.os.read.return_value = b"\n"
+    before_write = mocker.Mock()
+    mute_capture.splice = True
+    mute_capture.start()
+
+    assert mute_capture.forward(before_write) == 10
+
+    before_write.assert_called_once_with()
+    sizes = [args[2] for args, _ in mock_system.os.splice.call_args_list]
+    assert sizes == [9, 5]
+    mock_system.os.read.assert_called_once_with(mute_capture.pipe_out_fd, 1)
+    assert not mute_capture.mid_line
+    assert mute_capture.bytes_forwarded == 10
+
+
+def test_that_splice_stops_when_pipe_is_empty(mute_capture, mock_system):
+    mute_capture.platform.pending_bytes.return_value = 0
+    mute_capture.splice = True
+    mute_capture.start()
+    assert mute_capture.flush() == 0
+    assert not mock_system.os.splice.called
+
+
+def test_that_unspliceable_output_is_copied(mute_capture, mock_system):
+    mute_capture.platform.pending_bytes.return_value = 4
+    mock_system.os.splice.side_effect = OSError(errno.EINVAL, "Invalid argument")
+    mock_system.os.read.return_value = b"foo"
+    mute_capture.splice = True
+    mute_capture.start()
+
+    assert mute_capture.forward() == 3
+
+    assert not mute_capture.splice
+    mock_system.os.read.assert_called_once_with(mute_capture.pipe_out_fd, 4)
+    assert mute_capture.mid_line
+
+
+def test_that_full_pipes_are_copied_to(mute_capture, mock_system):
+    mute_capture.platform.pending_bytes.return_value = 4
+    mock_system.os.splice.side_effect = [1, BlockingIOError]
+    mock_system.os.read.return_value = b"oo\n"
+    mute_capture.splice = True
+    mute_capture.start()
+
+    assert mute_capture.forward() == 4
+
+    assert mute_capture.splice
+    mock_system.os.read.assert_called_once_with(mute_capture.pipe_out_fd, 3)
+
+
+def test_that_other_splice_errors_are_raised(mute_capture, mock_system):
+    mute_capture.platform.pending_bytes.return_value = 4
+    mock_system.os.splice.side_effect = OSError(errno.EIO, "I/O error")
+    mute_capture.splice = True
+    mute_capture.start()
+    with pytest.raises(OSError):
+        mute_capture.forward()
+
+
+def test_that_forwarder_writes_with_lock(mocker, mute_capture, mock_system):
+    mock_system.os.read.side_effect = [b"foo\n", BlockingIOError]
+    lock = mocker.MagicMock()
+    before_write = mocker.Mock()
+    after_write = mocker.Mock()
+    mute_capture.start()
+    forwarder = sparcli.capture.capture.Forwarder(
+        mute_capture, lock, before_write, after_write
+    )
+
+    wakes = iter([True, True])
+
+    def wait_readable(waker, read_fds, timeout):
+        if next(wakes, False):
+            return read_fds
+        forwarder.running = False
+        return []
+
+    mute_capture.platform.wait_readable.side_effect = wait_readable
+    forwarder.run()
+
+    assert lock.__enter__.call_count == 2
+    before_write.assert_called_once_with()
+    after_write.assert_called_once_with()
+    forwarder.waker.close()
+
+
+def test_that_forwarder_shows_marker_when_it_is_due(
+    mocker, mute_capture, mock_system
+):
+    mock_system.os.read.side_effect = BlockingIOError
+    limiter = mocker.Mock(sparcli.capture.flood.FloodLimiter)
+    limiter.time_to_marker.side_effect = [None, 0.5, 0.5, 0.0]
+    limiter.expire.return_value = b"[1 lines suppressed]\n"
+    mute_capture.limiter = limiter
+    before_write, after_write = mocker.Mock(), mocker.Mock()
+    mute_capture.start()
+    forwarder = sparcli.capture.capture.Forwarder(
+        mute_capture, mocker.MagicMock(), before_write, after_write
+    )
+    timeouts = []
+
+    def wait_readable(waker, read_fds, timeout):
+        timeouts.append(timeout)
+        forwarder.running = len(timeouts) < 2
+        return []
+
+    mute_capture.platform.wait_readable.side_effect = wait_readable
+    forwarder.run()
+
+    assert timeouts == [None, 0.5]
+    mock_system.os.write.assert_called_once_with(
+        mute_capture.true_fd, b"[1 lines suppressed]\n"
+    )
+    before_write.assert_called_once_with()
+    after_write.assert_called_once_with()
+    assert not mute_capture.mid_line
+    forwarder.waker.close()
+
+
+def test_that_forwarder_is_stopped_on_close(mocker, mute_capture, mock_system):
+    mock_system.os.read.side_effect = BlockingIOError
+    mute_capture.platform.wait_readable.side_effect = lambda waker, fds, timeout: (
+        waker.wait()
+    )
+    mute_capture.start()
+    mute_capture.start_forwarding(mocker.MagicMock())
+    forwarder = mute_capture.forwarder
+
+    mute_capture.close()
+
+    assert not forwarder.is_alive()
+    assert mute_capture.forwarder is None
+
+
+def test_that_multicapture_combines_forwarding(mocker, mock_system):
+    out = sparcli.capture.capture.NoCapture(1)
+    err = mocker.Mock(sparcli.capture.capture.PipeCapture)
+    err.bytes_forwarded = 5
+    err.forward_time = 0.5
+    err.mid_line = True
+    multicap = sparcli.capture.capture.MultiCapture(out, err)
+    lock = mocker.Mock()
+
+    multicap.start_forwarding(lock)
+
+    err.start_forwarding.assert_called_once_with(lock, None, None)
+    assert multicap.bytes_forwarded == 5
+    assert multicap.forward_time == 0.5
+    assert multicap.mid_line
+
+    multicap.close()
+    err.stop_forwarding.assert_called_once_with()
+
+
+def test_that_multicapture_knows_where_output_really_goes(mute_capture, mock_system):
+    multicap = sparcli.capture.capture.MultiCapture(
+        mute_capture, sparcli.capture.capture.NoCapture(2)
+    )
+    assert multicap.terminal_fd is mute_capture.target_fd
+
+    multicap.start()
+
+    assert multicap.terminal_fd is mock_system.os.dup.return_value
+
+
+def test_that_limited_output_is_filtered_and_not_spliced(
+    mocker, mute_capture, mock_system
+):
+    limiter = mocker.Mock(sparcli.capture.flood.FloodLimiter)
+    limiter.filter.side_effect = [b"fo", b""]
+    mock_system.os.read.side_effect = [b"foo\n", b"bar\n"]
+    before_write = mocker.Mock()
+    mute_capture.splice = True
+    mute_capture.limiter = limiter
+    mute_capture.start()
+
+    assert mute_capture.forward(before_write) == 4
+    assert mute_capture.forward(before_write) == 4
+
+    mock_system.os.write.assert_called_once_with(mute_capture.true_fd, b"fo")
+    before_write.assert_called_once_with()
+    assert mute_capture.mid_line
+    assert not mock_system.os.splice.called
+
+
+def test_that_multicapture_limits_both_streams(mocker, mock_system):
+    out = mocker.Mock(sparcli.capture.capture.PipeCapture)
+    err = mocker.Mock(sparcli.capture.capture.PipeCapture)
+    limiter = mocker.Mock(sparcli.capture.flood.FloodLimiter)
+    limiter.close.return_value = b"[1 lines suppressed]\n"
+    multicap = sparcli.capture.capture.MultiCapture(out, err)
+
+    multicap.limit_rate(limiter)
+    assert out.limiter is err.limiter is limiter
+
+    manager = mocker.Mock()
+    manager.attach_mock(out, "out")
+    manager.attach_mock(err, "err")
+    multicap.close()
+    out.write.assert_called_once_with(b"[1 lines suppressed]\n")
+    calls = [name for name, _, _ in manager.mock_calls]
+    assert calls[:4] == [
+        "out.stop_forwarding",
+        "err.stop_forwarding",
+        "out.close",
+        "err.close",
+    ]
+
+    limiter.close.return_value = b""
+    out.write.reset_mock()
+    multicap.close()
+    assert not out.write.called
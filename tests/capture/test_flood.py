@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+import sparcli.capture.flood
+
+
+@pytest.fixture
+def monotonic(mocker):
+    yield mocker.patch("time.monotonic", return_value=10.0)
+
+
+@pytest.fixture
+def spill_path(tmp_path):
+    yield tmp_path / "spill.log"
+
+
+def lines(start, stop):
+    return b"".join(b"%d\n" % i for i in range(start, stop))
+
+
+def test_that_output_under_the_limit_is_shown(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(10, 1000, spill_path)
+
+    assert limiter.filter(b"a\nb") == b"a\nb"
+    assert limiter.filter(b"c\n") == b"c\n"
+
+    assert limiter.close() == b""
+    assert spill_path.read_bytes() == b"a\nbc\n"
+
+
+def test_that_lines_over_the_limit_are_suppressed(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(3, None, spill_path)
+
+    assert limiter.filter(lines(0, 5)) == lines(0, 3)
+    assert limiter.filter(lines(5, 7)) == b""
+
+    monotonic.return_value = 12.0
+    marker = f"[4 lines suppressed; see {spill_path}]\n".encode()
+    assert limiter.filter(b"x\n") == marker + b"x\n"
+    limiter.close()
+    assert spill_path.read_bytes() == lines(0, 7) + b"x\n"
+
+
+def test_that_floods_are_sampled_evenly(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(5, None, spill_path)
+    limiter.filter(lines(0, 20))
+
+    monotonic.return_value = 10.5
+    assert limiter.filter(lines(20, 40)) == b""
+
+    monotonic.return_value = 11.0
+    shown = limiter.filter(lines(40, 80))
+
+    assert limiter.stride == 8
+    assert shown.endswith(b"40\n48\n56\n64\n72\n")
+    assert shown.startswith(b"[35 lines suppressed;")
+
+
+def test_that_sampling_stops_after_a_quiet_period(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(5, None, spill_path)
+    limiter.filter(lines(0, 20))
+
+    monotonic.return_value = 15.0
+    limiter.filter(b"x\n")
+
+    assert limiter.stride == 1
+
+
+def test_that_bytes_over_the_limit_are_suppressed(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(None, 8, spill_path)
+    assert limiter.filter(b"abc\ndef\nghi\n") == b"abc\ndef\n"
+    assert limiter.suppressed == 1
+
+
+def test_that_lines_are_shown_or_suppressed_whole(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(2, None, spill_path)
+
+    assert limiter.filter(b"a\nb") == b"a\nb"
+    assert limiter.filter(b"b\nc") == b"b\n"
+    assert limiter.filter(b"c\nd\n") == b""
+
+    assert limiter.suppressed == 2
+
+
+def test_that_marker_starts_on_a_new_line(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(100, None, spill_path)
+    limiter.filter(b"")
+    limiter.stride = 2
+
+    assert limiter.filter(b"a\nb\nc") == b"a\nc"
+
+    assert limiter.close() == f"\n[1 lines suppressed; see {spill_path}]\n".encode()
+
+
+def test_that_marker_is_shown_when_the_window_ends(monotonic, spill_path):
+    limiter = sparcli.capture.flood.FloodLimiter(1, None, spill_path)
+    assert limiter.time_to_marker() is None
+    limiter.filter(b"a\nb\nc")
+
+    monotonic.return_value = 10.25
+    assert limiter.time_to_marker() == 0.75
+    assert limiter.expire() == b""
+
+    monotonic.return_value = 11.0
+    assert limiter.time_to_marker() == 0.0
+    assert limiter.expire() == f"[1 lines suppressed; see {spill_path}]\n".encode()
+    assert limiter.time_to_marker() is None
+
+
+def test_that_output_is_spilled_to_a_temporary_file(monotonic):
+    limiter = sparcli.capture.flood.FloodLimiter(1)
+    try:
+        limiter.filter(b"a\nb\n")
+        limiter.close()
+        with open(limiter.path, "rb") as spill:
+            assert spill.read() == b"a\nb\n"
+        assert "sparcli-" in limiter.path
+    finally:
+        os.remove(limiter.path)
+
+
+def test_that_unreferenced_temporary_file_is_deleted(monotonic):
+    limiter = sparcli.capture.flood.FloodLimiter(10)
+    limiter.filter(b"a\nb\n")
+
+    assert limiter.close() == b""
+    assert not os.path.exists(limiter.path)
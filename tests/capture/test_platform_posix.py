@@ -1,3 +1,7 @@
+import struct
+
+import pytest
+
 import sparcli.capture.platform_posix
 
 
@@ -6,3 +10,46 @@ def test_that_set_nonblocking_sets_file_attribute(mocker, mock_system):
     platform = sparcli.capture.platform_posix.PosixPlatform()
     platform.set_nonblocking(read_fd)
     assert mock_system.fcntl.fcntl.call_args[0][0] == read_fd
+
+
+def test_that_pipe_size_is_set_where_possible(mock_system):
+    platform = sparcli.capture.platform_posix.PosixPlatform()
+    platform.set_pipe_size(3, 1024)
+    mock_system.fcntl.fcntl.assert_called_once_with(
+        3, mock_system.fcntl.F_SETPIPE_SZ, 1024
+    )
+
+    mock_system.fcntl.fcntl.side_effect = PermissionError
+    platform.set_pipe_size(3, 1024)
+
+    mock_system.fcntl.F_SETPIPE_SZ = None
+    mock_system.fcntl.fcntl.reset_mock()
+    platform.set_pipe_size(3, 1024)
+    assert not mock_system.fcntl.fcntl.called
+
+
+def test_that_pipes_are_waited_on_with_select(mocker):
+    waker = mocker.Mock()
+    platform = sparcli.capture.platform_posix.PosixPlatform()
+    assert platform.wait_readable(waker, [3]) is waker.wait.return_value
+    waker.wait.assert_called_once_with([3], None)
+    platform.wait_readable(waker, [3], 0.5)
+    waker.wait.assert_called_with([3], 0.5)
+
+
+@pytest.mark.parametrize(
+    "name,splice,expected",
+    [("linux", True, True), ("darwin", True, False), ("linux", None, False)],
+)
+def test_that_splice_is_only_used_on_linux(mock_system, name, splice, expected):
+    mock_system.sys.platform = name
+    mock_system.os.splice = splice
+    platform = sparcli.capture.platform_posix.PosixPlatform()
+    assert platform.can_splice == expected
+
+
+def test_that_pending_bytes_are_queried(mock_system):
+    mock_system.fcntl.ioctl.return_value = struct.pack("i", 42)
+    platform = sparcli.capture.platform_posix.PosixPlatform()
+    assert platform.pending_bytes(3) == 42
+    assert mock_system.fcntl.ioctl.call_args[0][:2] == (3, mock_system.termios.FIONREAD)
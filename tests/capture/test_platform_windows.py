@@ -10,3 +10,12 @@ def test_that_failure_raises_exception(mocker, mock_system):
 
     with pytest.raises(OSError):
         platform.set_nonblocking(read_fd)
+
+
+def test_that_pipes_are_polled(mocker):
+    waker = mocker.Mock()
+    platform = sparcli.capture.platform_windows.WindowsPlatform()
+    assert platform.wait_readable(waker, [3]) == [3]
+    waker.wait.assert_called_once_with(timeout=platform.POLL_INTERVAL)
+    platform.wait_readable(waker, [3], 0.001)
+    waker.wait.assert_called_with(timeout=0.001)
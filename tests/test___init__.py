@@ -1,3 +1,4 @@
+import asyncio
 import threading
 import time
 
@@ -15,6 +16,7 @@ def mock_capture(mocker):
 def test_that_it_can_be_used_as_a_context_manager(mocker):
     controller = mocker.MagicMock(sparcli.controller.Controller, autospec=True)()
     main = mocker.patch.object(sparcli, "_main", autospec=True)
+    main.fixed_context = None
     main.get_controller.return_value = controller
     SparcliContext = mocker.patch("sparcli.context.SparcliContext", autospec=True)
 
@@ -24,6 +26,73 @@ def test_that_it_can_be_used_as_a_context_manager(mocker):
     assert SparcliContext.return_value.__exit__.called
 
 
+def test_that_shared_sink_is_drained_by_controller(mocker):
+    main = mocker.patch.object(sparcli, "_main", autospec=True)
+    SharedSink = mocker.patch("sparcli.shared.SharedSink", autospec=True)
+    event_queue = main.get_controller.return_value.event_queue
+
+    sink = sparcli.shared_sink(4, merge=False)
+
+    SharedSink.assert_called_once_with(4, 2 ** 16, False, None)
+    event_queue.append.assert_called_once_with(("sink_added", sink))
+    assert sink.emit == event_queue.append
+
+
+def test_that_shared_sink_does_nothing_without_controller(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    SharedSink = mocker.patch("sparcli.shared.SharedSink", autospec=True)
+    sparcli._after_fork()
+
+    with sparcli.shared_sink(4) as sink:
+        sparcli.init_worker(sink)
+        assert isinstance(sparcli.ctx(), sparcli.context.NullContext)
+
+    assert not SharedSink.called
+    assert sink.dropped == 0
+
+
+def test_that_workers_record_into_shared_sink(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    sink = mocker.Mock(sparcli.shared.SharedSink)
+
+    sparcli.init_worker(sink)
+
+    assert sparcli.ctx() is sink.claim_slot.return_value
+    assert not main.controller
+
+
+def test_that_forked_child_records_nothing(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    controller = main.controller = mocker.Mock(sparcli.controller.Controller)
+    controller.event_queue = mocker.Mock(sparcli.events.EventQueue)
+    lock = main.controller_lock
+
+    sparcli._after_fork()
+
+    controller.event_queue.detach.assert_called_once_with()
+    controller.restore_signal_handlers.assert_called_once_with()
+    assert main.controller is None
+    assert main.controller_lock is not lock
+    assert isinstance(sparcli.ctx(), sparcli.context.NullContext)
+    assert sparcli.stats() is None
+
+    main.after_fork()
+    assert isinstance(main.fixed_context, sparcli.context.NullContext)
+
+
+def test_that_aggregating_context_can_be_requested(mocker):
+    main = mocker.patch.object(sparcli, "_main", autospec=True)
+    main.fixed_context = None
+    context = sparcli.ctx(flush_interval=1.0)
+    assert isinstance(context, sparcli.context.AggregatingContext)
+    assert context.flush_interval == 1.0
+    context.close()
+    assert main.get_controller.return_value.event_queue.append.called
+
+
 def test_that_it_can_wrap_an_iterable(mocker):
     ctx = mocker.patch("sparcli.ctx", autospec=True).return_value
     ctx = ctx.__enter__.return_value
@@ -32,21 +101,238 @@ def test_that_it_can_wrap_an_iterable(mocker):
     output = list(sparcli.gen(numbers, "x"))
 
     assert numbers == output
-    ctx.record.assert_any_call(x=1)
-    ctx.record.assert_any_call(x=2)
-    ctx.record.assert_any_call(x=3)
+    ctx.metric.assert_called_once_with("x")
+    metric = ctx.metric.return_value
+    metric.assert_has_calls([mocker.call(1), mocker.call(2), mocker.call(3)])
+
+
+def test_that_iterable_values_can_be_sampled(mocker):
+    main = mocker.patch.object(sparcli, "_main", autospec=True)
+    main.fixed_context = None
+    event_queue = main.get_controller.return_value.event_queue
+
+    assert list(sparcli.gen(range(5), "x", every=2)) == [0, 1, 2, 3, 4]
+
+    values = [args[0][2] for args, _ in event_queue.offer.call_args_list]
+    assert values == [0, 2, 4]
+    topics = [args[0][0] for args, _ in event_queue.append.call_args_list]
+    assert topics == ["sampler_added", "sampler_added", "producer_stopped"]
+
+
+def test_that_worker_contexts_can_be_sampled(mocker):
+    main = mocker.patch.object(sparcli, "_main", autospec=True)
+
+    context = sparcli.ctx(fraction=0.5)
+
+    assert isinstance(context, sparcli.context.SampledContext)
+    assert context.context is main.fixed_context
+    assert not main.get_controller.called
+
+
+def test_that_iterable_values_can_be_batched(mocker):
+    ctx = mocker.patch("sparcli.ctx", autospec=True).return_value
+    ctx = ctx.__enter__.return_value
+    batches = []
+    ctx.record_array.side_effect = lambda name, values: batches.append(list(values))
+    numbers = [1, 2, 3, 4, 5]
+
+    output = list(sparcli.gen(numbers, "x", batch_size=2))
+
+    assert numbers == output
+    assert batches == [[1, 2], [3, 4], [5]]
+    assert not ctx.record.called
+
+
+def test_that_partial_batch_is_sent_when_iteration_stops_early(mocker):
+    ctx = mocker.patch("sparcli.ctx", autospec=True).return_value
+    ctx = ctx.__enter__.return_value
+
+    for value in sparcli.gen([1, 2, 3], "x", batch_size=10):
+        break
+
+    ctx.record_array.assert_called_once_with("x", [1])
+
+
+async def numbers(values):
+    for value in values:
+        yield value
+
+
+def consume(async_iterable, n=None):
+    async def collect():
+        values = []
+        async for value in async_iterable:
+            values.append(value)
+            if len(values) == n:
+                break
+        return values
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def async_context(mocker):
+    context = mocker.Mock(sparcli.context.SparcliContext)
+    async_context = sparcli.aio.AsyncContext(lambda: context, lambda: False)
+    mocker.patch("sparcli.actx", autospec=True, return_value=async_context)
+    yield context
+
+
+def test_that_it_can_wrap_an_async_iterable(mocker, async_context):
+    assert consume(sparcli.agen(numbers([1, 2]), "x")) == [1, 2]
+
+    async_context.metric.assert_called_once_with("x")
+    metric = async_context.metric.return_value
+    metric.assert_has_calls([mocker.call(1), mocker.call(2)])
+    assert async_context.close.called
+
+
+def test_that_async_iterable_values_can_be_batched(async_context):
+    context = async_context
+    batches = []
+    context.record_array.side_effect = lambda name, values: batches.append(
+        list(values)
+    )
+
+    assert consume(sparcli.agen(numbers([1, 2, 3]), "x", batch_size=2)) == [1, 2, 3]
+
+    assert batches == [[1, 2], [3]]
+
+
+def test_that_async_context_only_blocks_before_controller_starts(mocker):
+    main = mocker.patch.object(sparcli, "_main", _Main(threading.Lock()))
+    AsyncContext = mocker.patch("sparcli.aio.AsyncContext", autospec=True)
+
+    sparcli.actx(flush_count=10)
+    (make_context,), kwargs = AsyncContext.call_args
+    assert make_context.args == (None, 10, None, None, None)
+
+    # Decided when the context is entered, not when it's made.
+    would_block = kwargs["would_block"]
+    assert would_block()
+    main.controller = mocker.Mock()
+    assert not would_block()
+
+
+def test_that_running_controller_is_got_without_lock(mocker):
+    main = _Main(threading.Lock())
+    main.initialized = True
+    main.controller = mocker.Mock()
+
+    # The lock is held while a controller is torn down.
+    with main.controller_lock:
+        assert main.get_controller() is main.controller
 
 
 def test_that_controller_is_configured(mocker):
-    capture = mocker.patch("sparcli.capture.factory", autospec=True)("fd")
+    capture = sparcli.capture.make_multi_capture.return_value
     renderer = mocker.patch("sparcli.render.Renderer", autospec=True)(
         capture.write_out, capture
     )
     Controller = mocker.patch("sparcli.controller.Controller", autospec=True)
 
-    _controller_factory()
+    _controller_factory(
+        max_fps=10, show_stats=True, max_queue_size=100, headless=False
+    )
+
+    Controller.assert_called_with(
+        renderer,
+        max_fps=10,
+        show_stats=True,
+        max_queue_size=100,
+        overflow="drop_newest",
+        grace_period=1.0,
+    )
+
+
+def test_that_scroll_region_renderer_can_be_chosen(mocker):
+    capture = sparcli.capture.make_multi_capture.return_value
+    ScrollRegionRenderer = mocker.patch(
+        "sparcli.render.ScrollRegionRenderer", autospec=True
+    )
+    Controller = mocker.patch("sparcli.controller.Controller", autospec=True)
+
+    _controller_factory(headless=False, scroll_region=True, row_priority="recent")
+
+    ScrollRegionRenderer.assert_called_once_with(capture.write_out, capture, "recent")
+    (renderer,), _ = Controller.call_args
+    assert renderer is ScrollRegionRenderer.return_value
+
+
+def test_that_flood_mode_limits_capture(mocker):
+    capture = sparcli.capture.make_multi_capture.return_value
+    FloodLimiter = sparcli.capture.flood.FloodLimiter
+    mocker.patch("sparcli.controller.Controller", autospec=True)
+
+    _controller_factory(headless=False)
+    assert not capture.limit_rate.called
+
+    _controller_factory(headless=False, max_lines_per_second=100, spill_path="f")
+    FloodLimiter.assert_called_once_with(100, None, "f")
+    capture.limit_rate.assert_called_once_with(FloodLimiter.return_value)
+
+
+def test_that_stats_come_from_running_controller(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    assert sparcli.stats() is None
+
+    main.controller = mocker.Mock(sparcli.controller.Controller)
+    assert sparcli.stats() is main.controller.get_stats.return_value
+
+
+@pytest.mark.parametrize("isatty", [False, ValueError])
+def test_that_headless_mode_is_detected(mocker, isatty):
+    mocker.patch("sys.stdout").isatty.side_effect = [isatty]
+    SummaryRenderer = mocker.patch("sparcli.render.SummaryRenderer", autospec=True)
+    Controller = mocker.patch("sparcli.controller.Controller", autospec=True)
+
+    _controller_factory(summary_interval=10)
+
+    assert not sparcli.capture.make_multi_capture.called
+    (renderer,), kwargs = Controller.call_args
+    assert renderer is SummaryRenderer.return_value
+    assert kwargs["max_fps"] == 0.1
+
+
+def test_that_summaries_are_written_to_stdout(mocker):
+    stdout = mocker.patch("sys.stdout")
+    sparcli._write_stdout("x")
+    stdout.write.assert_called_once_with("x")
+    assert stdout.flush.called
+
+
+def test_that_headless_mode_can_discard_everything(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    mocker.patch("atexit.register", autospec=True)
+    sparcli.configure(headless=True, summary_interval=None)
+
+    context = sparcli.ctx()
+
+    assert isinstance(context, sparcli.context.NullContext)
+    assert sparcli.ctx() is context
+    assert not main.controller
+    assert list(sparcli.gen([1, 2], "x")) == [1, 2]
+
+
+def test_that_options_are_passed_to_controller_factory(mocker):
+    main = _Main(threading.Lock())
+    mocker.patch.object(sparcli, "_main", main)
+    factory = mocker.patch.object(sparcli, "_controller_factory", autospec=True)
+    factory.__kwdefaults__ = {"max_fps": 30}
+    mocker.patch("atexit.register", autospec=True)
+
+    sparcli.configure(max_fps=5)
+    main.get_controller()
+
+    factory.assert_called_once_with(max_fps=5)
+
 
-    Controller.assert_called_with(renderer)
+def test_that_unknown_options_are_rejected():
+    with pytest.raises(TypeError) as error:
+        sparcli.configure(fps=5)
+    assert "fps" in str(error.value)
 
 
 def run_concurrently(function, n):
@@ -0,0 +1,38 @@
+import asyncio
+import threading
+
+import sparcli.aio
+
+
+def test_that_blocking_context_is_made_in_executor(mocker):
+    context = mocker.Mock()
+    threads = []
+
+    def make_context():
+        threads.append(threading.current_thread())
+        return context
+
+    async def use():
+        async with sparcli.aio.AsyncContext(make_context) as ctx:
+            assert ctx is context
+
+    asyncio.run(use())
+
+    assert threads[0] is not threading.current_thread()
+    assert context.close.called
+
+
+def test_that_ready_context_is_made_inline(mocker):
+    make_context = mocker.Mock()
+
+    async def use():
+        async with sparcli.aio.AsyncContext(make_context, lambda: False):
+            pass
+
+    loop = asyncio.new_event_loop()
+    run_in_executor = mocker.patch.object(loop, "run_in_executor")
+    loop.run_until_complete(use())
+    loop.close()
+
+    assert not run_in_executor.called
+    assert make_context.return_value.close.called
@@ -1,13 +1,16 @@
-import collections
-
+import numpy as np
 import pytest
 
 import sparcli.context
+import sparcli.events
+import sparcli.sampling
 
 
 @pytest.fixture
 def queue(mocker):
-    yield mocker.MagicMock(collections.deque)()
+    queue = mocker.MagicMock(sparcli.events.EventQueue)()
+    queue.offer.return_value = True
+    yield queue
 
 
 @pytest.fixture
@@ -17,9 +20,198 @@ def context(queue):
 
 def test_that_context_emits_data_produced_event(context, queue):
     context.record(x=1)
-    queue.append.assert_called_with(("data_produced", context, {"x": 1}))
+    queue.offer.assert_called_with(("data_produced", context, {"x": 1}))
+
+
+@pytest.mark.parametrize(
+    "values", [[1, 2, 3], range(1, 4), np.array([1, 2, 3]), np.array([[1], [2], [3]])]
+)
+def test_that_context_emits_array_produced_event(context, queue, values):
+    context.record_array("x", values)
+
+    topic, producer, name, array = queue.offer.call_args[0][0]
+
+    assert (topic, producer, name) == ("array_produced", context, "x")
+    assert array.dtype == float
+    assert array.ravel().tolist() == [1, 2, 3]
+    assert array is not values
+
+
+def test_that_metric_handles_emit_value_produced_events(context, queue):
+    metric = context.metric("x")
+    metric(1)
+    metric.record(2)
+
+    events = [args[0] for args, _ in queue.offer.call_args_list]
+    assert events == [("value_produced", metric, 1), ("value_produced", metric, 2)]
+    assert (metric.context, metric.name) == (context, "x")
 
 
 def test_that_context_emits_producer_stopped_event(context, queue):
     context.__exit__(None, None, None)
     queue.append.assert_called_with(("producer_stopped", context))
+
+
+@pytest.fixture
+def aggregating_context(queue):
+    yield sparcli.context.AggregatingContext(queue, flush_count=3)
+
+
+def test_that_records_are_aggregated_until_flush_count(aggregating_context, queue):
+    aggregating_context.record(x=1, y=2)
+    aggregating_context.record(x=float("nan"))
+    assert not queue.offer.called
+
+    aggregating_context.record_array("x", [3, 5])
+
+    topic, producer, aggregates = queue.offer.call_args[0][0]
+    assert (topic, producer) == ("aggregate_produced", aggregating_context)
+    x = aggregates["x"]
+    assert (x.count, x.finite_count, x.mean, x.minimum, x.maximum) == (4, 3, 3, 1, 5)
+    assert aggregates["y"].count == 1
+    assert not aggregating_context.aggregates
+
+
+def test_that_records_are_flushed_after_interval(mocker, queue):
+    monotonic = mocker.patch("time.monotonic", return_value=0.0)
+    context = sparcli.context.AggregatingContext(queue, flush_interval=0.5)
+
+    context.record(x=1)
+    assert not queue.offer.called
+
+    monotonic.return_value = 0.5
+    context.record(x=2)
+    assert queue.offer.call_args[0][0][2]["x"].count == 2
+
+
+def test_that_metric_handles_are_aggregated(aggregating_context, queue):
+    metric = aggregating_context.metric("x")
+    metric(1)
+    metric.record(2)
+    assert not queue.offer.called
+
+    metric(3)
+
+    assert queue.offer.call_args[0][0][2]["x"].count == 3
+
+
+def test_that_null_metric_handles_do_nothing(queue):
+    metric = sparcli.context.NullContext().metric("x")
+    metric(1)
+    metric.record(2)
+
+
+def test_that_aggregates_are_flushed_on_close(aggregating_context, queue):
+    aggregating_context.record(x=1)
+
+    aggregating_context.close()
+
+    events = [args[0] for args, _ in queue.append.call_args_list]
+    assert [event[0] for event in events] == ["aggregate_produced", "producer_stopped"]
+
+
+def test_that_empty_aggregates_are_not_sent(aggregating_context, queue):
+    aggregating_context.flush()
+    assert not queue.offer.called
+
+
+def test_that_refused_aggregates_are_kept(aggregating_context, queue):
+    queue.offer.return_value = False
+    aggregating_context.record_array("x", [1, 2, 3])
+    aggregating_context.record(x=4)
+    aggregating_context.record(x=5)
+    assert queue.offer.called
+
+    queue.offer.return_value = True
+    aggregating_context.record(x=6)
+
+    assert queue.offer.call_args[0][0][2]["x"].count == 6
+    assert not aggregating_context.aggregates
+
+
+def test_that_refused_records_are_collapsed(context, queue):
+    queue.offer.return_value = False
+    context.record(x=1)
+    context.record_array("x", [2, 3])
+    queue.offer.return_value = True
+    context.record(x=4)
+
+    events = [args[0] for args, _ in queue.offer.call_args_list]
+    topics = [event[0] for event in events]
+    assert topics[-2:] == ["aggregate_produced", "data_produced"]
+    assert events[-2][2]["x"].count == 3
+    assert events[-1][2] == {"x": 4}
+    assert not context.collapsed
+
+
+def test_that_refused_metric_values_are_collapsed(context, queue):
+    metric = context.metric("x")
+    queue.offer.return_value = False
+    metric(1)
+    metric(2)
+    queue.offer.return_value = True
+    metric(3)
+
+    events = [args[0] for args, _ in queue.offer.call_args_list]
+    topics = [event[0] for event in events]
+    assert topics[-2:] == ["aggregate_produced", "value_produced"]
+    assert events[-2][2]["x"].count == 2
+    assert not context.collapsed
+
+
+def test_that_collapsed_records_are_sent_on_close(context, queue):
+    queue.offer.return_value = False
+    context.record(x=1)
+    context.record(x=2)
+
+    context.close()
+
+    events = [args[0] for args, _ in queue.append.call_args_list]
+    assert [event[0] for event in events] == ["aggregate_produced", "producer_stopped"]
+    assert events[0][2]["x"].count == 2
+
+
+@pytest.fixture
+def sampled_context(context, queue):
+    make_sampler = sparcli.sampling.policy(every=2)
+    yield sparcli.context.SampledContext(context, make_sampler, queue.append)
+
+
+def test_that_sampled_context_skips_records(sampled_context, context, queue):
+    for x in range(5):
+        sampled_context.record(x=x)
+
+    events = [args[0] for args, _ in queue.offer.call_args_list]
+    assert [event[2] for event in events] == [{"x": 0}, {"x": 2}, {"x": 4}]
+    queue.append.assert_called_once_with(
+        ("sampler_added", context, None, sampled_context.sampler)
+    )
+
+
+def test_that_sampled_context_skips_array_values(sampled_context, queue):
+    sampled_context.record_array("x", range(3))
+    sampled_context.record_array("x", np.array([[3], [4]]))
+    sampled_context.record_array("x", [5])
+
+    arrays = [args[0][3].tolist() for args, _ in queue.offer.call_args_list]
+    assert arrays == [[0, 2], [4]]
+
+
+def test_that_sampled_metric_handles_share_a_sampler(sampled_context, context, queue):
+    metric = sampled_context.metric("x")
+    for x in range(3):
+        metric(x)
+    sampled_context.record_array("x", [3, 4])
+    metric.record(5)
+
+    sampler = sampled_context.samplers["x"]
+    queue.append.assert_called_with(("sampler_added", context, "x", sampler))
+    assert sampler.seen == 6
+    values = [args[0][2] for args, _ in queue.offer.call_args_list]
+    assert values[:2] == [0, 2]
+
+
+def test_that_sampled_context_closes_its_context(sampled_context, queue):
+    with sampled_context:
+        pass
+    queue.append.assert_called_with(("producer_stopped", sampled_context.context))
@@ -1,31 +1,67 @@
+import numpy as np
 import pytest
 
+import sparcli.context
 import sparcli.controller
+import sparcli.sampling
 
 
 @pytest.fixture
 def renderer(mocker):
-    yield mocker.patch("sparcli.render.Renderer", autospec=True)(None, None)
+    renderer = mocker.patch("sparcli.render.Renderer", autospec=True)(None, None)
+    renderer.poll_interval = None
+    renderer.needs_redraw = False
+    renderer.flush_time = 0.0
+    renderer.bytes_written = 0
+    renderer.bytes_forwarded = 0
+    yield renderer
 
 
 @pytest.fixture
-def controller(mocker, renderer):
-    mocker.patch.object(sparcli.controller, "deque", autospec=True)
+def waker(mocker):
+    waker = mocker.patch("sparcli.events.Waker", autospec=True)()
+    waker.wait.return_value = []
+    yield waker
+
+
+@pytest.fixture
+def event_queue(mocker):
+    EventQueue = mocker.patch("sparcli.events.EventQueue", autospec=True)
+    event_queue = EventQueue.return_value
+    event_queue.dropped = event_queue.collapsed = 0
+    yield event_queue
+
+
+@pytest.fixture
+def controller(renderer, waker, event_queue):
     yield sparcli.controller.Controller(renderer)
 
 
+def test_that_signal_handlers_wake_controller(renderer, controller, waker):
+    controller.install_signal_handlers()
+    controller.restore_signal_handlers()
+    renderer.install_signal_handlers.assert_called_once_with(waker.notify)
+    assert renderer.restore_signal_handlers.called
+
+
 def test_that_stop_emits_event(mocker, controller):
     controller.stop()
     controller.event_queue.append.assert_called_once_with(("controller_stopped",))
 
 
 def test_that_run_dispatches_to_methods(mocker, renderer, controller, effector):
+    mocker.patch.object(controller, "value_produced", autospec=True)
     mocker.patch.object(controller, "data_produced", autospec=True)
+    mocker.patch.object(controller, "array_produced", autospec=True)
+    mocker.patch.object(controller, "aggregate_produced", autospec=True)
     mocker.patch.object(controller, "producer_stopped", autospec=True)
     producer = mocker.Mock()
     controller.event_queue.popleft.side_effect = effector(
         [
+            ("value_produced", producer, 0.0),
             ("data_produced", producer, {"x": 1.0}),
+            ("array_produced", producer, "x", [2.0]),
+            ("aggregate_produced", producer, {}),
             ("producer_stopped", producer),
             IndexError,
             ("controller_stopped",),
@@ -36,29 +72,384 @@ def test_that_run_dispatches_to_methods(mocker, renderer, controller, effector):
 
     assert renderer.close.called
     assert renderer.draw.called
+    controller.value_produced.assert_called_once_with(producer, 0.0)
     controller.data_produced.assert_called_once_with(producer, {"x": 1.0})
+    controller.array_produced.assert_called_once_with(producer, "x", [2.0])
+    controller.aggregate_produced.assert_called_once_with(producer, {})
     controller.producer_stopped.assert_called_once_with(producer)
 
 
-def test_that_data_is_written_to_variables(mocker, controller):
+def test_that_events_are_applied_between_frames(
+    mocker, renderer, controller, effector
+):
+    producer = mocker.Mock()
+    controller.event_queue.popleft.side_effect = effector(
+        [("data_produced", producer, {"x": float(x)}) for x in range(100)]
+        + [("controller_stopped",)]
+    )
+    mocker.patch.object(controller, "data_produced", autospec=True)
+
+    controller.run()
+
+    assert controller.data_produced.call_count == 100
+    renderer.draw.assert_called_once_with(controller.variables, True, {})
+
+
+def test_that_last_changes_are_drawn_on_stop(mocker, renderer, controller, effector):
+    controller.event_queue.popleft.side_effect = effector(
+        [("data_produced", mocker.Mock(), {"x": 1.0}), ("controller_stopped",)]
+    )
+    controller.next_frame = float("inf")
+
+    controller.run()
+
+    renderer.draw.assert_called_once_with(controller.variables, True, {})
+
+
+def test_that_batch_size_is_limited(mocker, controller):
+    controller.MAX_BATCH = 2
+    controller.event_queue.popleft.return_value = ("data_produced", None, {})
+
+    assert controller.process_events() == 2
+
+
+def test_that_backlog_beyond_batch_size_is_not_stranded(renderer):
+    controller = sparcli.controller.Controller(renderer)
+    controller.MAX_BATCH = 10
+    for x in range(25):
+        controller.event_queue.append(("data_produced", "producer", {"x": float(x)}))
+    controller.stop()
+
+    controller.start()
+    controller.join(timeout=5)
+
+    assert not controller.is_alive()
+    assert controller.variables["x"].totals.count == 25
+
+
+def test_that_idle_controller_waits_for_events(renderer, controller, waker, effector):
+    controller.event_queue.popleft.side_effect = effector(
+        [IndexError, IndexError, ("controller_stopped",)]
+    )
+
+    controller.run()
+
+    renderer.start.assert_called_once_with(wake=waker.notify)
+    waker.wait.assert_any_call(timeout=None)
+    assert waker.reset.called
+    assert not renderer.draw.called
+    assert waker.close.called
+
+
+def test_that_renderer_can_request_redraw(renderer, controller, effector):
+    renderer.needs_redraw = True
+    controller.event_queue.popleft.side_effect = effector(
+        [IndexError, ("controller_stopped",)]
+    )
+
+    controller.run()
+
+    renderer.draw.assert_called_with(controller.variables, False, {})
+
+
+def test_that_renderer_is_polled_if_necessary(renderer, controller, waker):
+    renderer.poll_interval = 0.1
+    controller.wait()
+    waker.wait.assert_called_once_with(timeout=0.1)
+    assert controller.poll_due
+
+
+def test_that_sinks_are_polled_once_a_frame(mocker, renderer, controller, waker):
+    controller.sinks.append(mocker.Mock())
+    controller.wait()
+    waker.wait.assert_called_once_with(timeout=controller.frame_interval)
+    assert not controller.poll_due
+
+
+def test_that_changed_controller_waits_for_next_frame(mocker, controller, waker):
+    mocker.patch("time.monotonic", return_value=10.0)
+    controller.changed = True
+    controller.next_frame = 10.25
+
+    controller.wait()
+
+    waker.wait.assert_called_once_with(timeout=0.25)
+
+
+@pytest.mark.parametrize("max_fps", [0, -1])
+def test_that_frame_rate_must_be_positive(renderer, max_fps):
+    with pytest.raises(ValueError) as error:
+        sparcli.controller.Controller(renderer, max_fps=max_fps)
+    assert "max_fps" in str(error.value)
+
+
+def test_that_data_is_written_to_variables(mocker, controller, allclose):
     producer = mocker.Mock()
     mocker.patch("sparcli.controller.Variable", autospec=True)
     variable = controller.variables["x"]
 
     controller.data_produced(producer, {"x": 2})
+    controller.data_produced(producer, {"x": 3})
+    controller.ingest()
 
-    variable.reference.assert_called_once_with(producer)
-    variable.series.add.assert_called_once_with(2)
+    variable.reference.assert_called_with(producer)
+    (samples,), _ = variable.extend.call_args
+    assert allclose([2, 3], samples)
+    assert not controller.pending
+
+
+def test_that_metric_values_are_written_to_variables(mocker, controller, allclose):
+    producer = mocker.Mock()
+    metric = sparcli.context.Metric(producer, "x")
+    mocker.patch("sparcli.controller.Variable", autospec=True)
+    variable = controller.variables["x"]
+
+    controller.value_produced(metric, 2)
+    controller.data_produced(producer, {"x": 3})
+    controller.value_produced(metric, 4)
+    controller.ingest()
+
+    variable.reference.assert_called_with(producer)
+    (samples,), _ = variable.extend.call_args
+    assert allclose([2, 3, 4], samples)
+
+
+def test_that_sampled_variables_are_labelled_with_their_policy(
+    mocker, renderer, controller
+):
+    producer, other = mocker.Mock(), mocker.Mock()
+    sampler = sparcli.sampling.EveryNth(4)
+    controller.dispatch("sampler_added", producer, None, sampler)
+    controller.dispatch("sampler_added", other, "z", sampler)
+    controller.data_produced(producer, {"x": 1.0})
+    controller.data_produced(other, {"y": 1.0})
+    controller.data_produced(mocker.Mock(), {"y": 2.0})
+
+    controller.draw()
+
+    variables, _, labels = renderer.draw.call_args[0]
+    assert variables is controller.variables
+    assert labels == {"x": "x (1/4)"}
+
+    controller.producer_stopped(producer)
+    controller.producer_stopped(other)
+    assert not controller.samplers
 
 
-def test_that_old_references_are_cleaned_up(mocker, controller):
+def test_that_sampling_rates_are_measured_at_a_low_rate(mocker, controller):
+    monotonic = mocker.patch("time.monotonic", return_value=10.0)
+    producer = mocker.Mock()
+    sampler = sparcli.sampling.EveryNth(4)
+    controller.dispatch("sampler_added", producer, None, sampler)
+    controller.data_produced(producer, {"x": 1.0})
+    assert controller.labels() == {"x": "x (1/4)"}
+
+    sampler.select(4 * sampler.MIN_KEPT + 2)  # Keeps 11 of 42.
+    assert controller.labels() == {"x": "x (1/4)"}
+    monotonic.return_value += controller.LABEL_INTERVAL
+
+    assert controller.labels() == {"x": "x (1/3.82)"}
+
+
+def test_that_pending_data_is_ingested_before_producer_stops(mocker, controller):
     producer = mocker.Mock()
     mocker.patch("sparcli.data.CompactingSeries")
+    variable = controller.variables["x"]
+    controller.grace_period = 0
+    controller.event_queue.popleft.side_effect = [
+        ("data_produced", producer, {"x": 2}),
+        ("producer_stopped", producer),
+        IndexError,
+    ]
+
+    controller.process_events()
+
+    assert variable.series.extend.called
+    assert not controller.variables
+
+
+def test_that_arrays_are_ingested_after_pending_samples(mocker, controller, allclose):
+    producer = mocker.Mock()
+    mocker.patch("sparcli.controller.Variable", autospec=True)
+    variable = controller.variables["x"]
+    controller.event_queue.popleft.side_effect = [
+        ("data_produced", producer, {"x": 1}),
+        ("array_produced", producer, "x", np.array([2.0, 3.0])),
+        IndexError,
+    ]
+
+    controller.process_events()
+
+    variable.reference.assert_called_with(producer)
+    chunks = [args[0] for args, _ in variable.extend.call_args_list]
+    assert allclose([1, 2, 3], np.concatenate(chunks))
+
+
+def test_that_aggregates_are_merged(mocker, controller):
+    producer = mocker.Mock()
+    mocker.patch("sparcli.controller.Variable", autospec=True)
+    variable = controller.variables["x"]
+    aggregate = sparcli.data.Aggregate()
+    aggregate.extend(np.array([1.0, 2.0, float("nan")]))
+
+    controller.aggregate_produced(producer, {"x": aggregate})
+
+    variable.reference.assert_called_once_with(producer)
+    variable.merge.assert_called_once_with(aggregate)
+
+
+def test_that_variable_version_follows_series():
     variable = sparcli.controller.Variable()
-    variable.reference(producer)
-    controller.variables["x"] = variable
+    version = variable.version
+    variable.series.add(1.0)
+    assert variable.version != version
+
+
+def test_that_variable_totals_include_every_sample(allclose):
+    variable = sparcli.controller.Variable()
+    aggregate = sparcli.data.Aggregate()
+    aggregate.extend(np.array([4.0, float("nan")]))
+
+    variable.add(1.0)
+    variable.extend([2.0, 3.0])
+    variable.merge(aggregate)
+
+    assert variable.series.size + variable.series.head.size == 5
+    totals = variable.totals
+    assert (totals.count, totals.minimum, totals.maximum) == (5, 1.0, 4.0)
+    assert allclose([2.5], [totals.mean])
+
+
+def test_that_old_references_are_cleaned_up(mocker, renderer, controller):
+    producer, other = mocker.Mock(), mocker.Mock()
+    controller.grace_period = 0
+    controller.data_produced(producer, {"x": 1.0, "y": 2.0})
+    controller.data_produced(other, {"y": 3.0})
+    variable = controller.variables["x"]
 
     controller.producer_stopped(producer)
 
     assert not variable.is_live
+    assert list(controller.variables) == ["y"]
+    assert list(controller.producers) == [other]
+    renderer.forget.assert_called_once_with({"x": variable})
+
+
+def test_that_variables_are_kept_for_grace_period(mocker, renderer, controller):
+    monotonic = mocker.patch("time.monotonic", return_value=10.0)
+    first, second = mocker.Mock(), mocker.Mock()
+    controller.data_produced(first, {"x": 1.0, "y": 2.0})
+    x, y = controller.variables["x"], controller.variables["y"]
+
+    controller.producer_stopped(first)
+    monotonic.return_value = 10.5
+    controller.data_produced(second, {"x": 3.0})
+    controller.garbage_collect()
+    assert list(controller.expiring) == ["y"]
+
+    monotonic.return_value = 11.0
+    controller.garbage_collect()
+
+    assert controller.variables == {"x": x}
+    assert x.references == {second}
+    renderer.forget.assert_called_once_with({"y": y})
+    assert controller.changed
+
+
+def test_that_controller_wakes_when_grace_period_ends(mocker, controller, waker):
+    mocker.patch("time.monotonic", return_value=10.0)
+    controller.data_produced(mocker.Mock(), {"x": 1.0})
+    controller.producer_stopped(next(iter(controller.producers)))
+
+    controller.wait()
+    waker.wait.assert_called_with(timeout=1.0)
+
+    controller.renderer.poll_interval = 0.5
+    controller.wait()
+    waker.wait.assert_called_with(timeout=0.5)
+
+
+def test_that_stats_count_work(mocker, renderer, controller):
+    producer = mocker.Mock()
+    aggregate = sparcli.data.Aggregate()
+    aggregate.extend(np.array([1.0, 2.0, 3.0]))
+    controller.event_queue.popleft.side_effect = [
+        ("data_produced", producer, {"x": 1.0, "y": 2.0}),
+        ("array_produced", producer, "x", np.array([2.0, 3.0])),
+        ("aggregate_produced", producer, {"y": aggregate}),
+        IndexError,
+    ]
+    controller.event_queue.__len__.return_value = 0
+    renderer.flush_time = 0.25
+    renderer.bytes_written = 100
+
+    controller.process_events()
+    controller.draw()
+    stats = controller.get_stats()
+
+    assert stats["events"] == 3
+    assert stats["samples"] == 7
+    assert stats["frames"] == 1
+    assert stats["queue_depth"] == 0
+    assert stats["dropped_events"] == 0
+    assert stats["bytes_per_frame"] == 100
+    assert stats["flush_time"] == 0.25
+    assert stats["ingest_time"] > 0
+    assert stats["samples_per_second"] > 0
+
+
+def test_that_stats_are_drawn_when_enabled(renderer, waker, event_queue):
+    controller = sparcli.controller.Controller(renderer, show_stats=True)
+    controller.event_queue.__len__.return_value = 5
+
+    controller.draw()
+    assert not controller.variables
+    controller.draw()
+
+    renderer.draw.assert_called_with(controller.variables, True, {})
+    variable = controller.variables["sparcli.queue_depth"]
+    assert variable.is_live
+    assert variable.series.values[-1] == 5
+    assert "sparcli.draw_load" in controller.variables
+
+
+def test_that_sinks_are_drained(mocker, renderer, controller, effector):
+    sink = mocker.Mock(sparcli.shared.SharedSink)
+    sink.drain.side_effect = [
+        [],
+        [("x", np.array([1.0, 2.0]))],
+        [("x", np.array([3.0]))],
+    ]
+    controller.event_queue.popleft.side_effect = effector(
+        [
+            ("sink_added", sink),
+            IndexError,
+            IndexError,
+            ("sink_closed", sink),
+            IndexError,
+        ]
+    )
+
+    controller.grace_period = 0
+    controller.process_events()
+    controller.process_events()
+    assert controller.variables["x"].is_live
+    controller.process_events()
+
+    assert not controller.sinks
     assert not controller.variables
+    assert sink.release.called
+    assert controller.stats.samples == 3
+
+
+def test_that_open_sinks_are_released_on_stop(mocker, renderer, controller):
+    sink = mocker.Mock(sparcli.shared.SharedSink)
+    sink.drain.return_value = []
+    controller.event_queue.popleft.side_effect = [
+        ("sink_added", sink),
+        ("controller_stopped",),
+    ]
+
+    controller.run()
+
+    assert sink.release.called
@@ -39,6 +39,13 @@ def test_that_series_can_be_compacted(values, expected, allclose):
     assert allclose(expected, output)
 
 
+def test_that_series_can_be_compacted_in_place(allclose):
+    values = np.array([1, 2, NAN, 4, 5, 6], dtype=float)
+    output = sparcli.data.compact(values, out=values[:3])
+    assert allclose([1.5, 4, 5.5], values[:3])
+    assert np.shares_memory(output, values)
+
+
 @pytest.mark.parametrize("max_size", [0, 1, 3])
 def test_that_compacting_series_checks_for_max_size_constraints(max_size):
     with pytest.raises(ValueError) as error:
@@ -88,6 +95,28 @@ def test_that_weighted_head_value_is_included_in_values(
     assert allclose(out_values, values)
 
 
+def test_that_storage_is_reused_when_truncating(allclose):
+    series = sparcli.data.CompactingSeries(4, 1)
+    buffer = series.buffer
+
+    for value in range(10):
+        series.add(float(value))
+    series.extend([10.0, 11.0])
+
+    assert series.buffer is buffer
+    assert allclose([9, 10, 11], series.values)
+
+
+def test_that_head_is_included_when_storage_wraps(allclose):
+    series = sparcli.data.CompactingSeries(4, 2)
+
+    for value in range(11):
+        series.add(float(value))
+
+    assert series.start + series.size > series.max_size
+    assert allclose([6.5, 8.5, (8.5 * 2 + 10) / 3], series.values)
+
+
 @pytest.mark.parametrize(
     "values,expected",
     [([1, 2, 3], 2.0), (range(1, 1000000), 500000), ([1, NAN, 3], 2), ([INF, 3], 3)],
@@ -100,3 +129,128 @@ def test_that_mean_calculation_is_reasonably_stable(values, expected):
         bucket.add(value)
 
     assert expected == bucket.mean
+
+
+@pytest.mark.parametrize("max_size,max_scale", [(4, 1000), (4, 1), (8, 3)])
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 100])
+def test_that_extending_is_equivalent_to_adding(
+    max_size, max_scale, chunk_size, allclose
+):
+    values = np.sin(np.arange(100))
+    values[::5] = NAN
+    values[::11] = INF
+    expected = sparcli.data.CompactingSeries(max_size, max_scale)
+    actual = sparcli.data.CompactingSeries(max_size, max_scale)
+
+    for value in values:
+        expected.add(value)
+    for i in range(0, values.size, chunk_size):
+        actual.extend(values[i : i + chunk_size])
+
+    assert expected.scale == actual.scale
+    assert expected.head.size == actual.head.size
+    assert allclose(expected.tail, actual.tail)
+    assert allclose(expected.values, actual.values)
+
+
+@pytest.mark.parametrize(
+    "buckets,expected",
+    [([[1, 2], [3, 5]], [1.5, 4]), ([[NAN, 2], [INF, NAN]], [2, NAN])],
+)
+def test_that_bucket_means_ignore_non_finite_values(buckets, expected, allclose):
+    output = sparcli.data.bucket_means(np.array(buckets, dtype=float))
+    assert allclose(expected, output)
+
+
+@pytest.mark.parametrize(
+    "value", [2.5, np.float64(2.5), np.float32(2.5), np.array(2.5), np.int64(2)]
+)
+def test_that_numpy_scalars_are_added_as_floats(value):
+    series = sparcli.data.CompactingSeries(4, initial_scale=2)
+
+    series.add(1)
+    series.add(value)
+    # Start another bucket, so that the head holds the value on its own.
+    series.add(value)
+
+    assert series.tail[-1] == (1 + float(value)) / 2
+    assert type(series.head.mean) is float
+
+
+@pytest.mark.parametrize("max_size,max_scale", [(4, 1000), (4, 1), (8, 3)])
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 100])
+def test_that_merging_constant_chunks_is_equivalent_to_adding(
+    max_size, max_scale, chunk_size, allclose
+):
+    chunk_values = np.arange(10, dtype=float)
+    chunk_values[::4] = NAN
+    values = np.repeat(chunk_values, chunk_size)
+    expected = sparcli.data.CompactingSeries(max_size, max_scale)
+    actual = sparcli.data.CompactingSeries(max_size, max_scale)
+
+    expected.extend(values)
+    for i in range(0, values.size, chunk_size):
+        aggregate = sparcli.data.Aggregate()
+        aggregate.extend(values[i : i + chunk_size])
+        actual.merge(aggregate.mean, aggregate.count, aggregate.finite_count)
+
+    assert expected.scale == actual.scale
+    assert expected.head.size == actual.head.size
+    assert allclose(expected.values, actual.values)
+
+
+def test_that_merged_samples_are_split_across_buckets(allclose):
+    series = sparcli.data.CompactingSeries(8, initial_scale=2)
+
+    series.merge(1.0, 3, 2)
+    assert series.head.real_size == 1
+    assert isinstance(series.head.real_size, int)
+    series.merge(4.0, 3, 3)
+
+    # The second bucket has one (rounded from 2/3) finite sample of 1, and one
+    # sample of 4.
+    assert allclose([1, 2.5, 4], series.tail)
+    assert series.head.size == 0
+
+
+@pytest.mark.parametrize(
+    "values,count,mean,minimum,maximum,latest",
+    [
+        ([], 0, NAN, INF, -INF, NAN),
+        ([NAN, INF], 2, NAN, INF, -INF, NAN),
+        ([1, NAN, 3, -2], 4, 2 / 3, -2, 3, -2),
+        ([1, 3, NAN], 3, 2, 1, 3, 3),
+    ],
+)
+def test_that_aggregates_summarise_values(
+    values, count, mean, minimum, maximum, latest, allclose
+):
+    scalars = sparcli.data.Aggregate()
+    arrays = sparcli.data.Aggregate()
+
+    for value in values:
+        scalars.add(value)
+    arrays.extend(np.array(values, dtype=float))
+    merged = sparcli.data.Aggregate()
+    merged.merge(sparcli.data.Aggregate())
+    merged.merge(arrays)
+
+    for aggregate in (scalars, arrays, merged):
+        assert aggregate.count == count
+        assert allclose([mean], [aggregate.mean])
+        assert (aggregate.minimum, aggregate.maximum) == (minimum, maximum)
+        assert allclose([latest], [aggregate.latest])
+
+
+def test_that_version_changes_when_values_are_added():
+    series = sparcli.data.CompactingSeries(4)
+    versions = [series.version]
+
+    series.add(1.0)
+    versions.append(series.version)
+    series.extend([2.0, 3.0])
+    versions.append(series.version)
+    series.merge(4.0, 1, 1)
+    versions.append(series.version)
+
+    assert len(set(versions)) == 4
@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+import sparcli.events
+
+
+@pytest.fixture
+def waker():
+    waker = sparcli.events.Waker()
+    yield waker
+    waker.close()
+
+
+def test_that_waiting_times_out_without_notification(waker):
+    assert waker.wait(timeout=0.01) == []
+
+
+def test_that_notification_wakes_waiting_thread(waker):
+    threading.Timer(0.01, waker.notify).start()
+    assert waker.wait(timeout=5) == []
+    assert waker.pending
+
+
+def test_that_notifications_are_coalesced(mocker, waker):
+    send = mocker.patch.object(waker, "sender", autospec=True).send
+    waker.notify()
+    waker.notify()
+    assert send.call_count == 1
+
+
+def test_that_full_socket_does_not_block(mocker, waker):
+    sender = mocker.patch.object(waker, "sender", autospec=True)
+    sender.send.side_effect = BlockingIOError
+    waker.notify()
+    assert waker.pending
+
+
+def test_that_reset_clears_notification(waker):
+    waker.notify()
+    waker.reset()
+    assert not waker.pending
+    assert waker.wait(timeout=0) == []
+
+
+def test_that_closed_waker_ignores_notifications(waker):
+    waker.close()
+    waker.notify()
+
+
+def test_that_readable_files_are_reported(waker):
+    receiver, sender = sparcli.events.socket.socketpair()
+    sender.send(b"x")
+    assert waker.wait([receiver], timeout=5) == [receiver]
+    receiver.close()
+    sender.close()
+
+
+def test_that_queue_notifies_on_append(mocker):
+    waker = mocker.Mock(sparcli.events.Waker)
+    queue = sparcli.events.EventQueue(waker)
+
+    queue.append(("event",))
+
+    assert waker.notify.called
+    assert len(queue) == 1
+    assert queue.popleft() == ("event",)
+
+
+def make_event(topic, value=None):
+    return (topic, None, {"x": value})
+
+
+def test_that_data_is_refused_when_queue_is_full(mocker):
+    queue = sparcli.events.EventQueue(mocker.Mock(), max_size=1, overflow="collapse")
+
+    assert queue.offer(make_event("data_produced", 1))
+    assert not queue.offer(make_event("data_produced", 2))
+
+    assert len(queue) == 1
+    assert queue.collapsed == 1
+
+
+def test_that_newest_data_is_dropped_when_queue_is_full(mocker):
+    queue = sparcli.events.EventQueue(mocker.Mock(), max_size=1)
+
+    queue.offer(make_event("data_produced", 1))
+    assert queue.offer(make_event("data_produced", 2))
+
+    assert queue.popleft() == make_event("data_produced", 1)
+    assert queue.dropped == 1
+
+
+def test_that_oldest_data_is_dropped_when_queue_is_full(mocker):
+    waker = mocker.Mock(sparcli.events.Waker)
+    queue = sparcli.events.EventQueue(waker, max_size=2, overflow="drop_oldest")
+    queue.append(("producer_stopped", None))
+    queue.offer(make_event("data_produced", 1))
+
+    queue.offer(make_event("array_produced", 2))
+    queue.append(("controller_stopped",))
+    queue.offer(make_event("data_produced", 3))
+
+    assert [queue.popleft() for _ in range(len(queue))] == [
+        ("producer_stopped", None),
+        ("controller_stopped",),
+        make_event("data_produced", 3),
+    ]
+    assert queue.dropped == 2
+    assert waker.notify.call_count == 5
+
+
+def test_that_control_events_are_never_dropped(mocker):
+    queue = sparcli.events.EventQueue(mocker.Mock(), max_size=1, overflow="drop_oldest")
+    queue.append(("producer_stopped", None))
+
+    queue.offer(make_event("data_produced", 1))
+
+    assert len(queue) == 2
+    assert queue.dropped == 0
+
+
+def test_that_drop_oldest_queue_is_only_changed_with_lock(mocker):
+    queue = sparcli.events.EventQueue(mocker.Mock(), max_size=1, overflow="drop_oldest")
+    queue.lock = mocker.MagicMock()
+
+    queue.append(("producer_stopped", None))
+    queue.offer(make_event("data_produced", 1))
+    queue.popleft()
+
+    assert queue.lock.__enter__.call_count == 3
+
+
+@pytest.mark.parametrize("options", [{"overflow": "block"}, {"max_size": 0}])
+def test_that_queue_options_are_validated(mocker, options):
+    with pytest.raises(ValueError):
+        sparcli.events.EventQueue(mocker.Mock(), **options)
+
+
+@pytest.mark.parametrize("overflow", ["drop_newest", "drop_oldest"])
+def test_that_detached_queue_discards_events(mocker, overflow):
+    waker = mocker.Mock(sparcli.events.Waker)
+    queue = sparcli.events.EventQueue(waker, max_size=2, overflow=overflow)
+    append, offer = queue.append, queue.offer
+    queue.offer(make_event("data_produced", 1))
+    lock = queue.lock
+
+    queue.detach()
+    for i in range(3):
+        append(("producer_stopped", None))
+        assert offer(make_event("data_produced", i))
+
+    assert len(queue) == 0
+    assert waker.close.called
+    assert waker.notify.call_count == 1
+    assert queue.lock is None or queue.lock is not lock
@@ -1,6 +1,12 @@
+import os
+import shutil
+import signal
+import threading
+
 import numpy as np
 import pytest
 
+import sparcli.controller
 import sparcli.render
 
 
@@ -43,9 +49,12 @@ def test_that_resampled_series_fits_width(values, width, expected, allclose):
 
 @pytest.fixture
 def capture(mocker):
-    yield mocker.patch("sparcli.capture.capture.MultiCapture", autospec=True)(
+    capture = mocker.patch("sparcli.capture.capture.MultiCapture", autospec=True)(
         None, None
     )
+    capture.mid_line = False
+    capture.terminal_fd = None
+    yield capture
 
 
 @pytest.fixture
@@ -63,16 +72,574 @@ def test_that_renderer_draws_variables(mocker, renderer, capture):
 
     assert render.called
     assert resample.called
-    assert capture.flush.called
     assert capture.write_out.called
     assert renderer.height == len(variables)
 
 
+def test_that_unchanged_variables_are_not_redrawn(mocker, renderer, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    renderer.geometry.refresh()
+
+    renderer.draw({"a": mocker.MagicMock()}, changed=False)
+
+    assert not render.called
+    assert not capture.write_out.called
+
+
+def test_that_forwarded_output_triggers_redraw(mocker, renderer, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    mocker.patch("sparcli.render.resample", autospec=True)
+    renderer.geometry.refresh()
+    renderer.rows = ["a"]
+
+    renderer.erase()
+    assert renderer.needs_redraw
+    capture.write_out.assert_called_once_with("\x1b[1A\r\x1b[J")
+
+    renderer.draw({"a": mocker.MagicMock()}, changed=False)
+    assert render.called
+    assert renderer.height == 1
+    assert not renderer.needs_redraw
+
+
+def test_that_rows_are_not_drawn_after_partial_line(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    mocker.patch("time.monotonic", return_value=10.0)
+    capture.mid_line = True
+    renderer.erase()
+
+    renderer.draw({"a": mocker.MagicMock()})
+
+    assert not capture.write_out.called
+    assert renderer.height == 0
+    assert renderer.needs_redraw
+
+
+def test_that_rows_are_drawn_below_partial_line_after_timeout(
+    mocker, renderer, capture
+):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    monotonic = mocker.patch("time.monotonic", return_value=10.0)
+    capture.mid_line = True
+    renderer.erase()
+    renderer.draw({"a": mocker.MagicMock()})
+
+    monotonic.return_value = 10.5
+    renderer.draw({"a": mocker.MagicMock()}, changed=False)
+    renderer.draw({"a": mocker.MagicMock()})
+
+    assert [args[0] for args, _ in capture.write_out.call_args_list] == [
+        "\n",
+        "\ra ▁▂\n",
+    ]
+    assert not renderer.needs_redraw
+
+
+def test_that_forgotten_variables_are_removed_on_next_draw(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    variable = mocker.MagicMock()
+    renderer.draw({"a": variable})
+
+    renderer.forget({"a": variable})
+    renderer.draw({})
+
+    assert renderer.rows == []
+
+
+def test_that_previous_frame_is_cleared(renderer, capture):
+    renderer.geometry.refresh()
+    renderer.rows = ["a", "b"]
+    renderer.clear()
+    capture.write_out.assert_called_once_with("\x1b[2A\r\x1b[J")
+    assert renderer.height == 0
+
+
+def test_that_frame_is_written_at_once(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.side_effect = ["▁▂", "▃▄"]
+
+    renderer.draw({"a": mocker.MagicMock(), "bb": mocker.MagicMock()})
+
+    capture.write_out.assert_called_once_with("\r a ▁▂\nbb ▃▄\n")
+    assert renderer.rows == [" a ▁▂", "bb ▃▄"]
+    # Each bar is three bytes in UTF-8.
+    assert renderer.bytes_written == 21
+
+
+def test_that_identical_frames_produce_no_output(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    variables = {"a": mocker.MagicMock()}
+
+    renderer.draw(variables)
+    renderer.draw(variables)
+
+    assert capture.write_out.call_count == 1
+
+
+def test_that_unchanged_variables_are_not_rerendered(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    renderer.geometry = mocker.Mock(
+        sparcli.render.TerminalGeometry, columns=80, lines=24
+    )
+    renderer.geometry.refresh.return_value = False
+    a, b = mocker.MagicMock(version=1), mocker.MagicMock(version=1)
+
+    renderer.draw({"a": a, "b": b})
+    b.version = 2
+    renderer.draw({"a": a, "b": b})
+    assert render.call_count == 3
+
+    renderer.geometry.columns = 100
+    renderer.draw({"a": a})
+    assert render.call_count == 4
+    assert list(renderer.cache) == [a]
+
+
+def test_that_resize_redraws_everything(mocker, renderer, capture):
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    renderer.geometry = mocker.Mock(
+        sparcli.render.TerminalGeometry, columns=80, lines=24
+    )
+    renderer.geometry.refresh.return_value = False
+    renderer.draw({"a": mocker.MagicMock()})
+    capture.write_out.reset_mock()
+
+    renderer.geometry.refresh.return_value = True
+    renderer.draw({"a": mocker.MagicMock()}, changed=False)
+
+    capture.write_out.assert_has_calls(
+        [mocker.call("\x1b[1A\r\x1b[J"), mocker.call("\ra ▁▂\n")]
+    )
+
+
+def test_that_rows_leave_the_last_column_empty(mocker, renderer, capture):
+    resample = mocker.patch("sparcli.render.resample", autospec=True)
+    mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    renderer.geometry = mocker.Mock(
+        sparcli.render.TerminalGeometry, columns=80, lines=24
+    )
+
+    renderer.draw({"ab": mocker.MagicMock()})
+
+    (_, width), _ = resample.call_args
+    assert width == 76
+
+
+def test_that_rows_rewrapped_by_resize_are_cleared(mocker, renderer, capture):
+    renderer.geometry = mocker.Mock(
+        sparcli.render.TerminalGeometry, columns=10, lines=24
+    )
+    renderer.rows = ["a" * 25, "b" * 9]
+
+    renderer.clear()
+
+    capture.write_out.assert_called_once_with("\x1b[4A\r\x1b[J")
+
+
+@pytest.fixture
+def short(mocker, capture):
+    mocker.patch("sparcli.data", autospec=True)
+    mocker.patch("sparcli.render.resample", autospec=True)
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+
+    def make_renderer(priority=None, lines=4):
+        renderer = sparcli.render.Renderer(capture.write_out, capture, priority)
+        renderer.geometry = mocker.Mock(
+            sparcli.render.TerminalGeometry, columns=80, lines=lines
+        )
+        renderer.geometry.refresh.return_value = False
+        return renderer
+
+    yield make_renderer
+
+
+def variables_with(mocker, values):
+    variables = {}
+    for name, series in values.items():
+        variables[name] = mocker.MagicMock(version=1)
+        variables[name].series.values = np.array(series, dtype=float)
+    return variables
+
+
+def test_that_only_rows_that_fit_are_rendered(mocker, short):
+    renderer = short()
+    variables = {name: mocker.MagicMock() for name in "abcdefg"}
+
+    renderer.draw(variables)
+
+    assert renderer.rows == ["a ▁▂", "b ▁▂", "+5 more"]
+    assert sparcli.render.render_as_vertical_bars.call_count == 2
+    assert list(renderer.cache) == [variables["a"], variables["b"]]
+
+
+def test_that_visible_rows_are_labelled(mocker, short):
+    renderer = short()
+    variables = {name: mocker.MagicMock() for name in "abcd"}
+
+    renderer.draw(variables, labels={"b": "b (1/4)", "d": "d (1/4)"})
+
+    assert renderer.rows == ["      a ▁▂", "b (1/4) ▁▂", "+2 more"]
+
+
+def test_that_nothing_is_drawn_without_room(mocker, short):
+    renderer = short(lines=1)
+    renderer.draw({"a": mocker.MagicMock()})
+    assert renderer.rows == []
+
+
+def test_that_recently_changed_rows_are_shown(mocker, short):
+    monotonic = mocker.patch("time.monotonic", return_value=0.0)
+    renderer = short("recent")
+    variables = variables_with(mocker, {name: [] for name in "abcd"})
+    renderer.draw(variables)
+    assert renderer.rows == ["a ▁▂", "b ▁▂", "+2 more"]
+
+    monotonic.return_value = 1.0
+    variables["d"].version = 2
+    renderer.draw(variables)
+
+    assert renderer.rows == ["a ▁▂", "d ▁▂", "+2 more"]
+
+
+def test_that_ties_go_to_rows_already_shown(mocker, short):
+    monotonic = mocker.patch("time.monotonic", return_value=0.0)
+    renderer = short("recent")
+    variables = variables_with(mocker, {name: [] for name in "abcd"})
+    renderer.draw(variables)
+    monotonic.return_value = 1.0
+    variables["c"].version = variables["d"].version = 2
+    renderer.draw(variables)
+
+    monotonic.return_value = 2.0
+    for variable in variables.values():
+        variable.version = 3
+    renderer.draw(variables)
+
+    assert renderer.rows == ["c ▁▂", "d ▁▂", "+2 more"]
+
+
+def test_that_rows_with_highest_variance_are_shown(mocker, short):
+    renderer = short("variance")
+    variables = variables_with(
+        mocker,
+        {"a": [1, 1, 1], "b": [0, 5, 0], "c": [NAN, NAN], "d": [0, 1, NAN]},
+    )
+
+    renderer.draw(variables)
+
+    assert renderer.rows == ["b ▁▂", "d ▁▂", "+2 more"]
+
+
+def test_that_variance_is_rescored_at_most_once_per_interval(mocker, short):
+    monotonic = mocker.patch("time.monotonic", return_value=0.0)
+    renderer = short("variance")
+    variables = variables_with(
+        mocker, {"a": [0, 2], "b": [0, 1], "c": [0, 0], "d": [0, 0]}
+    )
+    renderer.draw(variables)
+    assert renderer.rows == ["a ▁▂", "b ▁▂", "+2 more"]
+
+    variables["c"].series.values = np.array([0.0, 9.0])
+    variables["c"].version = 2
+    monotonic.return_value = 0.5
+    renderer.draw(variables)
+    assert renderer.rows == ["a ▁▂", "b ▁▂", "+2 more"]
+
+    # Rescored once the interval is up, without changing again.
+    monotonic.return_value = 1.0
+    renderer.draw(variables)
+    assert renderer.rows == ["a ▁▂", "c ▁▂", "+2 more"]
+
+
+def test_that_row_priority_is_checked(capture):
+    with pytest.raises(ValueError):
+        sparcli.render.Renderer(capture.write_out, capture, "loudest")
+
+
+def test_that_signal_handlers_are_delegated_to_geometry(mocker, renderer, capture):
+    geometry = renderer.geometry = mocker.Mock(sparcli.render.TerminalGeometry)
+    geometry.poll_interval = 1.0
+    geometry.stale = True
+    wake = mocker.Mock()
+
+    renderer.install_signal_handlers(wake)
+    renderer.restore_signal_handlers()
+
+    geometry.install.assert_called_once_with(on_resize=wake)
+    assert geometry.uninstall.called
+    assert renderer.needs_redraw == geometry.stale
+    assert renderer.poll_interval == 1.0
+
+
+@pytest.fixture
+def geometry(mocker):
+    mocker.patch("shutil.get_terminal_size", return_value=os.terminal_size((80, 24)))
+    geometry = sparcli.render.TerminalGeometry()
+    yield geometry
+    geometry.uninstall()
+
+
+def test_that_geometry_is_cached(mocker, geometry):
+    assert geometry.refresh()
+    assert geometry.columns == 80
+    assert not geometry.refresh()
+    assert shutil.get_terminal_size.call_count == 1
+
+
+def test_that_geometry_is_read_from_the_terminal(mocker, geometry):
+    get_terminal_size = mocker.patch("os.get_terminal_size", autospec=True)
+    get_terminal_size.return_value = os.terminal_size((120, 40))
+    geometry.fd = 3
+
+    geometry.refresh()
+
+    get_terminal_size.assert_called_once_with(3)
+    assert geometry.columns == 120
+    assert not shutil.get_terminal_size.called
+
+
+@pytest.mark.parametrize("effect", [OSError, ValueError, [os.terminal_size((0, 0))]])
+def test_that_geometry_falls_back_without_a_terminal(mocker, geometry, effect):
+    mocker.patch("os.get_terminal_size", side_effect=effect)
+    geometry.fd = 3
+
+    geometry.refresh()
+
+    assert geometry.columns == 80
+
+
+def test_that_geometry_is_polled_without_signals(mocker, geometry):
+    monotonic = mocker.patch("time.monotonic", return_value=10.0)
+    geometry.refresh()
+    shutil.get_terminal_size.return_value = os.terminal_size((100, 24))
+
+    monotonic.return_value = 10.0 + geometry.POLL_INTERVAL
+
+    assert geometry.poll_interval == geometry.POLL_INTERVAL
+    assert geometry.refresh()
+    assert geometry.columns == 100
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGWINCH"), reason="Needs SIGWINCH")
+def test_that_geometry_is_refreshed_on_sigwinch(mocker, geometry):
+    previous = mocker.Mock()
+    signal.signal(signal.SIGWINCH, previous)
+    on_resize = mocker.Mock()
+    geometry.install(on_resize)
+    geometry.refresh()
+    shutil.get_terminal_size.return_value = os.terminal_size((100, 24))
+    assert geometry.poll_interval is None
+    assert not geometry.refresh()
+
+    os.kill(os.getpid(), signal.SIGWINCH)
+
+    assert on_resize.called
+    assert previous.called
+    assert geometry.refresh()
+    assert geometry.columns == 100
+    geometry.uninstall()
+    assert signal.getsignal(signal.SIGWINCH) is previous
+    signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+
+
+def test_that_signals_are_only_handled_from_main_thread(mocker, geometry):
+    signal_ = mocker.patch("signal.signal", autospec=True)
+    thread = threading.Thread(target=geometry.install)
+    thread.start()
+    thread.join()
+    assert not geometry.handling_signal
+    assert not signal_.called
+
+
+def test_that_signals_are_only_restored_from_main_thread(mocker, geometry):
+    geometry.handling_signal = True
+    signal_ = mocker.patch("signal.signal", autospec=True)
+    thread = threading.Thread(target=geometry.uninstall)
+    thread.start()
+    thread.join()
+    assert not signal_.called
+    geometry.handling_signal = False
+
+
+def test_that_geometry_is_polled_without_sigwinch(mocker, geometry):
+    mocker.patch.object(sparcli.render, "signal", spec=[])
+    geometry.install()
+    assert not geometry.handling_signal
+
+
+@pytest.mark.parametrize(
+    "old,new,expected",
+    [
+        ([], [], ""),
+        (["ab", "cd"], ["ab", "cd"], ""),
+        ([], ["ab", "cd"], "\rab\ncd\n"),
+        (["abc", "cd"], ["axc", "cd"], "\x1b[2A\x1b[2Gx\x1b[2B\r"),
+        (["abc", "cd"], ["abc", "cde"], "\x1b[1A\x1b[3Ge\x1b[K\x1b[1B\r"),
+        (["a", "b", "c"], ["a"], "\x1b[2A\r\x1b[J"),
+        (["a"], ["x", "y"], "\x1b[1A\x1b[1Gx\x1b[1B\ry\n"),
+    ],
+)
+def test_that_only_changed_cells_are_rewritten(old, new, expected):
+    assert sparcli.render.diff_rows(old, new) == expected
+
+
+def test_that_renderer_exposes_capture_stats(renderer, capture):
+    capture.forward_time = 0.5
+    capture.bytes_forwarded = 10
+    assert renderer.flush_time == 0.5
+    assert renderer.bytes_forwarded == 10
+
+
 def test_that_renderer_captures_output(mocker, renderer, capture):
-    renderer.start()
+    wake = mocker.Mock()
+    capture.terminal_fd = 3
+    renderer.start(wake)
     assert capture.start.called
+    assert renderer.geometry.fd == 3
+    capture.start_forwarding.assert_called_once_with(
+        renderer.lock, before_write=renderer.erase, after_write=wake
+    )
 
 
 def test_that_renderer_releases_output(mocker, renderer, capture):
     renderer.close()
     assert capture.close.called
+
+
+@pytest.fixture
+def pinned(mocker, capture):
+    mocker.patch("sparcli.data", autospec=True)
+    mocker.patch("sparcli.render.resample", autospec=True)
+    renderer = sparcli.render.ScrollRegionRenderer(capture.write_out, capture)
+    renderer.geometry = mocker.Mock(
+        sparcli.render.TerminalGeometry, columns=80, lines=10
+    )
+    renderer.geometry.refresh.return_value = False
+    yield renderer
+
+
+def test_that_scroll_region_is_reserved_for_rows(mocker, pinned, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.side_effect = ["▁▂", "▃▄"]
+    capture.mid_line = True
+
+    pinned.draw({"a": mocker.MagicMock(), "b": mocker.MagicMock()})
+
+    capture.write_out.assert_called_once_with(
+        "\x1bD\x1bD\x1b[2A\x1b7\x1b[1;8r\x1b8"
+        "\x1b7\x1b[0m\x1b[9;1H\x1b[1Ga ▁▂\x1b[K\x1b[10;1H\x1b[1Gb ▃▄\x1b[K\x1b8"
+    )
+
+
+def test_that_only_changed_rows_are_rewritten_in_place(mocker, pinned, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.side_effect = ["▁▂", "▃▄", "▃▅"]
+    a, b = mocker.MagicMock(version=1), mocker.MagicMock(version=1)
+    pinned.draw({"a": a, "b": b})
+    capture.write_out.reset_mock()
+
+    b.version = 2
+    pinned.draw({"a": a, "b": b})
+
+    capture.write_out.assert_called_once_with(
+        "\x1b7\x1b[0m\x1b[10;1H\x1b[4G▅\x1b8"
+    )
+
+
+def test_that_scroll_region_is_restored_on_resize(mocker, pinned, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    pinned.draw({"a": mocker.MagicMock()})
+    capture.write_out.reset_mock()
+
+    pinned.geometry.refresh.return_value = True
+    pinned.geometry.lines = 5
+    pinned.draw({"a": mocker.MagicMock()}, changed=False)
+
+    capture.write_out.assert_called_once_with(
+        "\x1b7\x1b[r\x1b8\x1b[J"
+        "\x1bD\x1b[1A\x1b7\x1b[1;4r\x1b8"
+        "\x1b7\x1b[0m\x1b[5;1H\x1b[1Ga ▁▂\x1b[K\x1b8"
+    )
+
+
+def test_that_rows_that_dont_fit_are_cut_off(mocker, pinned, capture):
+    render = mocker.patch("sparcli.render.render_as_vertical_bars", autospec=True)
+    render.return_value = "▁▂"
+    pinned.geometry.lines = 3
+
+    pinned.draw({name: mocker.MagicMock() for name in "abcd"})
+    assert pinned.rows == ["a ▁▂", "+3 more"]
+
+    pinned.geometry.refresh.return_value = True
+    pinned.geometry.lines = 1
+    pinned.draw({name: mocker.MagicMock() for name in "abcd"})
+    assert pinned.rows == []
+    capture.write_out.assert_called_with("\x1b7\x1b[r\x1b8\x1b[J")
+
+
+def test_that_scroll_region_renderer_forwards_without_erasing(pinned, capture):
+    capture.terminal_fd = 3
+    pinned.start()
+    assert capture.start.called
+    assert pinned.geometry.fd == 3
+    capture.start_forwarding.assert_called_once_with(pinned.lock)
+
+
+def test_that_last_frame_is_left_below_output_on_close(mocker, pinned, capture):
+    pinned.close()
+    assert capture.close.called
+    assert not capture.write_out.called
+
+    pinned.rows = ["a ▁▂", "b ▃▄"]
+    capture.mid_line = True
+    pinned.close()
+
+    capture.write_out.assert_called_once_with(
+        "\x1b7\x1b[r\x1b8\x1b[J\n\ra ▁▂\nb ▃▄\n"
+    )
+    assert pinned.rows == []
+
+
+def test_that_summaries_are_written_for_changed_variables(mocker):
+    write = mocker.Mock()
+    renderer = sparcli.render.SummaryRenderer(write)
+    variable = sparcli.controller.Variable()
+    variable.extend(np.array([1.0, 3.0, float("nan"), 2.0]))
+    empty = sparcli.controller.Variable()
+    renderer.start()
+    renderer.install_signal_handlers(None)
+
+    renderer.draw({"x": variable, "y": empty}, changed=False)
+    assert not write.called
+    renderer.draw({}, changed=True)
+    assert not write.called
+    renderer.forget({"x": variable})
+    renderer.draw({"y": empty}, changed=True, labels={"x": "x (1/4)"})
+
+    output = "x (1/4): 2 (mean 2, min 1, max 3)\ny: no data\n"
+    write.assert_called_once_with(output)
+    assert renderer.bytes_written == len(output.encode("utf8"))
+    renderer.restore_signal_handlers()
+    renderer.close()
+
+
+def test_that_summaries_describe_every_sample_after_compaction():
+    variable = sparcli.controller.Variable()
+    variable.extend(np.tile([0.0, 10.0], 1000))
+
+    line = sparcli.render.summarize("x", variable)
+
+    assert line == "x: 10 (mean 5, min 0, max 10)"
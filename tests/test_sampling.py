@@ -0,0 +1,108 @@
+import pytest
+
+import sparcli.sampling
+
+
+def kept(sampler, n):
+    return [i for i in range(n) if sampler.keep()]
+
+
+def test_that_every_nth_value_is_kept():
+    sampler = sparcli.sampling.EveryNth(3)
+
+    assert kept(sampler, 8) == [0, 3, 6]
+    assert (sampler.kept, sampler.seen) == (3, 8)
+
+
+def test_that_values_can_be_selected_in_bulk():
+    sampler = sparcli.sampling.EveryNth(3)
+
+    assert sampler.select(5) == [0, 3]
+    assert sampler.select(5) == [1, 4]
+    assert sampler.select(1) == []
+    assert sampler.seen == 11
+    assert kept(sampler, 3) == [1]
+
+
+def test_that_at_most_one_value_is_kept_per_interval(mocker):
+    monotonic = mocker.patch("time.monotonic", return_value=0.0)
+    sampler = sparcli.sampling.Interval(1.0)
+    times = []
+    for i in range(4000):
+        monotonic.return_value = i / 1000
+        if sampler.keep():
+            times.append(monotonic.return_value)
+
+    assert times[0] == 0.0
+    assert all(b - a >= 1.0 for a, b in zip(times, times[1:]))
+    assert len(times) == 4
+    # The clock was only checked for a small fraction of the values.
+    assert monotonic.call_count < 100
+
+
+def test_that_a_random_fraction_is_kept(mocker):
+    assert sparcli.sampling.Fraction(1.0).select(3) == [0, 1, 2]
+
+    mocker.patch("random.random", side_effect=[0.5, 0.9, 0.0])
+    sampler = sparcli.sampling.Fraction(0.5)
+
+    # Gaps of 1 + log(0.5) / log(0.5), then 1 + log(0.1) / log(0.5).
+    assert kept(sampler, 6) == [1, 5]
+
+
+def test_that_rate_is_the_fraction_kept():
+    sampler = sparcli.sampling.EveryNth(4)
+    assert sampler.rate == 1.0
+
+    sampler.select(8)
+
+    assert sampler.rate == 0.25
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"every": 0},
+        {"every": 1.5},
+        {"interval": 0},
+        {"fraction": 0},
+        {"fraction": 1.5},
+        {"every": 2, "fraction": 0.5},
+    ],
+)
+def test_that_options_are_checked(options):
+    with pytest.raises(ValueError):
+        sparcli.sampling.policy(**options)
+
+
+def test_that_policy_makes_samplers():
+    assert sparcli.sampling.policy() is None
+    assert isinstance(sparcli.sampling.policy(every=2)(), sparcli.sampling.EveryNth)
+    assert isinstance(sparcli.sampling.policy(interval=1)(), sparcli.sampling.Interval)
+    assert isinstance(
+        sparcli.sampling.policy(fraction=0.1)(), sparcli.sampling.Fraction
+    )
+
+
+def test_that_rate_label_shows_the_fraction_kept_once_known(mocker):
+    mocker.patch("random.random", return_value=0.5)
+    sampler = sparcli.sampling.Fraction(0.5)
+    # Gaps of 1 + log(0.5) / log(0.5), so it keeps 9 of 19.
+    sampler.select(19)
+    assert sampler.rate_label == "1/2"
+
+    sampler.select(2)
+
+    assert sampler.rate_label == "1/2.1"
+
+
+@pytest.mark.parametrize(
+    "options, label",
+    [
+        ({"every": 100}, "1/100"),
+        ({"interval": 0.5}, "1 per 0.5s"),
+        ({"fraction": 0.01}, "1/100"),
+    ],
+)
+def test_that_samplers_are_labelled_with_their_policy(options, label):
+    assert sparcli.sampling.policy(**options)().label == label
@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import sparcli.shared
+
+
+@pytest.fixture
+def sink():
+    sink = sparcli.shared.SharedSink(2, capacity=4)
+    yield sink
+    sink.release()
+
+
+def drain(sink):
+    return [(name, values.tolist()) for name, values in sink.drain()]
+
+
+def test_that_samples_are_drained_by_variable(sink):
+    context = sink.claim_slot()
+    context.record(x=1, y=2)
+    context.record_array("x", [3, 4])
+
+    assert drain(sink) == [("x", [1, 3, 4]), ("y", [2])]
+    assert drain(sink) == []
+
+
+def test_that_metric_handles_record_into_the_ring(sink):
+    context = sink.claim_slot()
+    x = context.metric("x")
+    x(1)
+    context.record(y=2)
+    x.record(3)
+
+    assert drain(sink) == [("x", [1, 3]), ("y", [2])]
+
+
+def test_that_workers_can_be_kept_separate():
+    sink = sparcli.shared.SharedSink(2, capacity=4, merge=False)
+    sink.claim_slot().record(x=1)
+    sink.claim_slot().record(x=2)
+
+    assert drain(sink) == [("x[0]", [1]), ("x[1]", [2])]
+    sink.release()
+
+
+def test_that_ring_wraps_around(sink):
+    context = sink.claim_slot()
+    context.record_array("x", [1, 2, 3])
+    drain(sink)
+
+    context.record_array("x", [4, 5, 6])
+
+    assert drain(sink) == [("x", [4, 5, 6])]
+
+
+def test_that_full_ring_drops_samples(sink):
+    context = sink.claim_slot()
+    context.record_array("x", [1, 2, 3])
+    context.record_array("x", [4, 5])
+    context.record(x=6)
+
+    assert drain(sink) == [("x", [1, 2, 3, 4])]
+    assert sink.dropped == 2
+
+
+def test_that_slots_are_limited(sink):
+    sink.claim_slot()
+    sink.claim_slot()
+    with pytest.raises(RuntimeError):
+        sink.claim_slot()
+
+
+@pytest.mark.parametrize("names", [["x" * 65], [f"x{i}" for i in range(257)]])
+def test_that_names_must_fit(sink, names):
+    context = sink.claim_slot()
+    with pytest.raises(ValueError):
+        for name in names:
+            context.record(**{name: 1.0})
+
+
+def test_that_sink_can_be_attached_by_state(sink):
+    other = sparcli.shared.SharedSink.__new__(sparcli.shared.SharedSink)
+    other.__setstate__(sink.__getstate__())
+
+    with other.claim_slot() as context:
+        context.record(x=1.0)
+
+    assert drain(sink) == [("x", [1.0])]
+    other.memory.close()
+
+
+def record_in_worker(sink):
+    sink.claim_slot().record_array("x", np.arange(3))
+
+
+def test_that_workers_record_into_parent(sink):
+    process = multiprocessing.Process(target=record_in_worker, args=(sink,))
+    process.start()
+    process.join()
+
+    assert drain(sink) == [("x", [0, 1, 2])]
+
+
+def test_that_slots_are_released_when_workers_exit(sink):
+    for _ in range(3):
+        process = multiprocessing.Process(target=record_in_worker, args=(sink,))
+        process.start()
+        process.join()
+        assert drain(sink) == [("x", [0, 1, 2])]
+
+    assert not sink.headers[:, sparcli.shared.OWNER].any()
+
+
+def test_that_slots_of_dead_workers_are_reused(sink):
+    process = multiprocessing.Process(target=lambda: None)
+    process.start()
+    process.join()
+    sink.claim_slot().record(x=1.0, y=2.0)
+    sink.claim_slot()
+    sink.headers[0, sparcli.shared.OWNER] = process.pid
+
+    context = sink.claim_slot()
+    context.record(y=3.0)
+
+    assert context.slot == 0
+    assert drain(sink) == [("x", [1.0]), ("y", [2.0, 3.0])]
+
+
+def test_that_rings_can_be_published_under_locks(mocker):
+    mocker.patch("sparcli.shared.ORDERED", False)
+    sink = sparcli.shared.SharedSink(1, capacity=2)
+    context = sink.claim_slot()
+    context.record(x=1.0)
+    context.record_array("x", [2.0, 3.0])
+
+    assert drain(sink) == [("x", [1.0, 2.0])]
+    assert sink.dropped == 1
+    sink.release()
+
+
+def test_that_contexts_can_outlive_the_memory():
+    sink = sparcli.shared.SharedSink(1)
+    context = sink.claim_slot()
+    sink.release()
+
+    context.record(x=1.0)
+    sink.release_slot(0, os.getpid())
+
+
+def test_that_slots_are_released_by_their_owner(sink, mocker):
+    sink.claim_slot()
+    sink.release_slot(0, os.getpid() + 1)
+    assert sink.headers[0, sparcli.shared.OWNER] == os.getpid()
+
+    sink.release_slot(0, os.getpid())
+    assert sink.headers[0, sparcli.shared.OWNER] == 0
+
+    mocker.patch("os.kill", side_effect=PermissionError)
+    assert sparcli.shared.process_exists(1)
+
+
+def test_that_closing_stops_draining(mocker, sink):
+    emit = sink.emit = mocker.Mock()
+    with sink:
+        pass
+    sink.close()
+    emit.assert_called_once_with(("sink_closed", sink))